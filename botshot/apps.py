@@ -7,6 +7,6 @@ class BotshotConfig(AppConfig):
     def ready(self):
         from botshot.core.interface_factory import InterfaceFactory
         import botshot.core.scheduler  # loads periodic scheduler task
-        interfaces = InterfaceFactory().get_interfaces()
-        for itf in interfaces:
-            itf().on_server_startup()
+        # validates INTERFACES and creates the interfaces of this process
+        for itf in InterfaceFactory.get_interfaces():
+            InterfaceFactory.from_name(itf.name).on_server_startup()
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of ChatConversation.context_dict load and save cost per message.
+
+Compares the inline JSON entity schema with the legacy base64-encoded pickle.
+Run with: python -m botshot.benchmarks.context_serialization [entities] [values] [iterations]
+"""
+import json
+import pickle
+import sys
+import time
+from base64 import b64encode
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(BOT_CONFIG={})
+
+from botshot.core.context import Context
+from botshot.core.entity_value import EntityValue
+from botshot.core.persistence import json_serialize, json_deserialize
+
+
+def legacy_json_serialize(obj):
+    """The context_dict encoder used before entity schema version 2."""
+    if isinstance(obj, EntityValue):
+        data = b64encode(pickle.dumps(obj))
+        return {"__data__": data.decode('utf8'), '__type__': 'entity'}
+    return json_serialize(obj)
+
+
+def make_context(num_entities, num_values):
+    context = Context(entities={}, history=[], counter=0)
+    for counter in range(num_values):
+        context.counter = counter
+        context.add_state('default.state_{}'.format(counter))
+        for i in range(num_entities):
+            name = 'entity_{}'.format(i)
+            raw = {'value': 'value {} of {}'.format(counter, name), 'confidence': 0.9, 'source': 'benchmark'}
+            entity = EntityValue(name, counter=counter, state_set=context.get_state_name(), raw=raw)
+            context.entities.setdefault(name, []).insert(0, entity)
+    return context
+
+
+def measure(context, encoder, iterations):
+    blob = json.dumps(context.to_dict(), default=encoder)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        Context.load(json.loads(blob, object_hook=json_deserialize))
+    load_time = (time.perf_counter() - start) / iterations
+    start = time.perf_counter()
+    for _ in range(iterations):
+        json.dumps(context.to_dict(), default=encoder)
+    save_time = (time.perf_counter() - start) / iterations
+    return load_time, save_time, len(blob)
+
+
+def main(num_entities=30, num_values=30, iterations=50):
+    context = make_context(num_entities, num_values)
+    print("Context with {} entities x {} values, {} iterations".format(num_entities, num_values, iterations))
+    results = {}
+    for name, encoder in [('pickle (v1)', legacy_json_serialize), ('schema (v2)', json_serialize)]:
+        load_time, save_time, size = measure(context, encoder, iterations)
+        results[name] = size
+        print("{:<12} load {:8.2f} ms   save {:8.2f} ms   size {:8.1f} kB".format(
+            name, load_time * 1000, save_time * 1000, size / 1024
+        ))
+    print("Size ratio pickle / schema: {:.2f}".format(results['pickle (v1)'] / results['schema (v2)']))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
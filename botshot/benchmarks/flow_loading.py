@@ -0,0 +1,69 @@
+"""
+Benchmark of loading flows of a large bot with get_flows().
+
+Compares parsing the YAML files with loading the definitions cached in FLOW_CACHE_DIR.
+Run with: python -m botshot.benchmarks.flow_loading [files] [flows per file] [states per flow]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(BOT_CONFIG={})
+
+from botshot.core import flow
+
+
+def write_bots(base_dir, num_files, num_flows, num_states):
+    bots = []
+    for i in range(num_files):
+        lines = []
+        for j in range(num_flows):
+            name = "default" if i == j == 0 else "flow_{}_{}".format(i, j)
+            lines += ["{}:".format(name), "    intent: \"{}\"".format(name), "    states:"]
+            for k in range(num_states):
+                lines += [
+                    "    - name: {}".format("root" if k == 0 else "state_{}".format(k)),
+                    "      intent: \"{}_{}\"".format(name, k),
+                    "      action:",
+                    "        text: \"Message {} of {}\"".format(k, name),
+                    "        replies: [\"Yes\", \"No\", \"Maybe\"]",
+                    "        next: \"{}.root\"".format(name),
+                    "      supports: [\"yes_no\", {\"intent\": [\"yes\", \"no\"]}]",
+                ]
+        filename = "bots/flows_{}.yml".format(i)
+        with open(os.path.join(base_dir, filename), "w") as f:
+            f.write("\n".join(lines) + "\n")
+        bots.append(filename)
+    return bots
+
+
+def measure(name):
+    start = time.perf_counter()
+    flows = flow.get_flows(cache=False)
+    elapsed = time.perf_counter() - start
+    print("{:<14} {:8.3f} s".format(name, elapsed))
+    return elapsed, len(flows)
+
+
+def main(num_files=300, num_flows=5, num_states=10):
+    with tempfile.TemporaryDirectory() as base_dir:
+        os.mkdir(os.path.join(base_dir, "bots"))
+        bots = write_bots(base_dir, num_files, num_flows, num_states)
+        settings.BASE_DIR = base_dir
+        print("{} files with {} flows of {} states".format(num_files, num_flows, num_states))
+
+        settings.BOT_CONFIG = {'BOTS': bots, 'FLOW_CACHE_DIR': None}
+        parsed_time, count = measure("parse YAML")
+        settings.BOT_CONFIG = {'BOTS': bots, 'FLOW_CACHE_DIR': os.path.join(base_dir, "cache")}
+        measure("fill cache")
+        cached_time, cached_count = measure("cached")
+        assert count == cached_count == num_files * num_flows
+        print("Speedup: {:.1f}x".format(parsed_time / cached_time))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,57 @@
+"""
+Benchmark of computing the next fire times of many recurrent schedules.
+
+Compares computing each schedule on its own with botshot.core.recurrence.next_fire_times,
+which computes each distinct timespec once.
+Run with: python -m botshot.benchmarks.recurrence [schedules] [distinct timespecs] [fire times]
+"""
+import random
+import sys
+import time
+from datetime import datetime
+
+import pytz
+
+from botshot.core.recurrence import Recurrence, next_fire_times
+
+
+def make_timespecs(count, seed=42):
+    rng = random.Random(seed)
+    timespecs = []
+    for _ in range(count):
+        kind = rng.choice(['hourly', 'daily', 'weekly', 'monthly', 'cron'])
+        timespec = {"second": 0, "minute": rng.randrange(60)}
+        if kind in ('daily', 'weekly', 'monthly'):
+            timespec["hour"] = rng.randrange(24)
+        if kind == 'weekly':
+            timespec["day_of_week"] = rng.randrange(7)
+        if kind == 'monthly':
+            timespec["day_of_month"] = rng.randrange(1, 29)
+        if kind == 'cron':
+            timespec = "*/{} {}-17 * * 1-5".format(rng.choice([5, 10, 15, 30]), rng.randrange(6, 12))
+        timespecs.append(timespec)
+    return timespecs
+
+
+def main(num_schedules=100000, num_timespecs=1000, count=10):
+    rng = random.Random(0)
+    timespecs = make_timespecs(num_timespecs)
+    schedules = [(id, rng.choice(timespecs), None, None) for id in range(num_schedules)]
+    now = datetime(2026, 10, 18, 12, 0, tzinfo=pytz.utc)
+    print("{} schedules with {} distinct timespecs, {} fire times each".format(num_schedules, num_timespecs, count))
+
+    start = time.perf_counter()
+    batch = next_fire_times(schedules, count, now=now)
+    batch_time = time.perf_counter() - start
+    print("{:<14} {:8.2f} s".format("batch", batch_time))
+
+    start = time.perf_counter()
+    single = {id: Recurrence.parse(timespec).next_times(now, count) for id, timespec, _, _ in schedules}
+    single_time = time.perf_counter() - start
+    print("{:<14} {:8.2f} s".format("one by one", single_time))
+    assert batch == single
+    print("Speedup: {:.1f}x".format(single_time / batch_time))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,10 +1,13 @@
 import logging
+import threading
+from collections import OrderedDict
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 from django.utils import timezone
 from django.utils.timezone import make_aware
 from datetime import datetime
 from botshot.core import config
+from botshot.core.context_store import get_context_store
 from botshot.core.parsing.message_parser import parse_text_entities
 from botshot.core.parsing.raw_message import RawMessage
 from botshot.core.responses import TextMessage, MessageElement
@@ -16,6 +19,10 @@ class ChatManager:
     def __init__(self):
         from botshot.core.interceptors import AdminDialogInterceptor, BotshotVersionDialogInterceptor
         self.save_messages = config.get("SAVE_MESSAGES", True)
+        self.response_persistence = config.get("RESPONSE_PERSISTENCE", "sync")
+        # responses sent while processing a message, saved together at the end
+        self.pending_responses = None
+        self.context_store = get_context_store()
         # TODO: Register extra interceptors in config
         self.interceptors = [AdminDialogInterceptor(), BotshotVersionDialogInterceptor()]
 
@@ -38,27 +45,28 @@ class ChatManager:
                 conversation.raw_conversation_id = raw_message.raw_conversation_id
                 conversation.meta = raw_message.conversation_meta
                 raw_message.interface.fill_conversation_details(conversation)
-                # Save and read instance from database to acquire lock
-                conversation.save()
+                # the inserted row stays locked until the transaction ends
+                conversation.save(force_insert=True)
                 logging.info("Created new conversation: %s", conversation.__dict__)
-                conversation = ChatConversation.objects.select_for_update().get(pk=conversation.conversation_id)
 
+            # written with the context when the message is processed
             conversation.last_message_time = timezone.now()
 
             try:
                 user = ChatUser.objects.get(raw_user_id=raw_message.raw_user_id)
+                _remember_state(user)
             except ObjectDoesNotExist:
                 user = ChatUser()
                 user.raw_user_id = raw_message.raw_user_id
                 logging.info("Created new user: %s", user.__dict__)
                 # Save user before filling details so that image field can be saved
-                user.save()
-                user.conversations.add(conversation)  # save metadata before filling details
-                conversation.save()
-
+                user.save(force_insert=True)
+                _remember_state(user)
                 # TODO: also update details of existing users every once in a while
+                # changed details are saved after the message is processed
                 raw_message.interface.fill_user_details(user)
-                user.save()
+
+            _add_membership(user, conversation)
 
             message = ChatMessage()
             message.conversation = conversation
@@ -75,9 +83,11 @@ class ChatManager:
         with transaction.atomic():
             conversation = ChatConversation.objects.select_for_update().get(pk=conversation_id)
             user = ChatUser.objects.get(pk=user_id)
+            _remember_state(user)
 
             # TODO: this might break for more users or with special messages
-            if conversation.context_dict and conversation.context_dict.get("counter") != counter:  # user was active
+            context = self.context_store.load(conversation)
+            if conversation.context_dict and context.counter != counter:  # user was active
                 return
 
             message = ChatMessage()
@@ -94,6 +104,7 @@ class ChatManager:
             conversation = ChatConversation.objects.select_for_update().get(pk=conversation_id)
             if user_id is not None:
                 user = ChatUser.objects.get(pk=user_id)
+                _remember_state(user)
             else:  # generic postback for conversation, not for a specific member
                 user = None  # TODO: if there's just one user, set this to the user
 
@@ -110,6 +121,8 @@ class ChatManager:
         # Import here to be able to mock the message processor class
         # TODO: Could be implemented using a MessageProcessorFactory instead
         from botshot.core.message_processor import MessageProcessor
+        processor = None
+        self.pending_responses = []
         try:
             logging.info("Processing user message: %s", message)
             processor = MessageProcessor(self, message=message, interceptors=self.interceptors)
@@ -118,11 +131,17 @@ class ChatManager:
             logging.exception("ERROR: Exception while processing message")
             # TODO: Save error message (ChatMessage.type = ERROR)
 
-        message.conversation.save()
+        self.context_store.save(message.conversation)
         if message.user is not None:
-            message.user.save()
+            _save_changes(message.user)
         if self.save_messages:
             message.save()
+        # responses that were sent are saved even if processing failed later
+        responses, self.pending_responses = self.pending_responses, None
+        self.save_responses(responses)
+        if processor is not None:
+            # loggers can read what the message changed once it's committed
+            transaction.on_commit(processor.logging_service.flush)
 
     def parse_raw_message_entities(self, raw_message):
         entities = raw_message.payload
@@ -144,16 +163,23 @@ class ChatManager:
         logging.info("Sending bot responses: %s", responses)
         conversation.interface.send_responses(conversation, reply_to, responses)
 
+        messages = []
         for response in responses:
             message = ChatMessage()
-            message.conversation = conversation
-            message.user = reply_to.user if reply_to else None
+            # only IDs, the messages can be pickled to be saved in a task
+            message.conversation_id = conversation.conversation_id
+            message.user_id = reply_to.user_id if reply_to else None
             message.type = ChatMessage.MESSAGE
             message.text = response.get_text()
             message.time = timezone.now()
             message.is_user = False
             message.response_dict = response
-            message.save()
+            messages.append(message)
+
+        if self.pending_responses is not None:
+            self.pending_responses += messages
+        else:
+            self.save_responses(messages)
 
         # Schedule logging messages
         # try:
@@ -164,21 +190,35 @@ class ChatManager:
         # except Exception as e:
         #     print('Error scheduling message log', e)
 
-    def broadcast(self, conversations, responses):
+    def save_responses(self, messages):
+        """
+        Saves sent responses according to RESPONSE_PERSISTENCE:
+        "sync" saves them in one query, "async" in a task after the transaction commits, "none" doesn't save them.
+        """
+        if not messages or self.response_persistence == "none":
+            return
+        if self.response_persistence == "async":
+            from botshot.tasks import run_async
+            transaction.on_commit(lambda: run_async(save_messages, messages=messages))
+        else:
+            save_messages(messages)
+
+    def broadcast(self, conversations, responses, broadcast_id=None):
         """
         Send the same responses to multiple conversations.
         Example usage: notifications, news, ...
 
         :param conversations: Iterable of Conversation objects
         :param responses: Iterable of MessageElement objects
+        :param broadcast_id: (optional) unique ID of the broadcast, used to resume it if it was interrupted
         """
         logging.info("Sending broadcast to %d conversations: %s" % (len(conversations), responses))
         interfaces = {}
         for conversation in conversations:
-            a = interfaces.setdefault(conversation.interface, [])
+            a = interfaces.setdefault(conversation.interface_name, [])
             a.append(conversation)
-        for interface, targets in interfaces.items():
-            interface.broadcast_responses(targets, responses)
+        for targets in interfaces.values():
+            targets[0].interface.broadcast_responses(targets, responses, broadcast_id=broadcast_id)
 
     @staticmethod
     def process_responses(responses):
@@ -192,3 +232,60 @@ class ChatManager:
             elif not isinstance(responses[i], MessageElement):
                 raise ValueError("Invalid message element of type %s" % type(responses[i]))
         return responses
+
+
+def save_messages(messages):
+    """Inserts messages in one query, in order."""
+    ChatMessage.objects.bulk_create(messages)
+
+
+# (user_id, conversation_id) of known memberships, least recently used first
+_memberships = OrderedDict()
+_memberships_lock = threading.Lock()
+
+
+def _add_membership(user, conversation):
+    """Adds a user to a conversation, unless they are known to be a member already."""
+    key = (user.user_id, conversation.conversation_id)
+    with _memberships_lock:
+        if key in _memberships:
+            _memberships.move_to_end(key)
+            return
+    # a single INSERT, the membership is kept if it already exists
+    Membership = ChatUser.conversations.through
+    Membership.objects.bulk_create(
+        [Membership(chatuser_id=user.user_id, chatconversation_id=conversation.conversation_id)],
+        ignore_conflicts=True
+    )
+    # remembered only once the row is committed, a rolled back membership is inserted again
+    transaction.on_commit(lambda: _remember_membership(key))
+
+
+def _remember_membership(key):
+    with _memberships_lock:
+        _memberships[key] = True
+        _memberships.move_to_end(key)
+        while len(_memberships) > config.get("MEMBERSHIP_CACHE_SIZE", 10000):
+            _memberships.popitem(last=False)
+
+
+def _get_state(instance) -> dict:
+    return {field.attname: field.value_to_string(instance) for field in instance._meta.concrete_fields}
+
+
+def _remember_state(instance):
+    """Remembers field values of a model instance, see _save_changes."""
+    instance._botshot_state = _get_state(instance)
+
+
+def _save_changes(instance):
+    """Saves fields of a model instance that changed since _remember_state, or all fields if it wasn't called."""
+    state = getattr(instance, '_botshot_state', None)
+    if state is None:
+        instance.save()
+        return
+    current = _get_state(instance)
+    changed = [name for name, value in current.items() if state.get(name) != value]
+    if changed:
+        instance.save(update_fields=changed)
+    instance._botshot_state = current
@@ -2,29 +2,62 @@ import logging
 import time
 from typing import Union, Optional
 
+from collections import deque
 from collections.abc import Iterable
 from functools import reduce
 
+from botshot.core import config, metrics
 from botshot.core.entity_query import EntityQuery
 from botshot.core.entity_value import EntityValue
+from botshot.core.parsing.entity_extractor import METADATA_ENTITIES
+
+# Version of the dict created by Context.to_dict().
+# Version 1 contexts (without the "version" key) are upgraded when they are loaded.
+CONTEXT_VERSION = 2
 
 
 class Context(object):
 
-    def __init__(self, entities, history, counter, max_depth=30, history_limit=30):
+    _FIELDS = ('counter', 'entities', 'history', 'max_depth', 'history_limit',
+               'max_entities', 'max_age', 'max_seconds', 'evicted')
+
+    def __init__(self, entities, history, counter, max_depth=30, history_limit=30,
+                 max_entities=None, max_age=None, max_seconds=None, evicted=None):
+        """
+        :param entities:        dict of entity name -> list of EntityValue, newest first
+        :param history:         list of visited states, newest first
+        :param counter:         number of messages received in the conversation
+        :param max_depth:       how many values to keep for each entity
+        :param history_limit:   how many states to keep in history
+        :param max_entities:    (optional) how many values to keep in total, the oldest ones are evicted first
+        :param max_age:         (optional) drop values older than this number of messages
+        :param max_seconds:     (optional) drop values older than this number of seconds
+        :param evicted:         counts of values removed by each of the limits above
+        """
         self.counter = counter
-        self.entities = entities
-        self.history = history
         self.max_depth = max_depth
         self.history_limit = history_limit
+        self.max_entities = max_entities
+        self.max_age = max_age
+        self.max_seconds = max_seconds
+        self.evicted = {'depth': 0, 'budget': 0, 'age': 0, 'expired': 0}
+        self.evicted.update(evicted or {})
+        self.entities = {}
+        for name, values in entities.items():
+            values = list(values)
+            if max_depth is not None and len(values) > max_depth:
+                self._count_eviction('depth', len(values) - max_depth)
+                values = values[:max_depth]
+            self.entities[name] = deque(values, maxlen=max_depth)
+        self.history = history
 
     def __getattr__(self, item):
-        if item in ['counter', 'entities', 'history', 'max_depth', 'history_limit']:
+        if item in Context._FIELDS:
             return super().__getattribute__(item)
         return self.__getitem__(item)
 
     def __setattr__(self, key, value):
-        if key in ['counter', 'entities', 'history', 'max_depth', 'history_limit']:
+        if key in Context._FIELDS:
             return super().__setattr__(key, value)
         return self.__setitem__(key, value)
 
@@ -37,22 +70,56 @@ class Context(object):
 
     def to_dict(self) -> dict:
         return {
+            'version': CONTEXT_VERSION,
             'history': self.history,
             'entities': self.entities,
             'counter': self.counter,
+            'evicted': self.evicted,
         }
 
     @staticmethod
     def load(data: dict):
+        version = data.get("version", 1)
+        if version > CONTEXT_VERSION:
+            raise ValueError("Context version {} is newer than supported version {}".format(version, CONTEXT_VERSION))
         history = data.get("history", [])
         counter = int(data.get("counter", 0))
-        entities = data.get("entities", {})
-        return Context(entities=entities, history=history, counter=counter)
+        entities = Context._load_entities(data.get("entities", {}))
+        context = Context(
+            entities=entities,
+            history=history,
+            counter=counter,
+            max_depth=config.get("CONTEXT_MAX_DEPTH", 30),
+            history_limit=config.get("CONTEXT_HISTORY_LIMIT", 30),
+            max_entities=config.get("CONTEXT_MAX_ENTITIES"),
+            max_age=config.get("CONTEXT_MAX_AGE"),
+            max_seconds=config.get("CONTEXT_MAX_SECONDS"),
+            evicted=data.get("evicted"),
+        )
+        context.prune()
+        return context
+
+    @staticmethod
+    def _load_entities(entities: dict) -> dict:
+        """
+        Drops values that failed to load, for example entities with an unsupported schema version.
+        Pickled values of version 1 contexts were already unpickled by json_deserialize,
+        they will be saved in the new schema.
+        """
+        migrated = {}
+        for entity_name, values in entities.items():
+            values = [value for value in values or [] if isinstance(value, EntityValue)]
+            if values:
+                migrated[entity_name] = values
+        return migrated
 
     def add_message_entities(self, entities):
         # TODO don't increment when @ requires -> input and it's valid
         # TODO what to say and do on invalid requires -> input?
         for entity_name, entity_values in entities.items():
+            if entity_name in METADATA_ENTITIES:
+                # describes how the message was parsed, kept only with the message
+                continue
             # allow also direct passing of {'entity' : 'value'}
 
             if not isinstance(entity_values, dict) and not isinstance(entity_values, list):
@@ -69,14 +136,79 @@ class Context(object):
 
         if 'value' in entity_dict:
             entity = EntityValue(entity_name, counter=self.counter, state_set=self.get_state_name(), raw=entity_dict)
-            self.entities.setdefault(entity_name, []).insert(0, entity)
+            self._push(entity_name, entity)
 
         if 'values' in entity_dict:  # compound entities (probably Wit.ai?)
             for item in entity_dict['values']:
                 for role, entity in item.items():
                     canon_name = entity_name + "__" + role
                     entity = EntityValue(canon_name, counter=self.counter, state_set=self.get_state_name(), value=entity)
-                    self.entities.setdefault(canon_name, []).insert(0, entity)
+                    self._push(canon_name, entity)
+
+    def _push(self, entity_name, entity: EntityValue):
+        """Prepends a value of an entity and enforces the retention limits. All writes should go through here."""
+        values = self.entities.get(entity_name)
+        if values is None:
+            values = self.entities[entity_name] = deque(maxlen=self.max_depth)
+        if len(values) == values.maxlen:
+            # the oldest value falls off the other end
+            self._count_eviction('depth')
+        values.appendleft(entity)
+        # values are ordered newest first, so expired ones are at the end
+        while values and self._is_expired(values[-1]):
+            self._evict(values, self._expiry_reason(values[-1]))
+        self._enforce_budget()
+
+    def _expiry_reason(self, entity: EntityValue) -> Optional[str]:
+        if self.max_age is not None and self.counter - entity.counter > self.max_age:
+            return 'age'
+        if self.max_seconds is not None and time.time() - entity.timestamp > self.max_seconds:
+            return 'expired'
+        return None
+
+    def _is_expired(self, entity: EntityValue) -> bool:
+        return self._expiry_reason(entity) is not None
+
+    def _evict(self, values: deque, reason: str):
+        values.pop()
+        self._count_eviction(reason)
+
+    def _count_eviction(self, reason: str, count=1):
+        """Counts evicted values in the context and in process-wide metrics (context.evicted.<reason>)."""
+        self.evicted[reason] += count
+        metrics.counter('context.evicted.' + reason).inc(count)
+
+    def _enforce_budget(self):
+        """Evicts the oldest values across all entities until at most max_entities values remain."""
+        if self.max_entities is None:
+            return
+        total = sum(len(values) for values in self.entities.values())
+        while total > self.max_entities:
+            oldest = min(
+                (values for values in self.entities.values() if values),
+                key=lambda values: (values[-1].counter, values[-1].timestamp)
+            )
+            self._evict(oldest, 'budget')
+            total -= 1
+        self._remove_empty()
+
+    def _remove_empty(self):
+        for entity_name in [name for name, values in self.entities.items() if not values]:
+            del self.entities[entity_name]
+
+    def prune(self):
+        """Removes all values that exceed any of the retention limits."""
+        for entity_name, values in self.entities.items():
+            kept = deque(maxlen=self.max_depth)
+            for entity in values:
+                reason = self._expiry_reason(entity)
+                if reason:
+                    self._count_eviction(reason)
+                else:
+                    kept.append(entity)
+            self.entities[entity_name] = kept
+        self._enforce_budget()
+        self._remove_empty()
 
     def add_state(self, state_name):
         timestamp = int(time.time())
@@ -188,13 +320,11 @@ class Context(object):
             raise ValueError('Use a dict to set a context value, e.g. {"value":"foo"}. Call multiple times to add more.')
         value_dict['counter'] = self.counter
         entity_obj = EntityValue(entity_name, counter=self.counter, state_set=self.get_state_name(), raw=value_dict)
-        self.entities.setdefault(entity_name, []).insert(0, entity_obj)
-        self.entities[entity_name] = self.entities[entity_name][:self.max_depth - 1]
+        self._push(entity_name, entity_obj)
 
     def set_value(self, entity_name, value):
         entity_obj = EntityValue(entity_name, counter=self.counter, state_set=self.get_state_name(), value=value)
-        self.entities.setdefault(entity_name, []).insert(0, entity_obj)
-        self.entities[entity_name] = self.entities[entity_name][:self.max_depth - 1]
+        self._push(entity_name, entity_obj)
 
     def has_any(self, entities, max_age=None):  # TODO
         for entity in entities:
@@ -214,5 +344,5 @@ class Context(object):
     def __setitem__(self, key, value):
         if not isinstance(value, EntityValue):
             value = EntityValue(key, counter=self.counter, state_set=self.get_state_name(), value=value)
-        self.entities.setdefault(key, []).insert(0, value)
+        self._push(key, value)
         return self.__getitem__(key)  # mainly to shut up IDE warnings
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import operator
+from functools import reduce
+
+from django.db import transaction
+from django.db.models import Case, Q, Value, When
+
+from botshot.core.entity_value import EntityValue
+from botshot.core.persistence import json_serialize, json_deserialize
+from botshot.models import ContextEntityIndex
+
+# longer values are indexed by their hash
+MAX_VALUE_LENGTH = 255
+# rows written in one query
+BATCH_SIZE = 500
+
+
+def index_value(value):
+    """Returns the indexed representation of an entity value, equal values have equal keys."""
+    if value is None:
+        return None
+    key = json.dumps(json_serialize(value), sort_keys=True)
+    if len(key) > MAX_VALUE_LENGTH:
+        key = "sha1:" + hashlib.sha1(key.encode('utf8')).hexdigest()
+    return key
+
+
+def _latest_value(values):
+    if not values:
+        return None
+    value = values[0]
+    if not isinstance(value, EntityValue):
+        # contexts flushed from Redis are plain JSON
+        value = json.loads(json.dumps(value), object_hook=json_deserialize)
+    return value if isinstance(value, EntityValue) else None
+
+
+def get_context_counter(context_dict) -> int:
+    return int((context_dict or {}).get('counter', 0))
+
+
+def get_index_state(context_dict) -> dict:
+    """Returns entity name -> (value_key, is_truthy, counter, timestamp) of the latest value of each entity in a context dict."""
+    state = {}
+    for entity_name, values in ((context_dict or {}).get('entities') or {}).items():
+        entity = _latest_value(list(values or []))
+        if entity is None:
+            continue
+        state[entity_name[:128]] = (
+            index_value(entity.value), bool(entity.value), entity.counter, float(entity.timestamp)
+        )
+    return state
+
+
+def get_index_rows(conversation_id, context_dict) -> list:
+    """Returns index rows with the latest value of each entity in a context dict."""
+    return [_row(conversation_id, entity, values) for entity, values in get_index_state(context_dict).items()]
+
+
+def _row(conversation_id, entity, values):
+    value_key, is_truthy, counter, timestamp = values
+    return ContextEntityIndex(
+        conversation_id=conversation_id, entity=entity, value_key=value_key,
+        is_truthy=is_truthy, counter=counter, timestamp=timestamp,
+    )
+
+
+def update_context_index(contexts: dict, previous: dict = None):
+    """
+    Writes index rows of entities that changed, conversations whose entities didn't change cost no query.
+    New entities are inserted, changed ones updated in one UPDATE and removed ones deleted.
+
+    :param contexts: dict of conversation_id -> context_dict
+    :param previous: (optional) dict of conversation_id -> index state of the context when it was loaded,
+                     see get_index_state. Conversations missing in it are compared with their rows in the database.
+    """
+    if not contexts:
+        return
+    previous = dict(previous or {})
+    unknown = [conversation_id for conversation_id in contexts if conversation_id not in previous]
+    if unknown:
+        for conversation_id in unknown:
+            previous[conversation_id] = {}
+        rows = ContextEntityIndex.objects.filter(conversation_id__in=unknown).values_list(
+            'conversation_id', 'entity', 'value_key', 'is_truthy', 'counter', 'timestamp'
+        )
+        for conversation_id, entity, *values in rows:
+            previous[conversation_id][entity] = tuple(values)
+
+    created, updated, removed = [], [], []
+    for conversation_id, context_dict in contexts.items():
+        state, old = get_index_state(context_dict), previous[conversation_id]
+        for entity, values in state.items():
+            if entity not in old:
+                created.append(_row(conversation_id, entity, values))
+            elif old[entity] != values:
+                updated.append(_row(conversation_id, entity, values))
+        removed += [Q(conversation_id=conversation_id, entity=entity) for entity in old if entity not in state]
+    if not created and not updated and not removed:
+        return
+
+    # no savepoint when called in the transaction that saves the conversation
+    with transaction.atomic(savepoint=False):
+        for i in range(0, len(removed), BATCH_SIZE):
+            ContextEntityIndex.objects.filter(reduce(operator.or_, removed[i:i + BATCH_SIZE])).delete()
+        for i in range(0, len(updated), BATCH_SIZE):
+            _update_rows(updated[i:i + BATCH_SIZE])
+        ContextEntityIndex.objects.bulk_create(created, batch_size=BATCH_SIZE)
+
+
+def _update_rows(rows):
+    conditions = [Q(conversation_id=row.conversation_id, entity=row.entity) for row in rows]
+    values = {
+        field: Case(*[When(condition, then=Value(getattr(row, field))) for condition, row in zip(conditions, rows)],
+                    output_field=ContextEntityIndex._meta.get_field(field))
+        for field in ('value_key', 'is_truthy', 'counter', 'timestamp')
+    }
+    ContextEntityIndex.objects.filter(reduce(operator.or_, conditions)).update(**values)
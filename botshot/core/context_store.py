@@ -0,0 +1,351 @@
+import atexit
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.utils.module_loading import import_string
+
+from botshot.core import config
+from botshot.core.context import Context
+from botshot.core.context_index import get_context_counter, get_index_state, update_context_index
+from botshot.core.persistence import get_redis, json_serialize, json_deserialize
+from botshot.models import ChatConversation
+
+_context_store = None
+
+
+def get_context_store():
+    """Returns the context store of this process, configured by BOT_CONFIG.CONTEXT_STORE."""
+    global _context_store
+    if _context_store is None:
+        path = config.get("CONTEXT_STORE", "botshot.core.context_store.DatabaseContextStore")
+        _context_store = import_string(path)()
+    return _context_store
+
+
+class ContextStore(ABC):
+    """
+    Loads and saves conversation context between ChatManager and the database.
+
+    Conversations are still locked with select_for_update while a message is being processed,
+    which guarantees that messages of one conversation are processed in order.
+    """
+
+    @abstractmethod
+    def load(self, conversation: ChatConversation) -> Context:
+        """Returns the newest context of a conversation."""
+        pass
+
+    @abstractmethod
+    def save(self, conversation: ChatConversation):
+        """Saves the conversation along with its context_dict."""
+        pass
+
+    def flush(self):
+        """Writes all pending contexts to the database."""
+        pass
+
+
+class DatabaseContextStore(ContextStore):
+    """Default store, reads and writes the context directly from ChatConversation."""
+
+    def load(self, conversation):
+        # the index is written along with the context, only entities that change are written again
+        conversation._index_state = get_index_state(conversation.context_dict)
+        return Context.load(data=conversation.context_dict or {})
+
+    def save(self, conversation):
+        conversation.context_counter = get_context_counter(conversation.context_dict)
+        conversation.save()
+        previous = getattr(conversation, '_index_state', None)
+        update_context_index(
+            {conversation.conversation_id: conversation.context_dict},
+            previous={conversation.conversation_id: previous} if previous is not None else None
+        )
+        conversation._index_state = get_index_state(conversation.context_dict)
+
+
+class CachedContextStore(ContextStore):
+    """
+    Base class for stores that keep contexts of hot conversations in a cache
+    and write them to ChatConversation in batches (write-behind).
+
+    Each saved context gets a version stamp. ChatConversation.context_version is the last version
+    written to the database, the cached context is only used if it isn't older than that.
+    """
+
+    def __init__(self):
+        self.flush_size = config.get("CONTEXT_STORE_FLUSH_SIZE", 100)
+        self.flush_seconds = config.get("CONTEXT_STORE_FLUSH_SECONDS", 5)
+        self.last_flush = time.time()
+        atexit.register(self._flush_on_exit)
+
+    def _flush_on_exit(self):
+        try:
+            self.flush()
+        except Exception:
+            logging.exception("Error flushing contexts on exit")
+
+    @abstractmethod
+    def _get(self, conversation_id):
+        """Returns a tuple (version, context_dict) from cache, or None."""
+        pass
+
+    @abstractmethod
+    def _get_version(self, conversation_id):
+        """Returns version of the cached context, or None."""
+        pass
+
+    @abstractmethod
+    def _put(self, conversation_id, version, context_dict):
+        """Puts a context to cache and marks it as not yet written to the database."""
+        pass
+
+    @abstractmethod
+    def _pending(self) -> list:
+        """Returns a list of (conversation_id, version, context_dict) not yet written to the database."""
+        pass
+
+    @abstractmethod
+    def _mark_written(self, conversation_id, version):
+        """Marks a context as written, unless it was saved again in the meantime."""
+        pass
+
+    @abstractmethod
+    def _pending_count(self) -> int:
+        pass
+
+    def load(self, conversation):
+        cached = None
+        if conversation.conversation_id is not None:
+            try:
+                cached = self._get(conversation.conversation_id)
+            except Exception:
+                logging.exception("Error reading context from cache, falling back to database")
+        if cached is not None and cached[0] >= conversation.context_version:
+            version, context_dict = cached
+            conversation.context_dict = context_dict
+            conversation._context_version = version
+        else:
+            conversation._context_version = conversation.context_version
+        return Context.load(data=conversation.context_dict or {})
+
+    def _save_directly(self, conversation):
+        conversation.context_counter = get_context_counter(conversation.context_dict)
+        conversation.save()
+        update_context_index({conversation.conversation_id: conversation.context_dict})
+
+    def save(self, conversation):
+        if conversation.conversation_id is None:
+            return self._save_directly(conversation)
+        try:
+            cached_version = self._get_version(conversation.conversation_id)
+            base_version = getattr(conversation, '_context_version', None)
+            if base_version is None:
+                base_version = conversation.context_version
+                if cached_version is not None and cached_version > base_version:
+                    # context_dict was read from the database and is older than the cached one, keep the cached one
+                    base_version = None
+            if base_version is not None:
+                version = max(cached_version or 0, base_version) + 1
+                self._put(conversation.conversation_id, version, conversation.context_dict)
+                conversation._context_version = version
+        except Exception:
+            logging.exception("Error writing context to cache, falling back to database")
+            return self._save_directly(conversation)
+        # everything but the context is written right away
+        update_fields = [
+            field.name for field in ChatConversation._meta.concrete_fields
+            if field.name not in ('conversation_id', 'context_dict', 'context_version', 'context_counter')
+        ]
+        conversation.save(update_fields=update_fields)
+        if self._pending_count() >= self.flush_size or time.time() - self.last_flush >= self.flush_seconds:
+            # flush after the caller's transaction commits, never while it holds the conversation lock
+            transaction.on_commit(self.flush)
+
+    def flush(self):
+        """
+        Writes pending contexts to the database in a single UPDATE.
+        Conversations that are locked by a worker right now are skipped, they are written by the next flush.
+        """
+        self.last_flush = time.time()
+        pending = self._pending()
+        if not pending:
+            return
+        versions = {conversation_id: version for conversation_id, version, _ in pending}
+        with transaction.atomic():
+            # databases without row locks (sqlite) ignore select_for_update
+            claimed = dict(
+                ChatConversation.objects.select_for_update(skip_locked=True)
+                .filter(conversation_id__in=versions.keys())
+                .values_list('conversation_id', 'context_version')
+            )
+            # never overwrite a newer version written by another worker
+            written = {
+                conversation_id: context_dict for conversation_id, version, context_dict in pending
+                if conversation_id in claimed and claimed[conversation_id] < version
+            }
+            if written:
+                context_field = ChatConversation._meta.get_field('context_dict')
+                context_whens, version_whens, counter_whens = [], [], []
+                for conversation_id, context_dict in written.items():
+                    condition = dict(conversation_id=conversation_id)
+                    context_whens.append(When(then=Value(context_dict, output_field=context_field), **condition))
+                    version_whens.append(When(then=Value(versions[conversation_id]), **condition))
+                    counter_whens.append(When(then=Value(get_context_counter(context_dict)), **condition))
+                ChatConversation.objects.filter(conversation_id__in=written.keys()).update(
+                    context_dict=Case(*context_whens, default=F('context_dict'), output_field=context_field),
+                    context_version=Case(*version_whens, default=F('context_version')),
+                    context_counter=Case(*counter_whens, default=F('context_counter')),
+                )
+                update_context_index(written)
+        for conversation_id in claimed:
+            self._mark_written(conversation_id, versions[conversation_id])
+        logging.debug("Flushed %d of %d pending contexts to database", len(claimed), len(pending))
+
+
+class LocalContextStore(CachedContextStore):
+    """
+    Keeps contexts in an in-process LRU cache.
+    Only use this store when messages of a conversation are always processed by the same worker process,
+    contexts that were not flushed yet are lost if the process crashes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.max_size = config.get("CONTEXT_STORE_SIZE", 10000)
+        self.cache = OrderedDict()  # conversation_id -> (version, context_dict)
+        # contexts not yet written to the database, they are never evicted from the cache
+        self.dirty = {}  # conversation_id -> (version, context_dict)
+        self.lock = threading.RLock()
+
+    def _get(self, conversation_id):
+        with self.lock:
+            cached = self.cache.get(conversation_id)
+            if cached is None:
+                return None
+            self.cache.move_to_end(conversation_id)
+            version, context_dict = cached
+            # copy containers, the processor modifies them in place
+            return version, dict(context_dict, history=list(context_dict.get('history', [])))
+
+    def _get_version(self, conversation_id):
+        with self.lock:
+            cached = self.cache.get(conversation_id)
+            return cached[0] if cached else None
+
+    def _put(self, conversation_id, version, context_dict):
+        with self.lock:
+            self.cache[conversation_id] = (version, context_dict)
+            self.cache.move_to_end(conversation_id)
+            self.dirty[conversation_id] = (version, context_dict)
+            self._trim()
+            is_full = len(self.cache) > self.max_size
+        if is_full:
+            # the rest is evicted once the pending contexts are written, after the caller's transaction commits
+            transaction.on_commit(self.flush)
+
+    def _trim(self):
+        """Evicts least recently used contexts that were already written to the database."""
+        excess = len(self.cache) - self.max_size
+        if excess <= 0:
+            return
+        evicted = list(islice((id for id in self.cache if id not in self.dirty), excess))
+        for id in evicted:
+            del self.cache[id]
+
+    def flush(self):
+        super().flush()
+        with self.lock:
+            self._trim()
+
+    def _pending(self):
+        with self.lock:
+            return [(id, version, context_dict) for id, (version, context_dict) in self.dirty.items()]
+
+    def _mark_written(self, conversation_id, version):
+        with self.lock:
+            if conversation_id in self.dirty and self.dirty[conversation_id][0] == version:
+                del self.dirty[conversation_id]
+
+    def _pending_count(self):
+        return len(self.dirty)
+
+
+class RedisContextStore(CachedContextStore):
+    """
+    Keeps contexts in Redis, shared by all workers.
+    Pending contexts survive a worker crash and are flushed by the next worker that flushes.
+    If Redis is not available, contexts are written directly to the database.
+    """
+
+    KEY_PREFIX = "botshot_context_"
+    DIRTY_KEY = "botshot_context_dirty"
+
+    # remove the dirty flag only if the context wasn't saved again during flush
+    MARK_WRITTEN_SCRIPT = """
+        if redis.call('hget', KEYS[1], ARGV[1]) == ARGV[2] then
+            return redis.call('hdel', KEYS[1], ARGV[1])
+        end
+        return 0
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.ttl = config.get("CONTEXT_STORE_TTL", 3600 * 24)
+        self.redis = get_redis()
+        if self.redis is None:
+            raise ValueError("RedisContextStore requires REDIS_URL to be set.")
+        self.mark_written_script = self.redis.register_script(self.MARK_WRITTEN_SCRIPT)
+
+    def _key(self, conversation_id):
+        return self.KEY_PREFIX + str(conversation_id)
+
+    def _get(self, conversation_id):
+        version, data = self.redis.hmget(self._key(conversation_id), 'version', 'data')
+        if version is None or data is None:
+            return None
+        return int(version), json.loads(data.decode('utf8'), object_hook=json_deserialize)
+
+    def _get_version(self, conversation_id):
+        version = self.redis.hget(self._key(conversation_id), 'version')
+        return int(version) if version is not None else None
+
+    def _put(self, conversation_id, version, context_dict):
+        key = self._key(conversation_id)
+        pipe = self.redis.pipeline()
+        pipe.hset(key, 'version', version)
+        pipe.hset(key, 'data', json.dumps(context_dict, default=json_serialize))
+        # pending contexts never expire
+        pipe.persist(key)
+        pipe.hset(self.DIRTY_KEY, conversation_id, version)
+        pipe.execute()
+
+    def _pending(self):
+        dirty = self.redis.hscan_iter(self.DIRTY_KEY, count=self.flush_size)
+        ids = [id for id, _ in islice(dirty, self.flush_size)]
+        if not ids:
+            return []
+        pipe = self.redis.pipeline()
+        for id in ids:
+            pipe.hmget(self._key(id.decode('utf8')), 'version', 'data')
+        pending = []
+        for id, (version, data) in zip(ids, pipe.execute()):
+            if version is None or data is None:
+                continue
+            # the context is already serialized, decode it only to plain JSON
+            pending.append((int(id), int(version), json.loads(data.decode('utf8'))))
+        return pending
+
+    def _mark_written(self, conversation_id, version):
+        self.mark_written_script(keys=[self.DIRTY_KEY], args=[conversation_id, version])
+        self.redis.expire(self._key(conversation_id), self.ttl)
+
+    def _pending_count(self):
+        return self.redis.hlen(self.DIRTY_KEY)
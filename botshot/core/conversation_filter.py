@@ -1,7 +1,30 @@
+import time
 from abc import ABC, abstractmethod
+from itertools import chain
+
+from django.db.models import F
+
+from botshot.core import config
 from botshot.core.persistence import DictSerializable
 from botshot.core.context import Context
-from botshot.models import ChatConversation
+from botshot.core.context_index import index_value
+from botshot.core.context_store import get_context_store
+from botshot.models import ChatConversation, ContextEntityIndex
+
+
+def iter_keyset(queryset, field, chunk_size):
+    """
+    Yields lists of values of an indexed field, in chunks ordered by the field.
+    Uses keyset pagination, so each chunk is a cheap indexed query no matter how deep into the table it is.
+    """
+    last = None
+    while True:
+        chunk_qs = queryset if last is None else queryset.filter(**{field + '__gt': last})
+        chunk = list(chunk_qs.order_by(field).values_list(field, flat=True)[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1]
 
 
 class ConversationFilter(DictSerializable, ABC):
@@ -14,6 +37,12 @@ class ConversationFilter(DictSerializable, ABC):
         """Returns the IDs of all conversations matching this filter."""
         pass
 
+    def iter_id_chunks(self, chunk_size=1000):
+        """Yields IDs of matching conversations in lists of at most chunk_size. Override to stream large sets."""
+        ids = self.get_ids()
+        for start in range(0, len(ids), chunk_size):
+            yield ids[start:start + chunk_size]
+
 
 class ListConversationFilter(ConversationFilter):
 
@@ -28,19 +57,27 @@ class ListConversationFilter(ConversationFilter):
 class AllConversationFilter(ConversationFilter):
 
     def get_ids(self):
-        return [c.id for c in ChatConversation.objects.all()]
+        return list(chain.from_iterable(self.iter_id_chunks()))
+
+    def iter_id_chunks(self, chunk_size=1000):
+        return iter_keyset(ChatConversation.objects.all(), 'conversation_id', chunk_size)
 
 
 class ContextConversationFilter(ConversationFilter):
+    """Base class of filters by context, evaluated in Python on every conversation."""
 
     def get_ids(self):
-        matching = []
-        for conversation in ChatConversation.objects.all():
-            context = Context.load(data=conversation.context_dict)
-            if self._filter_context(context):
-                matching.append(conversation.id)
-        return matching
-    
+        return list(chain.from_iterable(self.iter_id_chunks()))
+
+    def iter_id_chunks(self, chunk_size=1000):
+        # contexts are read from the database, write the cached ones first
+        get_context_store().flush()
+        for ids in iter_keyset(ChatConversation.objects.all(), 'conversation_id', chunk_size):
+            rows = ChatConversation.objects.filter(conversation_id__in=ids).values_list('conversation_id', 'context_dict')
+            matching = [id for id, context_dict in rows if self._filter_context(Context.load(data=context_dict or {}))]
+            if matching:
+                yield sorted(matching)
+
     @abstractmethod
     def _filter_context(self, context) -> bool:
         """
@@ -51,13 +88,38 @@ class ContextConversationFilter(ConversationFilter):
 
 
 class EntityValueConversationFilter(ContextConversationFilter):
-    
+    """
+    Matches conversations by the latest value of an entity.
+    Evaluated in the database using ContextEntityIndex.
+    """
+
     def __init__(self, entity, value=None, max_age=None):
         super().__init__()
         self.entity = entity
         self.value = value
         self.max_age = max_age
 
+    def iter_id_chunks(self, chunk_size=1000):
+        # the index is updated when contexts are written, write the cached ones first
+        get_context_store().flush()
+        return iter_keyset(self.get_queryset(), 'conversation_id', chunk_size)
+
+    def get_queryset(self):
+        """Returns a queryset of ContextEntityIndex rows matching the filter."""
+        queryset = ContextEntityIndex.objects.filter(entity=self.entity)
+        # No specific value requested, accept any value
+        if self.value is None:
+            queryset = queryset.filter(is_truthy=True)
+        else:
+            queryset = queryset.filter(value_key=index_value(self.value))
+        if self.max_age is not None:
+            queryset = queryset.filter(conversation__context_counter__lte=F('counter') + self.max_age)
+        max_seconds = config.get("CONTEXT_MAX_SECONDS")
+        if max_seconds is not None:
+            # the value would be dropped when the context is loaded
+            queryset = queryset.filter(timestamp__gte=time.time() - max_seconds)
+        return queryset
+
     def _filter_context(self, context):
         val = context.get_value(self.entity, max_age=self.max_age)
         # No specific value requested, accept any value
@@ -7,7 +7,7 @@ from datetime import timedelta
 from botshot.core.logging.logging_service import AsyncLoggingService
 from botshot.core.responses.responses import TextMessage
 from botshot.models import ChatMessage, ChatConversation, ChatUser
-from botshot.tasks import run_async
+from botshot.core.dispatch import dispatch
 
 
 class Dialog:
@@ -36,8 +36,10 @@ class Dialog:
             raise ValueError('Specify a positive "seconds" parameter')
         time_formatted = "in {} seconds".format(seconds)
         logging.info('Setting inactivity callback %s with payload "%s"', time_formatted, payload)
-        task_id = run_async(
+        task_id = dispatch(
             self.chat_manager.accept_inactive,
+            interface_name=self.conversation.interface_name,
+            raw_conversation_id=self.conversation.raw_conversation_id,
             _at=None,
             _seconds=seconds,
             conversation_id=self.conversation.id,
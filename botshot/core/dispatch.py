@@ -0,0 +1,92 @@
+import logging
+import zlib
+
+from botshot.core import config
+from botshot.core.persistence import get_redis
+from botshot.tasks import run_async, sharded_method_call_wrapper
+
+DEPTH_KEY = "botshot_dispatch_depth"
+
+
+def get_shard_count() -> int:
+    """Returns the number of dispatch shards, 0 if partitioned dispatch is disabled."""
+    return config.get("DISPATCH_SHARDS") or 0
+
+
+def get_shard(interface_name, raw_conversation_id, shards=None) -> int:
+    """Returns the shard of a conversation. The shard never changes as long as the number of shards is the same."""
+    shards = shards or get_shard_count()
+    key = "{}:{}".format(interface_name, raw_conversation_id).encode('utf8')
+    return zlib.crc32(key) % shards
+
+
+def get_shard_queue(shard) -> str:
+    """Returns name of the Celery queue of a shard."""
+    return "{}{}".format(config.get("DISPATCH_QUEUE_PREFIX", "botshot_shard_"), shard)
+
+
+def dispatch(method, interface_name, raw_conversation_id, _at=None, _seconds=None, **kwargs):
+    """
+    Runs a method that processes a message of a conversation asynchronously.
+
+    If DISPATCH_SHARDS is set, the task is sent to the queue of the conversation's shard.
+    Each shard queue should be consumed by a single worker process, so that messages of one
+    conversation are processed in order and never wait for each other's database locks.
+    Otherwise the task is sent to the default queue.
+    """
+    shards = get_shard_count()
+    if not shards:
+        return run_async(method, _at=_at, _seconds=_seconds, **kwargs)
+    shard = get_shard(interface_name, raw_conversation_id, shards)
+    options = {}
+    if _at is not None:
+        options['eta'] = _at
+    elif _seconds is not None:
+        options['countdown'] = _seconds
+    # delayed tasks don't count to the queue depth, they aren't waiting for a worker yet
+    counted = not options
+    if counted:
+        _change_depth(shard, 1)
+    try:
+        return sharded_method_call_wrapper.apply_async(
+            args=(method, shard, counted), kwargs=kwargs, queue=get_shard_queue(shard), **options
+        )
+    except Exception:
+        if counted:
+            _change_depth(shard, -1)
+        raise
+
+
+def dispatch_message(method, raw_message):
+    """Dispatches processing of a received RawMessage, see dispatch()."""
+    return dispatch(
+        method,
+        interface_name=raw_message.interface.name,
+        raw_conversation_id=raw_message.raw_conversation_id,
+        raw_message=raw_message
+    )
+
+
+def on_task_started(shard):
+    """Called by the worker when it starts processing a task of a shard."""
+    _change_depth(shard, -1)
+
+
+def get_queue_depths() -> dict:
+    """Returns the number of dispatched tasks waiting in each shard queue."""
+    redis = get_redis()
+    if redis is None:
+        return {}
+    depths = {shard: 0 for shard in range(get_shard_count())}
+    for shard, depth in redis.hgetall(DEPTH_KEY).items():
+        depths[int(shard)] = max(int(depth), 0)
+    return depths
+
+
+def _change_depth(shard, amount):
+    try:
+        redis = get_redis()
+        if redis is not None:
+            redis.hincrby(DEPTH_KEY, shard, amount)
+    except Exception:
+        logging.exception("Unable to update queue depth of shard %s", shard)
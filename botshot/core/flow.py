@@ -1,6 +1,11 @@
 from typing import Optional
+import hashlib
 import importlib
+import importlib.util
+import json
 import re
+import threading
+import time
 from abc import abstractmethod, ABC
 from django.conf import settings
 
@@ -12,43 +17,375 @@ from inspect import getsource
 from django.utils.module_loading import import_string
 
 _FLOWS = None
+_ROUTER = None
+_ROUTES_VERSION = 0
+# filename -> _FlowFile, flows of each file in BOTS
+_FILES = {}
+_last_reload_check = 0
+_reload_lock = threading.Lock()
+
+
+class _FlowFile:
+    def __init__(self, mtime, digest, flows: dict):
+        self.mtime = mtime
+        self.digest = digest
+        self.flows = flows
+
 
 def get_flows(cache=True):
-    """Creates flows from their YAML definitions."""
+    """
+    Creates flows from their YAML definitions.
+    Parsed definitions are cached on disk by their content, see FLOW_CACHE_DIR.
+    With FLOW_HOT_RELOAD, files are checked for changes and only the changed ones are loaded again.
+    """
     global _FLOWS
     if not cache or _FLOWS is None:
-        import yaml
-        flows = {}  # a dict with all the flows loaded from YAML
-        BOTS = config.get('BOTS', [])
-        for filename in BOTS:
-            try:
-                with open(os.path.join(settings.BASE_DIR, filename)) as f:
-                    definitions = yaml.load(f)
-                    if not definitions:
-                        logging.warning("Skipping empty flow definition {}".format(filename))
-                        break
-                    for flow_name in definitions:
-                        if flow_name in flows:
-                            raise Exception("Error: duplicate flow {}".format(flow_name))
-                        definition = definitions[flow_name]
-                        flow = Flow.load(flow_name, definition, relpath=os.path.dirname(filename))
-                        flows[flow_name] = flow
-            except OSError as e:
-                raise ValueError("Unable to open definition {}".format(filename)) from e
-            except TypeError as e:
-                raise ValueError("Unable to read definition {}".format(filename)) from e
-
-        if not flows.get('default') or not flows.get('default').get_state('root'):
-            raise Exception("Required state default.root was not found. "
-                            "Please add this state, Botshot uses it as the first state when starting a conversation.")
-
-        print('Initialized {} flows: {}'.format(len(flows), sorted(list(flows.keys()))))
-
-        _FLOWS = flows
+        if not cache:
+            _FILES.clear()
+        _FLOWS = _load_flows(_FILES)
+    elif config.get('FLOW_HOT_RELOAD', False):
+        _reload_changed()
     return _FLOWS
 
 
+def _load_flows(files: dict):
+    """Creates flows of BOTS, files that are not in files (a dict of filename -> _FlowFile) are loaded into it."""
+    flows = {}  # a dict with all the flows loaded from YAML
+    for filename in config.get('BOTS', []):
+        if filename not in files:
+            files[filename] = _load_file(filename)
+        for flow_name, flow in files[filename].flows.items():
+            if flow_name in flows:
+                raise Exception("Error: duplicate flow {}".format(flow_name))
+            flows[flow_name] = flow
+
+    if not flows.get('default') or not flows.get('default').get_state('root'):
+        raise Exception("Required state default.root was not found. "
+                        "Please add this state, Botshot uses it as the first state when starting a conversation.")
+
+    print('Initialized {} flows: {}'.format(len(flows), sorted(list(flows.keys()))))
+
+    invalidate_router()
+    get_router(flows)
+    return flows
+
+
+def _load_file(filename, content=None) -> _FlowFile:
+    path = os.path.join(settings.BASE_DIR, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+        if content is None:
+            with open(path, 'rb') as f:
+                content = f.read()
+    except OSError as e:
+        raise ValueError("Unable to open definition {}".format(filename)) from e
+    digest = hashlib.sha1(content).hexdigest()
+    flows = {}
+    try:
+        definitions = load_definitions(content, digest)
+        if not definitions:
+            logging.warning("Skipping empty flow definition {}".format(filename))
+        else:
+            for flow_name, definition in definitions.items():
+                flows[flow_name] = Flow.load(flow_name, definition, relpath=os.path.dirname(filename))
+    except (TypeError, AttributeError) as e:
+        raise ValueError("Unable to read definition {}".format(filename)) from e
+    return _FlowFile(mtime, digest, flows)
+
+
+def load_definitions(content: bytes, digest=None):
+    """
+    Parses YAML flow definitions.
+    The result is cached in FLOW_CACHE_DIR by a hash of the content, loading it is much faster than parsing YAML.
+    """
+    import yaml
+    cache_dir = _get_cache_dir()
+    if not cache_dir:
+        return yaml.load(content, Loader=_yaml_loader())
+    digest = digest or hashlib.sha1(content).hexdigest()
+    cache_path = os.path.join(cache_dir, "{}-{}.json".format(digest, yaml.__version__))
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    definitions = yaml.load(content, Loader=_yaml_loader())
+    try:
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(definitions, f)
+        os.replace(tmp_path, cache_path)
+    except (OSError, TypeError, ValueError):
+        # for example YAML dates, which can't be saved as JSON
+        logging.debug("Unable to cache flow definition %s", cache_path, exc_info=True)
+    return definitions
+
+
+def _get_cache_dir() -> Optional[str]:
+    """
+    Returns the directory of cached flow definitions, or None if they shouldn't be cached.
+    Cached definitions contain import paths of actions, so the directory must not be writable by other users.
+    """
+    base_dir = getattr(settings, 'BASE_DIR', None)
+    cache_dir = config.get('FLOW_CACHE_DIR', os.path.join(base_dir, '.botshot_flow_cache') if base_dir else None)
+    if not cache_dir:
+        return None
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        stat = os.stat(cache_dir)
+    except OSError:
+        logging.debug("Unable to create flow cache directory %s", cache_dir, exc_info=True)
+        return None
+    if hasattr(os, 'getuid') and (stat.st_uid != os.getuid() or stat.st_mode & 0o022):
+        logging.warning("Not caching flow definitions in %s, it's owned or writable by another user", cache_dir)
+        return None
+    return cache_dir
+
+
+def _yaml_loader():
+    import yaml
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def _reload_changed():
+    """Loads flow files changed since they were loaded, at most once in FLOW_RELOAD_SECONDS."""
+    global _FLOWS, _last_reload_check
+    now = time.time()
+    if now - _last_reload_check < config.get('FLOW_RELOAD_SECONDS', 1.0):
+        return
+    with _reload_lock:
+        if now - _last_reload_check < config.get('FLOW_RELOAD_SECONDS', 1.0):
+            return
+        _last_reload_check = now
+        changed = []
+        files = dict(_FILES)
+        try:
+            bots = config.get('BOTS', [])
+            for filename in set(files) - set(bots):
+                del files[filename]
+                changed.append(filename)
+            for filename in bots:
+                loaded = files.get(filename)
+                path = os.path.join(settings.BASE_DIR, filename)
+                if loaded is not None and os.stat(path).st_mtime == loaded.mtime:
+                    continue
+                with open(path, 'rb') as f:
+                    content = f.read()
+                if loaded is not None and hashlib.sha1(content).hexdigest() == loaded.digest:
+                    loaded.mtime = os.stat(path).st_mtime
+                    continue
+                files[filename] = _load_file(filename, content)
+                changed.append(filename)
+            if changed:
+                logging.info("Reloading changed flow definitions %s", changed)
+                _FLOWS = _load_flows(files)
+                _FILES.clear()
+                _FILES.update(files)
+        except Exception:
+            logging.exception("Unable to reload flows, keeping the previous ones")
+
+
+def invalidate_router():
+    """Marks the routing index as outdated. Called whenever intents or accepted entities of flows change."""
+    global _ROUTES_VERSION
+    _ROUTES_VERSION += 1
+
+
+def get_router(flows=None):
+    """
+    Returns the routing index of flows.
+    The index is rebuilt if flows or their states changed since it was built.
+    """
+    global _ROUTER
+    if flows is None:
+        flows = get_flows()
+    if _ROUTER is None or not _ROUTER.is_current(flows):
+        _ROUTER = FlowRouter(flows)
+    return _ROUTER
+
+
+class IntentMatcher:
+    """
+    Finds the first of an ordered list of regexes that matches an intent, same as calling re.match on each.
+    The regexes are combined to a single alternation and results are memoized per intent.
+    """
+
+    MAX_CACHE_SIZE = 10000
+
+    def __init__(self, items: list):
+        """
+        :param items: list of tuples (regex, result), in order of priority
+        """
+        self.results = {}  # group index -> result
+        self.combined = self._combine(items)
+        # regexes are only matched one by one if they can't be combined
+        self.items = [(re.compile(regex), result) for regex, result in items] if self.combined is None else None
+        self.cache = {}
+        self._precompute_literals(items)
+
+    def _precompute_literals(self, items):
+        """
+        Precomputes results of literal intents, which are the most common.
+        A literal regex matches intents it's a prefix of, so only regexes that aren't literal are matched.
+        """
+        first_index = {}  # literal -> index of its first item
+        patterns = []  # (index, compiled regex) of items that aren't literal
+        literals = []
+        for i, (regex, _) in enumerate(items):
+            if re.escape(regex) == regex:
+                first_index.setdefault(regex, i)
+                literals.append(regex)
+            else:
+                patterns.append((i, re.compile(regex)))
+        for intent in literals[:self.MAX_CACHE_SIZE]:
+            best = min((first_index[intent[:k]] for k in range(len(intent) + 1) if intent[:k] in first_index))
+            for i, pattern in patterns:
+                if i > best:
+                    break
+                if pattern.match(intent):
+                    best = i
+                    break
+            self.cache[intent] = items[best][1]
+
+    def _combine(self, items):
+        if not items:
+            return None
+        parts = []
+        group = 1
+        for regex, result in items:
+            if re.search(r'\\[1-9]|\(\?P=|\(\?\(', regex):
+                # backreferences and conditional groups would point to wrong groups after combining
+                return None
+            self.results[group] = result
+            parts.append('(' + regex + ')')
+            # literal intents are the most common, they have no groups
+            group += (0 if re.escape(regex) == regex else re.compile(regex).groups) + 1
+        try:
+            return re.compile('|'.join(parts))
+        except re.error:
+            # for example duplicate group names
+            return None
+
+    def match(self, intent: str):
+        """Returns result of the first regex that matches the intent, or None."""
+        if intent in self.cache:
+            return self.cache[intent]
+        if self.combined is not None:
+            m = self.combined.match(intent)
+            result = self.results[m.lastindex] if m else None
+        else:
+            result = next((result for regex, result in self.items if regex.match(intent)), None)
+        if len(self.cache) >= self.MAX_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[intent] = result
+        return result
+
+
+class FlowRouter:
+    """
+    Routing index of flows used to find transitions by intent and by entity.
+    """
+
+    def __init__(self, flows: dict):
+        self.flows_id = id(flows)
+        self.version = _ROUTES_VERSION
+        self.flows = dict(flows)
+        self.flow_matcher = IntentMatcher([(flow.intent, flow) for flow in flows.values()])
+        self.state_matchers = {}  # built on first use, large bots have many flows
+        self.order = {}
+        self.entity_index = {}  # entity name -> list of flows that accept it
+        for i, (name, flow) in enumerate(flows.items()):
+            self.order[name] = i
+            for entity_name in flow.accepted:
+                self.entity_index.setdefault(entity_name, []).append(flow)
+
+    def is_current(self, flows: dict) -> bool:
+        return self.flows_id == id(flows) and self.version == _ROUTES_VERSION
+
+    def get_state_for_intent(self, flow_name, intent) -> Optional[str]:
+        """Returns full name of the first state of a flow that receives an intent."""
+        matcher = self.state_matchers.get(flow_name)
+        if matcher is None:
+            flow = self.flows.get(flow_name)
+            if flow is None:
+                return None
+            matcher = IntentMatcher([
+                (state.intent, flow.name + "." + state_name)
+                for state_name, state in flow.states.items() if state.intent
+            ])
+            self.state_matchers[flow_name] = matcher
+        return matcher.match(intent)
+
+    def get_flow_for_intent(self, intent):
+        """Returns the first flow that accepts an intent."""
+        return self.flow_matcher.match(intent)
+
+    def get_flow_for_entities(self, entity_names):
+        """Returns the first flow that accepts any of the entities."""
+        best = None
+        for entity_name in entity_names:
+            flows = self.entity_index.get(entity_name)
+            if flows and (best is None or self.order[flows[0].name] < self.order[best.name]):
+                best = flows[0]
+        return best
+
+
+def import_action(path: str, relpath: Optional[str] = None):
+    """Imports an action by its absolute path, or relative to the flow module."""
+    try:
+        # try to import as absolute path
+        return import_string(path)
+    except ImportError:
+        if not relpath:
+            raise
+        # try to import relative to flow module
+        return import_string(relpath + "." + path)
+
+
+def find_action_module(path: str, relpath: Optional[str] = None) -> str:
+    """
+    Returns the name of the module of an action without importing it, only its parent packages are imported.
+    :raises ImportError: if the module doesn't exist
+    """
+    module_name = path.rpartition(".")[0]
+    candidates = [module_name] + ([relpath + "." + module_name] if relpath and module_name else [])
+    for name in candidates:
+        try:
+            if importlib.util.find_spec(name) is not None:
+                return name
+        except (ImportError, ValueError):
+            pass
+    raise ImportError("Module of action {} not found".format(path))
+
+
+class LazyAction:
+    """An action given by its import path, it's imported when it's first used."""
+
+    def __init__(self, path: str, relpath: Optional[str] = None):
+        self.path = path
+        self.relpath = relpath
+        self._fn = None
+        # a misspelled path is still reported when flows are loaded
+        find_action_module(path, relpath)
+
+    def resolve(self):
+        if self._fn is None:
+            self._fn = import_action(self.path, self.relpath)
+        return self._fn
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        return "LazyAction({})".format(self.path)
+
+
 class State:
+    def __setattr__(self, key, value):
+        if key == 'intent':
+            invalidate_router()
+        super().__setattr__(key, value)
+
     def __init__(self, name: str, action, intent=None, requires=None, is_temporary=False, supported=None,
                  unsupported=None):
         """
@@ -142,13 +479,9 @@ class State:
             # action already given as object, everything ok
             return action
         elif isinstance(action, str):
-            # dynamically load the function
-            try:
-                # try to import as absolute path
-                return import_string(action)
-            except ImportError:
-                # try to import relative to flow module
-                return import_string(relpath + "." + action)
+            if config.get('FLOW_LAZY_ACTIONS', True):
+                return LazyAction(action, relpath)
+            return import_action(action, relpath)
         elif isinstance(action, dict):
             # load a static action, such as text or image
             return State.make_default_action(action)
@@ -234,7 +567,8 @@ class State:
         return True
 
     def get_action_code(self):
-        return getsource(self.action) if callable(self.action) else None
+        action = self.action.resolve() if isinstance(self.action, LazyAction) else self.action
+        return getsource(action) if callable(action) else None
 
     def is_supported(self, msg_entities: set) -> bool:
         """Checks whether this state can handle a message with given entities."""
@@ -245,6 +579,13 @@ class State:
 
 
 class Flow:
+    _ROUTED_FIELDS = ('states', 'intent', 'accepted')
+
+    def __setattr__(self, key, value):
+        if key in Flow._ROUTED_FIELDS:
+            invalidate_router()
+        super().__setattr__(key, value)
+
     def __init__(self, name: str, states=None, intent=None, unsupported=None):
         """
         Construct a new flow instance.
@@ -284,6 +625,7 @@ class Flow:
         """Adds a state to this flow."""
         if isinstance(state, State):
             self.states[state.name] = state
+            invalidate_router()
             return self
         raise ValueError("Argument must be an instance of State")
 
@@ -301,6 +643,7 @@ class Flow:
     def set_accepts(self, entity_name):
         """Add accepted entity."""
         self.accepted.add(entity_name)
+        invalidate_router()
         return self
 
     def accepts_message(self, entities: list) -> bool:
@@ -0,0 +1,86 @@
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from botshot.core import config, metrics
+
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+
+def _create_session():
+    retry = Retry(
+        total=config.get("HTTP_MAX_RETRIES", 3),
+        read=0,  # the request could have been processed, don't send messages twice
+        backoff_factor=config.get("HTTP_BACKOFF_FACTOR", 0.3),
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,  # only idempotent methods are retried on error status
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=config.get("HTTP_POOL_CONNECTIONS", 10),
+        pool_maxsize=config.get("HTTP_POOL_MAXSIZE", 20),
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the shared HTTP session of this process.
+    The session keeps a pool of keep-alive connections for each host.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                # connections can't be shared with a forked parent process
+                _session = _create_session()
+                _session_pid = pid
+    return _session
+
+
+def request(method, url, endpoint=None, **kwargs) -> requests.Response:
+    """
+    Sends a request using the shared session and records its latency.
+
+    :param endpoint: name of the endpoint in metrics, for example "facebook.send". Defaults to the host name.
+                     Don't use the URL, it can contain access tokens.
+    """
+    kwargs.setdefault("timeout", config.get("HTTP_TIMEOUT", 30))
+    endpoint = endpoint or urlparse(url).hostname
+    start = time.time()
+    try:
+        response = get_session().request(method, url, **kwargs)
+    except requests.RequestException:
+        metrics.counter("http.errors." + endpoint).inc()
+        raise
+    finally:
+        metrics.histogram("http.latency." + endpoint).observe(time.time() - start)
+    if response.status_code >= 400:
+        logging.debug("HTTP %s %s returned %d", method, endpoint, response.status_code)
+        metrics.counter("http.errors." + endpoint).inc()
+    return response
+
+
+def get(url, endpoint=None, **kwargs) -> requests.Response:
+    return request("GET", url, endpoint=endpoint, **kwargs)
+
+
+def post(url, endpoint=None, **kwargs) -> requests.Response:
+    return request("POST", url, endpoint=endpoint, **kwargs)
+
+
+def put(url, endpoint=None, **kwargs) -> requests.Response:
+    return request("PUT", url, endpoint=endpoint, **kwargs)
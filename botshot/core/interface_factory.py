@@ -1,22 +1,82 @@
+import logging
+import threading
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
 from botshot.core.interfaces import BotshotInterface
 from botshot.core import config
 from django.utils.module_loading import import_string
 
+# registry of this process, interface name -> class and interface name -> instance
+_classes = None
+_instances = {}
+_lock = threading.Lock()
+
 
 class InterfaceFactory:
 
     @staticmethod
     def from_name(name) -> BotshotInterface:
-        """Creates a chat interface by its name."""
-        for interface_class in InterfaceFactory.get_interfaces():
-            if interface_class.name == name:
-                return interface_class()
-        raise ValueError("Unknown interface name '{}'. Did you register the class in INTERFACES config property?".format(name))
+        """Returns the chat interface of this process by its name, it's created on first use."""
+        instance = _instances.get(name)
+        if instance is None:
+            interface_class = InterfaceFactory.get_class(name)
+            with _lock:
+                instance = _instances.get(name)
+                if instance is None:
+                    instance = _instances[name] = interface_class()
+        return instance
+
+    @staticmethod
+    def get_class(name):
+        """Returns a registered interface class by its name."""
+        interface_class = _get_classes().get(name)
+        if interface_class is None:
+            raise ValueError("Unknown interface name '{}'. Did you register the class in INTERFACES config property?".format(name))
+        return interface_class
 
     @staticmethod
     def get_interfaces():
         """Returns a list of registered interface classes."""
-        # FIXME: avoid importing classes every time this is called
-        # TODO: check that interfaces have the correct subclass and a name set
-        interface_paths = config.get_required('INTERFACES')
-        return [import_string(path) for path in interface_paths]
+        return list(_get_classes().values())
+
+    @staticmethod
+    def reload():
+        """Forgets the loaded classes and instances, they are loaded again from INTERFACES on next use."""
+        global _classes
+        with _lock:
+            _classes = None
+            _instances.clear()
+
+
+def _get_classes() -> dict:
+    global _classes
+    if _classes is None:
+        with _lock:
+            if _classes is None:
+                _classes = _load_classes(config.get_required('INTERFACES'))
+    return _classes
+
+
+def _load_classes(interface_paths) -> dict:
+    classes = {}
+    for path in interface_paths:
+        interface_class = import_string(path)
+        if not isinstance(interface_class, type):
+            raise ValueError("Interface {} is not a class.".format(path))
+        if not issubclass(interface_class, BotshotInterface):
+            logging.warning("Interface %s is not a subclass of BotshotInterface", path)
+        name = getattr(interface_class, 'name', None)
+        if not name:
+            raise ValueError("Interface {} doesn't have a name set.".format(path))
+        if name in classes:
+            raise ValueError("Duplicate interface name '{}' of {} and {}.".format(name, classes[name], path))
+        classes[name] = interface_class
+    return classes
+
+
+@receiver(setting_changed)
+def _reload_on_settings_change(setting, **kwargs):
+    if setting == 'BOT_CONFIG':
+        InterfaceFactory.reload()
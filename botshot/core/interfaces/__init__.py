@@ -1,4 +1,4 @@
-from botshot.tasks import run_async
+from botshot.core import pipeline
 from botshot.models import ChatConversation, ChatUser, ChatMessage
 from botshot.core.parsing.raw_message import RawMessage
 from botshot.core import config
@@ -25,13 +25,15 @@ class BotshotInterface():
         """
         raise NotImplementedError()
 
-    def broadcast_responses(self, conversations: Iterable[ChatConversation], responses: Iterable):
+    def broadcast_responses(self, conversations: Iterable[ChatConversation], responses: Iterable, broadcast_id=None):
         """
         Send the same responses to multiple conversations.
         Example usage: notifications, news, ...
 
         :param conversations: Iterable of Conversation objects
         :param responses: Iterable of MessageElement objects
+        :param broadcast_id: (optional) unique ID of the broadcast, interfaces that support it
+                             skip conversations that already received a broadcast with the same ID
         """
         raise NotImplementedError()
 
@@ -55,9 +57,7 @@ class BasicAsyncInterface(BotshotInterface):
         self.msg_limit_seconds = config.get('MSG_LIMIT_SECONDS', 15)
 
     def webhook(self, request):
-        from botshot.core.chat_manager import ChatManager
         if request.method == "POST":
-            manager = ChatManager()
             request_body = json.loads(request.body.decode('utf-8'))
             raw_messages = self.parse_raw_messages(request_body)
             for raw_message in raw_messages:
@@ -67,7 +67,7 @@ class BasicAsyncInterface(BotshotInterface):
                     continue
                 self.on_message_received(raw_message)
                 logging.info("Received raw message: %s", raw_message)
-                run_async(manager.accept, raw_message=raw_message)
+                pipeline.submit(raw_message)
             return HttpResponse()
 
         elif request.method == "GET":
@@ -84,7 +84,7 @@ class BasicAsyncInterface(BotshotInterface):
     def parse_raw_messages(self, request) -> Generator[RawMessage, None, None]:
         raise NotImplementedError()
 
-    def broadcast_responses(self, conversations, responses):
+    def broadcast_responses(self, conversations, responses, broadcast_id=None):
         # send one at a time by default, override this for bulk messaging
         for conversation in conversations:
             self.send_responses(conversation=conversation, reply_to=None, responses=responses)
@@ -53,30 +53,11 @@ class FacebookAdapter(MessageAdapter):
             return {"botshot_supported": False}
         return fn(message, meta=meta)
 
-    def _is_facebook_url(self, url: str):
+    def is_facebook_url(self, url: str):
         """Used to check whether an attachment needs to be uploaded to Facebook before sending."""
         parsed_url = urlparse(url)
         return 'facebook.com' in parsed_url.netloc  # TODO: what about CDNs?
 
-    def _upload_attachment(self, meta, url, type, allow_cache):
-        """Uploads an attachment to FB servers."""
-        from botshot.core.persistence import get_redis
-        att_id = self.interface.upload_attachment(meta, url, type, allow_cache)
-        redis = get_redis()
-        if att_id is not None and redis is not None:
-            expiry = 60 * 60 * 24  # a day
-            redis.set("FB_ATTACHMENT_FOR_{url}".format(url=url), att_id, ex=expiry)
-        return att_id
-
-    def _retrieve_attachment(self, url):
-        """Retrieves an attachment ID from FB servers."""
-        from botshot.core.persistence import get_redis
-        redis = get_redis()
-        if redis is not None:
-            att_id = redis.get("FB_ATTACHMENT_FOR_{url}".format(url=url))
-            return att_id.decode("utf8") if att_id else None
-        return None
-
     def _text_message(self, message: TextMessage, **kwargs):
         if len(message.buttons) and message.quick_replies:
             raise Exception("A message can only have one of: quick replies, buttons")
@@ -203,13 +184,10 @@ class FacebookAdapter(MessageAdapter):
             }
         }
 
-        if self._is_facebook_url(message.url):
+        if self.is_facebook_url(message.url):
             data['attachment']['payload']['elements'][0]['url'] = message.url
         else:
-            att_id = self._retrieve_attachment(message.url)
-            if not att_id:
-                att_id = self._upload_attachment(meta, message.url, message.media_type, message.allow_cache)
-            # yes it could expire in the 1e-5 seconds between prepare_message and this
+            att_id = self.interface.get_attachment_id(meta or {}, message.url, message.media_type, message.allow_cache)
             data['attachment']['payload']['elements'][0]['attachment_id'] = att_id
 
         data['attachment']['payload']['elements'][0]['buttons'] = [
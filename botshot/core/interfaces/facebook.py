@@ -1,16 +1,28 @@
 import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import urlencode
+
 import requests
+from urllib3.exceptions import ProtocolError
 from botshot.core.interfaces.adapter.facebook import FacebookAdapter
 from botshot.core.parsing.raw_message import RawMessage
 from botshot.core.responses.buttons import *
 from botshot.core.responses.responses import *
+from botshot.core.responses.media import MediaMessage
 from botshot.core.responses.settings import ThreadSetting, GreetingSetting, GetStartedSetting, MenuSetting
 from django.http.response import HttpResponse
 from botshot.core.interfaces import BasicAsyncInterface
-from botshot.core import config
+from botshot.core import config, http, metrics
+from botshot.core.persistence import get_redis
 from botshot.models import ChatMessage, ChatUser
 
 FB_API_URL = "https://graph.facebook.com/v2.6"
+# maximum number of requests in one Graph API batch
+FB_BATCH_SIZE = 50
 
 
 class FacebookInterface(BasicAsyncInterface):
@@ -22,6 +34,17 @@ class FacebookInterface(BasicAsyncInterface):
         self.pages = self._init_pages()
         self.adapter = FacebookAdapter(self)
         self.profile_fields = config.get('FB_PROFILE_FIELDS', 'first_name,last_name,profile_pic')
+        self.broadcast_concurrency = config.get('FB_BROADCAST_CONCURRENCY', 4)
+        self.pacer = UsagePacer(
+            max_usage=config.get('FB_BROADCAST_MAX_USAGE', 75),
+            max_delay=config.get('FB_BROADCAST_MAX_DELAY', 60)
+        )
+        self.attachments = AttachmentCache(
+            upload_fn=lambda page, url, media_type: self._upload_to_page(page, url, media_type, True),
+            ttl=config.get('FB_ATTACHMENT_TTL', 3600 * 24),
+            max_size=config.get('FB_ATTACHMENT_CACHE_SIZE', 1000),
+            concurrency=config.get('FB_ATTACHMENT_UPLOAD_CONCURRENCY', 4),
+        )
 
     def _init_pages(self):
         page_configs = config.get_required('FB_PAGES')
@@ -38,6 +61,9 @@ class FacebookInterface(BasicAsyncInterface):
                 raise ValueError("FB_PAGES page '{}' property 'PAGE_ID' has to be specified "
                                  "when multiple pages are present.".format(name))
             pages.append(MessengerPage(name=name, token=token, page_id=page_id))
+        # page_id -> page, pages without page_id receive messages of all other pages
+        self.pages_by_id = {page.page_id: page for page in pages if page.page_id is not None}
+        self.default_page = next((page for page in pages if page.page_id is None), None)
         return pages
 
     def webhook_get(self, request):
@@ -47,9 +73,9 @@ class FacebookInterface(BasicAsyncInterface):
             return HttpResponse('Error, token not matching FB_VERIFY_TOKEN.')
 
     def get_page(self, page_id):
-        for page in self.pages:
-            if page.page_id == page_id or page.page_id is None:
-                return page
+        page = self.pages_by_id.get(page_id, self.default_page)
+        if page is not None:
+            return page
         raise ValueError("Facebook page not found by page_id = '{}' in FB_PAGES.".format(page_id))
 
     def parse_raw_messages(self, request):
@@ -139,7 +165,7 @@ class FacebookInterface(BasicAsyncInterface):
                 logging.warn("Can't retrieve user details, no associated FB page")
                 return
             url += "&access_token=" + str(page.token)
-            res = requests.get(url)  # don't use params, encoding issues
+            res = http.get(url, endpoint="facebook.profile")  # don't use params, encoding issues
             if res.status_code != requests.codes.ok:
                 logging.error("ERROR: Loading FB profile, got response: {}".format(res.text))
                 return
@@ -179,48 +205,177 @@ class FacebookInterface(BasicAsyncInterface):
             responses=responses
         )
 
+    def _to_request(self, fbid, conversation_meta, response):
+        """Returns a tuple (request_mode, response_dict) of a Send API request."""
+        if isinstance(response, SenderActionMessage):
+            request_mode = "messages"
+            response_dict = {
+                'sender_action': response.action,
+                'recipient': {"id": fbid},
+            }
+        elif isinstance(response, MessageElement):
+            message_tag = response.get_message_tag()
+            message = self.adapter.transform_message(response, meta=conversation_meta)
+
+            response_dict = {
+                "recipient": {"id": fbid},
+                "message": message,
+                "messaging_type": "MESSAGE_TAG" if message_tag else "RESPONSE",
+                "tag": message_tag,
+            }
+            request_mode = "messages"
+        else:
+            # TODO: Check what happens when this error is thrown
+            raise ValueError('Error: Invalid message type: {}: {}'.format(type(response), response))
+        return request_mode, response_dict
+
     def _send_responses(self, fbid, conversation_meta, responses):
         page_id = conversation_meta.get('page_id')
         token = self.get_page(page_id).token
 
         if not isinstance(responses, list):
             responses = [responses]
+        self.prefetch_attachments(conversation_meta, responses)
 
         for response in responses:
-            if isinstance(response, SenderActionMessage):
-                request_mode = "messages"
-                response_dict = {
-                    'sender_action': response.action,
-                    'recipient': {"id": fbid},
-                }
-            elif isinstance(response, MessageElement):
-                message_tag = response.get_message_tag()
-                message = self.adapter.transform_message(response, meta=conversation_meta)
-
-                response_dict = {
-                    "recipient": {"id": fbid},
-                    "message": message,
-                    "messaging_type": "MESSAGE_TAG" if message_tag else "RESPONSE",
-                    "tag": message_tag,
-                }
-                request_mode = "messages"
-            else:
-                # TODO: Check what happens when this error is thrown
-                raise ValueError('Error: Invalid message type: {}: {}'.format(type(response), response))
+            request_mode, response_dict = self._to_request(fbid, conversation_meta, response)
 
             prefix_post_message_url = FB_API_URL + '/me/'
 
             post_message_url = prefix_post_message_url + request_mode + '?access_token=' + token
 
-            r = requests.post(post_message_url,
-                              headers={"Content-Type": "application/json"},
-                              data=json.dumps(response_dict))
+            r = http.post(post_message_url, endpoint="facebook." + request_mode,
+                          headers={"Content-Type": "application/json"},
+                          data=json.dumps(response_dict))
 
             if r.status_code != 200:
                 logging.error('ERROR: MESSAGE REFUSED: {}'.format(response_dict))
                 logging.error('ERROR: {}'.format(r.text))
                 logging.exception(r.json()['error']['message'])
 
+    def broadcast_responses(self, conversations, responses, broadcast_id=None):
+        """
+        Sends the same responses to many conversations using Graph API batch requests.
+
+        Batches are sent concurrently by FB_BROADCAST_CONCURRENCY threads and paced by the usage headers
+        returned by Facebook. Responses of one conversation are always sent in the same batch, in order.
+
+        :param broadcast_id: (optional) ID of the broadcast. If Redis is available, conversations that
+                             were already sent are remembered, so that an interrupted broadcast can be resumed
+                             by calling this method again with the same ID.
+        :returns: dict with the number of conversations that were sent, failed and skipped.
+                  Conversations of a batch that timed out might have received the responses, they are counted as failed,
+                  but never sent again when the broadcast is resumed.
+        """
+        if not isinstance(responses, list):
+            responses = [responses]
+        progress = BroadcastProgress(broadcast_id)
+        stats = {'sent': 0, 'failed': 0, 'skipped': 0}
+        stats_lock = threading.Lock()
+        per_batch = max(1, FB_BATCH_SIZE // max(len(responses), 1))
+
+        def send_batch(batch):
+            sent, failed, unknown = self._send_batch(batch, responses)
+            progress.add(sent)
+            progress.add_unknown(unknown)
+            with stats_lock:
+                stats['sent'] += len(sent)
+                stats['failed'] += failed + len(unknown)
+
+        conversations = iter(conversations)
+        with ThreadPoolExecutor(max_workers=self.broadcast_concurrency) as executor:
+            in_flight = []
+            while True:
+                chunk = list(islice(conversations, per_batch * self.broadcast_concurrency))
+                if not chunk:
+                    break
+                todo = progress.filter(chunk)
+                stats['skipped'] += len(chunk) - len(todo)
+                for batch in self._group_batches(todo, per_batch):
+                    in_flight.append(executor.submit(send_batch, batch))
+                # don't read more conversations than the threads can send
+                for future in in_flight:
+                    future.result()
+                in_flight = []
+        logging.info("Facebook broadcast %s finished: %s", broadcast_id, stats)
+        return stats
+
+    def _group_batches(self, conversations, per_batch):
+        """Splits conversations to batches of the same page, a batch is sent with the page's token."""
+        by_page = {}
+        for conversation in conversations:
+            page = self.get_page((conversation.meta or {}).get('page_id'))
+            by_page.setdefault(page, []).append(conversation)
+        for page, targets in by_page.items():
+            for i in range(0, len(targets), per_batch):
+                yield page, targets[i:i + per_batch]
+
+    def _send_batch(self, batch, responses, retries=3):
+        """
+        Sends responses to a batch of conversations of one page in a single Graph API call.
+        The batch is retried only if it surely wasn't sent, or if it was refused because of rate limits.
+        :returns: tuple (list of conversations that received all responses, number of failed conversations,
+                  list of conversations that might have received them, if the response of Facebook was lost)
+        """
+        page, conversations = batch
+        if conversations:
+            self.prefetch_attachments(conversations[0].meta or {}, responses)
+        requests_, owners = [], []
+        for i, conversation in enumerate(conversations):
+            meta = conversation.meta or {}
+            for j, response in enumerate(responses):
+                request_mode, response_dict = self._to_request(conversation.raw_conversation_id, meta, response)
+                body = {
+                    key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                    for key, value in response_dict.items() if value is not None
+                }
+                request = {
+                    "method": "POST",
+                    "relative_url": "me/" + request_mode,
+                    "body": urlencode(body),
+                    "name": "c{}r{}".format(i, j),
+                    "omit_response_on_success": False,
+                }
+                if j > 0:
+                    # keep the order of responses of one conversation
+                    request["depends_on"] = "c{}r{}".format(i, j - 1)
+                requests_.append(request)
+                owners.append(i)
+
+        for attempt in range(retries):
+            self.pacer.wait()
+            try:
+                r = http.post(FB_API_URL, endpoint="facebook.batch", data={
+                    "access_token": page.token,
+                    "batch": json.dumps(requests_),
+                    "include_headers": "false",
+                })
+            except requests.RequestException as e:
+                if not _is_unsent(e):
+                    # e.g. a read timeout, Facebook could have processed the batch already
+                    logging.exception("Delivery of Facebook batch to %d conversations is unknown", len(conversations))
+                    metrics.counter("facebook.batch_unknown").inc()
+                    return [], 0, conversations
+                logging.exception("Error sending Facebook batch")
+                continue
+            self.pacer.update(r.headers)
+            if r.status_code == 200:
+                break
+            logging.error("Facebook batch refused: %s", r.text)
+            if self.pacer.is_rate_limited(r):
+                continue
+            return [], len(conversations), []
+        else:
+            return [], len(conversations), []
+
+        failed = set()
+        for owner, result in zip(owners, r.json()):
+            if not result or result.get('code') != 200:
+                logging.warning("Facebook broadcast message refused: %s", result and result.get('body'))
+                failed.add(owner)
+        sent = [conversation for i, conversation in enumerate(conversations) if i not in failed]
+        return sent, len(failed), []
+
     # @staticmethod
     # def post_setting(page_id, response):
     #     if isinstance(response, ThreadSetting):
@@ -263,12 +418,31 @@ class FacebookInterface(BasicAsyncInterface):
     #         return r
     #     raise ValueError('Error: Invalid setting type: {}: {}'.format(type(response), response))
 
+    def get_attachment_id(self, meta, attachment_url: str, type: str, is_reusable=True):
+        """Returns ID of an attachment, reusable attachments are uploaded only once and cached."""
+        if not is_reusable:
+            return self.upload_attachment(meta, attachment_url, type, is_reusable=False)
+        return self.attachments.get(self.get_page(meta.get("page_id")), attachment_url, type)
+
+    def prefetch_attachments(self, meta, responses):
+        """Uploads or loads from cache all reusable attachments of responses at once, before they are sent."""
+        attachments = [
+            (response.url, response.media_type) for response in responses
+            if isinstance(response, MediaMessage) and response.url and response.allow_cache
+            and not self.adapter.is_facebook_url(response.url)
+        ]
+        if attachments:
+            self.attachments.get_many(self.get_page(meta.get("page_id")), attachments)
+
     def upload_attachment(self, meta, attachment_url: str, type: str, is_reusable=True):
         """
         Uploads a file from the given URL to Facebook's servers.
 
         :returns: Id of the attachment if uploaded successfully, None otherwise.
         """
+        return self._upload_to_page(self.get_page(meta.get("page_id")), attachment_url, type, is_reusable)
+
+    def _upload_to_page(self, page, attachment_url: str, type: str, is_reusable=True):
         data = {
             "message": {
                 "attachment": {
@@ -276,11 +450,8 @@ class FacebookInterface(BasicAsyncInterface):
                 }
             }
         }
-        prefix_post_message_url = FB_API_URL + '/me/'
-        page_id = meta.get("page_id")
-        token = self.get_page(page_id).token
-        post_message_url = prefix_post_message_url + "message_attachments" + '?access_token=' + token
-        r = requests.post(url=post_message_url, data=json.dumps(data), headers={"Content-Type": "application/json"})
+        post_message_url = FB_API_URL + '/me/message_attachments?access_token=' + page.token
+        r = http.post(post_message_url, endpoint="facebook.message_attachments", data=json.dumps(data), headers={"Content-Type": "application/json"})
         response = r.json()
         if r.status_code != 200:
             logging.error("Couldn't upload attachment: {}".format(response))
@@ -294,3 +465,249 @@ class MessengerPage:
         self.name = name
         self.token = token
         self.page_id = page_id
+
+
+class UsagePacer:
+    """
+    Slows down requests when Facebook reports high usage of the app's or page's rate limit.
+    Usage is read from the X-App-Usage and X-Page-Usage headers, as a percentage of the limit.
+    """
+
+    USAGE_HEADERS = ('X-App-Usage', 'X-Page-Usage')
+    # Graph API error codes of exceeded rate limits
+    RATE_LIMIT_ERRORS = {4, 17, 32, 613}
+
+    def __init__(self, max_usage=75, max_delay=60):
+        """
+        :param max_usage:   usage in percent from which requests are delayed
+        :param max_delay:   delay in seconds when the limit is reached
+        """
+        self.max_usage = max_usage
+        self.max_delay = max_delay
+        self.usage = 0
+        self.lock = threading.Lock()
+
+    def update(self, headers):
+        usage = 0
+        for header in self.USAGE_HEADERS:
+            try:
+                values = json.loads(headers.get(header) or '{}')
+                usage = max([usage] + [v for v in values.values() if isinstance(v, (int, float))])
+            except ValueError:
+                logging.warning("Invalid %s header: %s", header, headers.get(header))
+        with self.lock:
+            self.usage = usage
+
+    def is_rate_limited(self, response) -> bool:
+        try:
+            code = response.json().get('error', {}).get('code')
+        except ValueError:
+            return False
+        if code in self.RATE_LIMIT_ERRORS:
+            with self.lock:
+                self.usage = 100
+            return True
+        return False
+
+    def get_delay(self) -> float:
+        """Returns the delay in seconds, growing linearly from zero at max_usage to max_delay at 100%."""
+        with self.lock:
+            usage = self.usage
+        if usage < self.max_usage:
+            return 0
+        return self.max_delay * min(1.0, (usage - self.max_usage) / max(100 - self.max_usage, 1))
+
+    def wait(self):
+        delay = self.get_delay()
+        if delay > 0:
+            logging.info("Facebook usage at %d%%, waiting %.1f seconds", self.usage, delay)
+            time.sleep(delay)
+
+
+def _is_unsent(error: requests.RequestException) -> bool:
+    """Returns whether a request surely didn't reach the server, so that it can be sent again."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        # the connection was dropped while waiting for the response
+        return not any(isinstance(arg, ProtocolError) for arg in error.args)
+    return False
+
+
+class BroadcastProgress:
+    """Remembers in Redis which conversations already received a broadcast, so that it can be resumed."""
+
+    KEY_PREFIX = "botshot_fb_broadcast_"
+    TTL = 3600 * 24 * 7
+
+    def __init__(self, broadcast_id):
+        self.redis = get_redis() if broadcast_id is not None else None
+        self.key = self.KEY_PREFIX + str(broadcast_id)
+
+    def filter(self, conversations) -> list:
+        """Returns conversations that didn't receive the broadcast yet."""
+        if self.redis is None or not conversations:
+            return list(conversations)
+        pipe = self.redis.pipeline()
+        for conversation in conversations:
+            pipe.sismember(self.key, conversation.conversation_id)
+        return [c for c, done in zip(conversations, pipe.execute()) if not done]
+
+    def add(self, conversations):
+        if self.redis is None or not conversations:
+            return
+        pipe = self.redis.pipeline()
+        pipe.sadd(self.key, *[c.conversation_id for c in conversations])
+        pipe.expire(self.key, self.TTL)
+        pipe.execute()
+
+    def add_unknown(self, conversations):
+        """Remembers conversations that might have received the broadcast, they are skipped when it's resumed."""
+        if self.redis is None or not conversations:
+            return
+        ids = [c.conversation_id for c in conversations]
+        pipe = self.redis.pipeline()
+        for key in (self.key, self.key + "_unknown"):
+            pipe.sadd(key, *ids)
+            pipe.expire(key, self.TTL)
+        pipe.execute()
+
+    def get_unknown(self) -> set:
+        """Returns IDs of conversations whose delivery is unknown."""
+        if self.redis is None:
+            return set()
+        return {int(id) for id in self.redis.smembers(self.key + "_unknown")}
+
+
+class AttachmentCache:
+    """
+    Remembers IDs of attachments uploaded to Facebook by page and URL, in an LRU dict of this process
+    in front of Redis. Each URL is uploaded once: concurrent uploads in this process wait for the first one,
+    and other processes wait for it using a lock in Redis.
+    """
+
+    KEY_PREFIX = "FB_ATTACHMENT_FOR_"
+    LOCK_PREFIX = "FB_ATTACHMENT_UPLOADING_"
+    # seconds to wait for an upload of another process, then the attachment is uploaded again
+    LOCK_TIMEOUT = 30
+    POLL_SECONDS = 0.1
+
+    def __init__(self, upload_fn, ttl=3600 * 24, max_size=1000, concurrency=4):
+        """
+        :param upload_fn:    function (page, url, media_type) -> attachment ID or None
+        :param ttl:          seconds to remember an attachment ID
+        :param max_size:     how many attachment IDs to keep in this process
+        :param concurrency:  how many attachments to upload at once in get_many()
+        """
+        self.upload_fn = upload_fn
+        self.ttl = ttl
+        self.max_size = max_size
+        self.concurrency = concurrency
+        self.lru = OrderedDict()  # key -> (expires at, attachment ID)
+        self.in_flight = {}  # key -> Future of an upload in this process
+        self.lock = threading.Lock()
+
+    def _key(self, page, url):
+        return "{}{}_{}".format(self.KEY_PREFIX, page.page_id or page.name, url)
+
+    def get(self, page, url: str, media_type: str):
+        """Returns ID of an attachment, it is uploaded if it's not cached."""
+        return self.get_many(page, [(url, media_type)]).get(url)
+
+    def get_many(self, page, attachments) -> dict:
+        """
+        Returns IDs of many attachments, cached ones are read in one Redis call and the rest is uploaded concurrently.
+        :param attachments: list of tuples (url, media_type)
+        :returns: dict url -> attachment ID, or None if the upload failed
+        """
+        media_types = dict(attachments)
+        result = self._get_cached(page, list(media_types))
+        missing = [url for url, att_id in result.items() if att_id is None]
+        if len(missing) == 1:
+            result[missing[0]] = self._upload(page, missing[0], media_types[missing[0]])
+        elif missing:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(missing))) as executor:
+                uploads = {url: executor.submit(self._upload, page, url, media_types[url]) for url in missing}
+            for url, future in uploads.items():
+                try:
+                    result[url] = future.result()
+                except Exception:
+                    logging.exception("Error uploading attachment %s", url)
+        return result
+
+    def _get_cached(self, page, urls) -> dict:
+        now = time.time()
+        result, missing = {}, []
+        with self.lock:
+            for url in urls:
+                cached = self.lru.get(self._key(page, url))
+                if cached is not None and cached[0] > now:
+                    self.lru.move_to_end(self._key(page, url))
+                    result[url] = cached[1]
+                else:
+                    missing.append(url)
+        metrics.counter("facebook.attachment_cache.hits").inc(len(result))
+        redis = get_redis()
+        if missing and redis is not None:
+            values = redis.mget([self._key(page, url) for url in missing])
+            for url, att_id in zip(missing, values):
+                if att_id is not None:
+                    result[url] = att_id.decode("utf8")
+                    self._remember(self._key(page, url), result[url])
+            metrics.counter("facebook.attachment_cache.redis_hits").inc(sum(v is not None for v in values))
+        for url in missing:
+            result.setdefault(url, None)
+        return result
+
+    def _remember(self, key, att_id):
+        with self.lock:
+            self.lru[key] = (time.time() + self.ttl, att_id)
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.max_size:
+                self.lru.popitem(last=False)
+
+    def _upload(self, page, url, media_type):
+        key = self._key(page, url)
+        with self.lock:
+            future = self.in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self.in_flight[key] = Future()
+        if not is_owner:
+            return future.result()
+        try:
+            att_id = self._upload_once(page, url, media_type, key)
+            future.set_result(att_id)
+            return att_id
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+    def _upload_once(self, page, url, media_type, key):
+        redis = get_redis()
+        lock_key = self.LOCK_PREFIX + key[len(self.KEY_PREFIX):]
+        if redis is not None and not redis.set(lock_key, 1, nx=True, ex=self.LOCK_TIMEOUT):
+            # another process is uploading the attachment
+            deadline = time.time() + self.LOCK_TIMEOUT
+            while time.time() < deadline:
+                time.sleep(self.POLL_SECONDS)
+                att_id = redis.get(key)
+                if att_id is not None:
+                    self._remember(key, att_id.decode("utf8"))
+                    return att_id.decode("utf8")
+                if not redis.exists(lock_key):
+                    break
+        try:
+            metrics.counter("facebook.attachment_cache.uploads").inc()
+            att_id = self.upload_fn(page, url, media_type)
+            if att_id is not None:
+                self._remember(key, att_id)
+                if redis is not None:
+                    redis.set(key, att_id, ex=self.ttl)
+            return att_id
+        finally:
+            if redis is not None:
+                redis.delete(lock_key)
@@ -3,7 +3,7 @@ import logging
 from datetime import datetime, timedelta
 from typing import Optional
 
-import requests
+from botshot.core import http
 from django.conf import settings
 
 from botshot.core.interfaces.adapter.microsoft import MicrosoftAdapter
@@ -97,7 +97,7 @@ class MicrosoftInterface():
                 '&client_secret=' + settings.BOT_CONFIG.get('MS_BOT_TOKEN') +
                 '&scope=' + 'https://api.botframework.com/.default'
             )
-            response = requests.post(url, data=payload, headers=headers)
+            response = http.post(url, endpoint="microsoft.token", data=payload, headers=headers)
             if response.status_code != 200:
                 logging.error(response.text)
                 response.raise_for_status()
@@ -143,7 +143,7 @@ class MicrosoftInterface():
         }
         logging.warning(url)
         logging.warning(payload)
-        response = requests.post(url, data=json.dumps(payload), headers=headers)
+        response = http.post(url, endpoint="microsoft.activities", data=json.dumps(payload), headers=headers)
         if response.status_code != 200:
             logging.warning(str(payload))
             logging.warning(response)
@@ -171,7 +171,7 @@ class MicrosoftInterface():
         }
         url = MicrosoftInterface.get_base_url(chat_id) + 'conversations/' + chat_id + '/activities'
         headers = {"Authorization": "Bearer " + MicrosoftInterface.get_auth_token()}
-        response = requests.post(url, data=json.dumps(payload), headers=headers)
+        response = http.post(url, endpoint="microsoft.activities", data=json.dumps(payload), headers=headers)
         if response.status_code != 200:
             logging.error(response.text)
             response.raise_for_status()
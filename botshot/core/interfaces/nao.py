@@ -83,5 +83,5 @@ class NaoInterface(BotshotInterface):
         responses_for_user = self.responses[conversation.raw_conversation_id]
         responses_for_user += responses
 
-    def broadcast_responses(self, conversations, responses):
+    def broadcast_responses(self, conversations, responses, broadcast_id=None):
         raise NotImplementedError()
@@ -6,7 +6,7 @@ from datetime import datetime, timedelta
 from time import time
 from typing import Optional, Generator
 
-import requests
+from botshot.core import http
 from django.conf import settings
 
 from botshot.core import config
@@ -39,7 +39,7 @@ class TelegramInterface(BasicAsyncInterface):
 
         payload = {'url': callback_url}
 
-        response = requests.post(endpoint_url, data=payload)
+        response = http.post(endpoint_url, endpoint="telegram.setWebhook", data=payload)
         if not response.json()['ok']:
             raise Exception("Error while registering telegram webhook: {}".format(response.json()))
 
@@ -101,7 +101,7 @@ class TelegramInterface(BasicAsyncInterface):
         # answer query to hide loading bar in frontend
         url = self.base_url + 'answerCallbackQuery'
         payload = {'callback_query_id': query_id}
-        response = requests.post(url, data=payload)
+        response = http.post(url, endpoint="telegram.answerCallbackQuery", data=payload)
         if not response.json()['ok']:
             logging.error('Error occurred while answering to telegram callback: {}'.format(response.json()))
 
@@ -109,7 +109,7 @@ class TelegramInterface(BasicAsyncInterface):
         if self.should_hide_keyboard:
             url = self.base_url + 'editMessageReplyMarkup'
             payload = {'chat_id': chat_id, 'message_id': message_id, 'reply_markup': ''}
-            response = requests.post(url, data=payload)
+            response = http.post(url, endpoint="telegram.editMessageReplyMarkup", data=payload)
             if not response.json()['ok']:
                 logging.error('Error occurred while hiding telegram keyboard: {}'.format(response.json()))
 
@@ -153,7 +153,7 @@ class TelegramInterface(BasicAsyncInterface):
             'chat_id': message.conversation.raw_conversation_id,
             'action': 'typing'
         }
-        response = requests.post(url, data=payload)
+        response = http.post(url, endpoint="telegram.sendChatAction", data=payload)
         if not response.json()['ok']:
             logging.warning("Error occurred while sending Telegram typing action: {}".format(response.json()))
 
@@ -164,7 +164,8 @@ class TelegramInterface(BasicAsyncInterface):
             messages += self.adapter.transform_message(response, chat_id)
         for method, payload in messages:
             url = self.base_url + method
-            response = requests.post(url, data=payload)
+            # the URL contains the bot token, name the endpoint by method
+            response = http.post(url, endpoint="telegram." + method, data=payload)
             if not response.json()['ok']:
                 logging.warning("Telegram message for method {} failed to send: {}".format(
                     url,
@@ -172,7 +173,7 @@ class TelegramInterface(BasicAsyncInterface):
                 )
                 break
 
-    def broadcast_responses(self, conversations, responses):
+    def broadcast_responses(self, conversations, responses, broadcast_id=None):
         for conversation in conversations:
             self.send_responses(conversation=conversation, reply_to=None, responses=responses)
 
@@ -14,7 +14,7 @@ class TestInterface(BotshotInterface):
     def send_responses(self, user: ChatUser, responses):
         pass
 
-    def broadcast_responses(self, users, responses):
+    def broadcast_responses(self, users, responses, broadcast_id=None):
         pass
 
     @staticmethod
@@ -25,3 +25,14 @@ class MessageLogger(ABC):
     @abstractmethod
     def log_error(self, message: ChatMessage, state, exception):
         pass
+
+    def log_batch(self, events: list):
+        """
+        Logs events of a processed message.
+        Override to log the events in bulk, by default each event is passed to its method.
+
+        :param events: list of (method_name, message, kwargs) tuples in order, for example
+                       ('log_state_change', message, {'state': 'default.root'})
+        """
+        for method_name, message, kwargs in events:
+            getattr(self, method_name)(message=message, **kwargs)
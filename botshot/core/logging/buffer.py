@@ -0,0 +1,72 @@
+import logging
+import threading
+import time
+
+from botshot.core import metrics
+
+
+class BatchBuffer:
+    """
+    Buffers items in a process and sends them in batches.
+    The buffer is flushed when it has batch_size items, or by a background thread every flush_seconds.
+
+    Subclasses implement send_batch(), which gets at most batch_size items. If it raises, the items
+    that weren't sent are passed to on_failure(), which keeps them for the next flush, up to max_buffer items.
+    """
+
+    name = "buffer"
+
+    def __init__(self, batch_size=500, flush_seconds=5.0, max_buffer=10000):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer
+        self.items = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    def send_batch(self, items: list):
+        raise NotImplementedError()
+
+    def add(self, items: list):
+        with self.lock:
+            self.items += items
+            is_full = len(self.items) >= self.batch_size
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name + "-flush", daemon=True)
+                self.thread.start()
+        if is_full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                items, self.items = self.items, []
+            for offset in range(0, len(items), self.batch_size):
+                start = time.time()
+                try:
+                    self.send_batch(items[offset:offset + self.batch_size])
+                except Exception:
+                    logging.exception("Unable to send %d items of %s", len(items) - offset, self.name)
+                    metrics.counter(self.name + ".failed_batches").inc()
+                    # the next batches would most likely fail too
+                    self.on_failure(items[offset:])
+                    return
+                finally:
+                    metrics.histogram(self.name + ".batch_latency").observe(time.time() - start)
+
+    def on_failure(self, items: list):
+        with self.lock:
+            items = items + self.items
+            dropped = max(len(items) - self.max_buffer, 0)
+            self.items = items[dropped:]
+        if dropped:
+            metrics.counter(self.name + ".dropped").inc(dropped)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Error flushing %s", self.name)
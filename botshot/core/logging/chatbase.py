@@ -1,21 +1,131 @@
+import calendar
+import json
 import logging
+import random
+import threading
 import time
 
-import requests
-from django.conf import settings
+from celery.signals import worker_process_shutdown
 
-from botshot.core import config
+from botshot.core import config, http, metrics
 from botshot.core.logging import MessageLogger
+from botshot.core.logging.buffer import BatchBuffer
+from botshot.core.persistence import get_redis
 from botshot.core.responses import MessageElement
 from botshot.models import ChatMessage
-import calendar
+
+BASE_URL = 'https://chatbase.com/api'
+UNSENT_KEY = 'botshot_chatbase_unsent'
+
+_sender = None
+_lock = threading.Lock()
+
+
+class ChatbaseSender(BatchBuffer):
+    """
+    Sends messages to the Chatbase batch endpoint.
+    Failed requests are retried with exponential backoff and jitter. Batches that still fail are stored in Redis
+    and sent again by the next successful flush of any worker, so that a restart doesn't lose them.
+    """
+
+    name = "chatbase"
+
+    def __init__(self, batch_size=100, flush_seconds=5.0, max_retries=3, backoff=0.5, max_unsent=1000):
+        super().__init__(batch_size=batch_size, flush_seconds=flush_seconds)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_unsent = max_unsent
+
+    def send_batch(self, messages: list):
+        self._post(messages)
+        metrics.counter("chatbase.sent").inc(len(messages))
+        self._resend_unsent()
+
+    def _post(self, messages):
+        for attempt in range(self.max_retries + 1):
+            try:
+                # the API key is in each message in the body, not in the URL where it could be logged
+                response = http.post(BASE_URL + "/messages", endpoint="chatbase.messages",
+                                     json={"messages": messages})
+                if response.ok:
+                    return
+                if response.status_code != 429 and response.status_code < 500:
+                    # the batch is invalid, sending it again won't help
+                    logging.error("Chatbase rejected %d messages with code %d: %s",
+                                  len(messages), response.status_code, response.text[:200])
+                    metrics.counter("chatbase.rejected").inc(len(messages))
+                    return
+                error = "HTTP {}".format(response.status_code)
+            except Exception as e:
+                error = e
+            if attempt < self.max_retries:
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logging.warning("Chatbase request failed (%s), retrying in %.1f s", error, delay)
+                time.sleep(delay)
+        raise IOError("Chatbase request failed: {}".format(error))
+
+    def on_failure(self, messages: list):
+        redis = get_redis()
+        if redis is None:
+            super().on_failure(messages)
+            return
+        try:
+            pipe = redis.pipeline()
+            for start in range(0, len(messages), self.batch_size):
+                pipe.rpush(UNSENT_KEY, json.dumps(messages[start:start + self.batch_size]))
+            pipe.ltrim(UNSENT_KEY, -self.max_unsent, -1)
+            pipe.execute()
+        except Exception:
+            logging.exception("Unable to store %d unsent Chatbase messages", len(messages))
+            metrics.counter("chatbase.dropped").inc(len(messages))
+
+    def _resend_unsent(self):
+        redis = get_redis()
+        if redis is None:
+            return
+        # one stored batch per flush, so that a long outage doesn't block the new messages
+        try:
+            data = redis.lpop(UNSENT_KEY)
+        except Exception:
+            logging.exception("Unable to read unsent Chatbase messages")
+            return
+        if not data:
+            return
+        messages = json.loads(data)
+        try:
+            self._post(messages)
+        except Exception:
+            logging.exception("Unable to send %d stored Chatbase messages", len(messages))
+            self.on_failure(messages)
+            return
+        metrics.counter("chatbase.resent").inc(len(messages))
+
+
+def get_sender() -> ChatbaseSender:
+    """Returns the Chatbase message buffer of this process."""
+    global _sender
+    if _sender is None:
+        with _lock:
+            if _sender is None:
+                _sender = ChatbaseSender(
+                    batch_size=config.get("CHATBASE_BATCH_SIZE", 100),
+                    flush_seconds=config.get("CHATBASE_FLUSH_SECONDS", 5.0),
+                    max_retries=config.get("CHATBASE_MAX_RETRIES", 3),
+                )
+    return _sender
+
+
+@worker_process_shutdown.connect
+def flush_sender(**kwargs):
+    if _sender is not None:
+        _sender.flush()
 
 
 class ChatbaseLogger(MessageLogger):
+    """Logs user messages and bot responses to Chatbase, in batches of messages of this process."""
 
     def __init__(self):
         super().__init__()
-        self.base_url = 'https://chatbase.com/api'
         self.api_key = config.get_required("CHATBASE_API_KEY", "Chatbase API key not provided!")
         self.bot_version = config.get("VERSION", 'no version')
 
@@ -45,11 +155,7 @@ class ChatbaseLogger(MessageLogger):
             "version": self.bot_version
         }
         # TODO: add session_id attribute
-        logging.debug("Sending to chatbase: {}".format(payload))
-        response = requests.post(self.base_url + "/message", params=payload)
-        if not response.ok:
-            logging.error("Chatbase request with code %d, reason: %s", response.status_code, response.reason)
-        return response.ok
+        get_sender().add([payload])
 
     def log_bot_response(self, message: ChatMessage, response: MessageElement, timestamp):
         payload = {
@@ -63,11 +169,7 @@ class ChatbaseLogger(MessageLogger):
             "not_handled": False,  # only for user messages
             "version": self.bot_version
         }
-        logging.debug("Sending to chatbase: {}".format(payload))
-        response = requests.post(self.base_url + "/message", params=payload)
-        if not response.ok:
-            logging.error("Chatbase request with code %d, reason: %s", response.status_code, response.reason)
-        return response.ok
+        get_sender().add([payload])
 
     def log_user_message_start(self, message: ChatMessage, accepted_state):
         pass
@@ -1,72 +1,187 @@
 import json
+import logging
+import os
+import threading
 import time
+from datetime import datetime
 
-from botshot.core import config
+import pytz
+from celery.signals import worker_process_shutdown
+
+from botshot.core import config, metrics
 from botshot.core.logging import MessageLogger
+from botshot.core.logging.buffer import BatchBuffer
+from botshot.core.persistence import json_serialize
+from botshot.core.responses import MessageElement
+from botshot.models import ChatMessage
 
+_client = None
+_client_pid = None
+_indexer = None
+_lock = threading.Lock()
 
-def get_elastic():
+
+def _create_client(es_config):
     from elasticsearch import Elasticsearch
-    es_config = config.get_required('ELASTIC', 'ElasticSearch config not provided.')
+    url = es_config.get('URL')
+    if not url:
+        host = es_config['HOST']
+        url = host if '://' in host else 'http://{}:{}'.format(host, es_config.get('PORT', 9200))
+    return Elasticsearch(
+        hosts=[url],
+        connections_per_node=es_config.get('CONNECTIONS', 10),
+        request_timeout=es_config.get('TIMEOUT', 30),
+    )
+
+
+def get_elastic():
+    """
+    Returns the shared Elasticsearch client of this process, or None if ELASTIC is not configured.
+    The client keeps a pool of connections, it is created again in forked processes.
+    """
+    global _client, _client_pid
+    es_config = config.get('ELASTIC')
     if not es_config:
         return None
-    return Elasticsearch(es_config['HOST'], port=es_config['PORT'])
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _client = _create_client(es_config)
+                _client_pid = pid
+    return _client
+
+
+def get_index_name(timestamp) -> str:
+    """
+    Returns the index of a document created at a time.
+    Indices are partitioned by day or month, old ones can be deleted or moved to cheaper nodes.
+    """
+    es_config = config.get('ELASTIC') or {}
+    date_format = '%Y.%m' if es_config.get('INDEX_PERIOD') == 'month' else '%Y.%m.%d'
+    date = datetime.fromtimestamp(timestamp, tz=pytz.utc)
+    return '{}-{}'.format(es_config.get('INDEX', 'message-log'), date.strftime(date_format))
+
+
+class BulkIndexer(BatchBuffer):
+    """Buffers documents and indexes them with the bulk API."""
+
+    name = "elastic"
+
+    def send_batch(self, actions: list):
+        client = get_elastic()
+        if client is None:
+            return
+        from elasticsearch import helpers
+        success, errors = helpers.bulk(client, actions, chunk_size=len(actions), raise_on_error=False)
+        metrics.counter("elastic.indexed").inc(success)
+        if errors:
+            logging.warning("Elasticsearch rejected %d documents: %s", len(errors), errors[:3])
+            metrics.counter("elastic.rejected").inc(len(errors))
+
+
+def get_indexer() -> BulkIndexer:
+    """Returns the document buffer of this process."""
+    global _indexer
+    if _indexer is None:
+        with _lock:
+            if _indexer is None:
+                es_config = config.get('ELASTIC') or {}
+                _indexer = BulkIndexer(
+                    batch_size=es_config.get('BULK_SIZE', 500),
+                    flush_seconds=es_config.get('FLUSH_SECONDS', 5.0),
+                    max_buffer=es_config.get('MAX_BUFFER', 10000),
+                )
+    return _indexer
+
+
+@worker_process_shutdown.connect
+def flush_indexer(**kwargs):
+    if _indexer is not None:
+        _indexer.flush()
 
 
 class ElasticsearchLogger(MessageLogger):
-    def __init__(self):
-        super().__init__()
-        self.test_id = -1  # FIXME
-
-    def log_user_message(self, dialog, time: float, state, message_text, message_type, entities):
-        self._log_message({
-            'uid': dialog.session.chat_id,
-            'test_id': self.test_id,
-            'created': time,
-            'is_user': True,
-            'text': message_text,
-            'state': state,
-            'type': message_type,
-            'entities': entities
-        })
+    """
+    Logs user messages, bot responses and errors to Elasticsearch.
+    Documents are indexed in bulk to time-partitioned indices, see get_index_name().
+    """
+
+    def log_user_message_start(self, message: ChatMessage, accepted_state):
+        pass
+
+    def log_user_message_end(self, message: ChatMessage, final_state):
+        self._index([self._user_message_doc(message, final_state)])
 
-    def log_bot_message(self, dialog, time: float, state, message):
-        from botshot.core.responses import TextMessage
-        type_ = type(message).__name__ if message else 'TextMessage'
-        response = json.loads(
-            json.dumps(message, default=lambda obj: obj.__dict__ if hasattr(obj, '__dict__') else str(obj)))
+    def log_state_change(self, message: ChatMessage, state):
+        pass
 
-        text = message.text if hasattr(message, 'text') else str(message)
+    def log_bot_response(self, message: ChatMessage, response: MessageElement, timestamp):
+        self._index([self._bot_response_doc(message, response, timestamp)])
 
-        self._log_message({
-            'uid': dialog.session.chat_id,
-            'test_id': self.test_id,
-            'created': time,
+    def log_error(self, message: ChatMessage, state, exception):
+        self._index([self._error_doc(message, state, exception)])
+
+    def log_batch(self, events: list):
+        docs, state = [], None
+        for method_name, message, kwargs in events:
+            if method_name == 'log_user_message_start':
+                state = kwargs['accepted_state']
+            elif method_name == 'log_state_change':
+                state = kwargs['state']
+            elif method_name == 'log_user_message_end':
+                docs.append(self._user_message_doc(message, kwargs['final_state']))
+            elif method_name == 'log_bot_response':
+                docs.append(self._bot_response_doc(message, kwargs['response'], kwargs['timestamp'], state))
+            elif method_name == 'log_error':
+                docs.append(self._error_doc(message, kwargs['state'], kwargs['exception']))
+        self._index(docs)
+
+    def _base_doc(self, message: ChatMessage, created):
+        return {
+            'conversation_id': message.conversation_id,
+            'user_id': message.user_id,
+            'message_id': message.message_id,
+            'created': created,
+        }
+
+    def _user_message_doc(self, message: ChatMessage, final_state):
+        doc = self._base_doc(message, message.time.timestamp() if message.time else time.time())
+        doc.update({
+            'is_user': True,
+            'text': message.text,
+            'state': final_state,
+            'type': message.type,
+            'entities': self._to_json(message.entities),
+        })
+        return doc
+
+    def _bot_response_doc(self, message: ChatMessage, response: MessageElement, timestamp, state=None):
+        doc = self._base_doc(message, timestamp)
+        doc.update({
             'is_user': False,
-            'text': text,
+            'text': getattr(response, 'text', None) or str(response),
             'state': state,
-            'type': type_,
-            'response': response,
+            'type': type(response).__name__,
+            'response': self._to_json(response),
         })
+        return doc
 
-    def log_error(self, dialog, state, exception):
-        self._log_message({
-            'uid': dialog.session.chat_id,
-            'test_id' : self.test_id,
-            'created': time.time(),
+    def _error_doc(self, message: ChatMessage, state, exception):
+        doc = self._base_doc(message, time.time())
+        doc.update({
             'is_user': False,
             'text': str(exception),
             'state': state,
-            'type': 'error'
+            'type': 'error',
         })
+        return doc
+
+    @staticmethod
+    def _to_json(obj):
+        return json.loads(json.dumps(json_serialize(obj), default=str))
 
-    def _log_message(self, message):
-        es = get_elastic()
-        if not es:
+    def _index(self, docs):
+        if not docs or get_elastic() is None:
             return
-        try:
-            print('Logging', message)
-            es.index(index="message-log", doc_type='message', body=message)
-        except Exception as e:
-            print('Unable to log message to Elasticsearch.')
-            print(e)
+        get_indexer().add([{'_index': get_index_name(doc['created']), '_source': doc} for doc in docs])
@@ -1,15 +1,38 @@
 import logging
+import pickle
+import threading
 from typing import List
+
+from celery.signals import worker_process_shutdown
+
+from botshot.core import config, metrics
 from botshot.core.logging import MessageLogger
+from botshot.core.logging.buffer import BatchBuffer
+from botshot.core.persistence import get_redis
 from botshot.core.responses import MessageElement
 from botshot.models import ChatMessage
-from botshot.tasks import run_async
+from botshot.tasks import celery_method_call_wrapper
+
+PENDING_KEY = "botshot_logging_pending"
+
+# events of messages waiting for LOGGING_BATCH_MESSAGES, shared by all services in this process
+_buffer = None
+_buffer_lock = threading.Lock()
 
 
 class AsyncLoggingService(MessageLogger):
+    """
+    Collects logging events of one processed message, they are sent to the loggers in one task on flush().
+
+    Events of LOGGING_BATCH_MESSAGES messages are sent together, by default each message has its own task.
+    Buffered events are also sent every LOGGING_FLUSH_SECONDS, so that a quiet worker doesn't keep them.
+    When LOGGING_MAX_PENDING batches are already waiting in the queue, new batches are dropped
+    and counted in the logging.dropped_batches and logging.dropped_events metrics.
+    """
 
     def __init__(self, loggers: List[MessageLogger]):
         self.loggers = loggers
+        self.events = []
 
     def log_user_message_start(self, message: ChatMessage, accepted_state):
         self._log_all('log_user_message_start', message=message, accepted_state=accepted_state)
@@ -24,12 +47,114 @@ class AsyncLoggingService(MessageLogger):
         self._log_all('log_bot_response', message=message, response=response, timestamp=timestamp)
 
     def log_error(self, message: ChatMessage, state, exception):
+        try:
+            pickle.dumps(exception)
+        except Exception:
+            # keep the rest of the batch serializable
+            exception = Exception(repr(exception))
         self._log_all('log_error', message=message, state=state, exception=exception)
 
-    def _log_all(self, method_name, **kwargs):
-        for logger in self.loggers:
+    def _log_all(self, method_name, message, **kwargs):
+        if self.loggers:
+            self.events.append((method_name, message, kwargs))
+
+    def flush(self):
+        """Sends the collected events to the loggers, call after the message is processed."""
+        events, self.events = self.events, []
+        if not events:
+            return
+        if config.get("LOGGING_BATCH_MESSAGES", 1) <= 1:
+            send_batches([(self.loggers, events)])
+        else:
+            get_buffer().add([(self.loggers, events)])
+
+
+class LoggingBuffer(BatchBuffer):
+    """Buffers (loggers, events) of processed messages, each batch is sent in one task."""
+
+    name = "logging.buffer"
+
+    def send_batch(self, batches: list):
+        send_batches(batches)
+
+
+def get_buffer() -> LoggingBuffer:
+    """Returns the logging buffer of this process."""
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = LoggingBuffer(
+                    batch_size=config.get("LOGGING_BATCH_MESSAGES", 1),
+                    flush_seconds=config.get("LOGGING_FLUSH_SECONDS", 5.0),
+                )
+    return _buffer
+
+
+@worker_process_shutdown.connect
+def flush_buffer(**kwargs):
+    """Sends events of all messages waiting in the buffer of this process."""
+    if _buffer is not None:
+        _buffer.flush()
+
+
+def send_batches(batches):
+    """
+    Sends logging batches in one task.
+    :param batches: list of (loggers, events) tuples
+    """
+    num_events = sum(len(events) for _, events in batches)
+    max_pending = config.get("LOGGING_MAX_PENDING", 1000)
+    redis = get_redis()
+    counted = redis is not None
+    if counted:
+        try:
+            pending = redis.incr(PENDING_KEY)
+        except Exception:
+            logging.exception("Unable to count pending logging batches")
+            counted, pending = False, 0
+        if counted and max_pending and pending > max_pending:
+            redis.decr(PENDING_KEY)
+            logging.warning("Logging queue is full, dropping %d events", num_events)
+            _count_dropped(num_events)
+            return
+    options = {}
+    if config.get("LOGGING_QUEUE"):
+        options['queue'] = config.get("LOGGING_QUEUE")
+    try:
+        celery_method_call_wrapper.apply_async(
+            args=(run_loggers, ), kwargs=dict(batches=batches, counted=counted), **options
+        )
+        metrics.counter("logging.sent_events").inc(num_events)
+    except Exception:
+        logging.exception("Error sending logging batch")
+        if counted:
+            redis.decr(PENDING_KEY)
+        _count_dropped(num_events)
+
+
+def run_loggers(batches, counted=False):
+    """Passes events of logging batches to their loggers, runs in the worker."""
+    if counted:
+        redis = get_redis()
+        if redis is not None:
+            redis.decr(PENDING_KEY)
+    for loggers, events in batches:
+        for logger in loggers:
             try:
-                run_async(getattr(logger, method_name), **kwargs)
-            except:
-                logging.error("Logger: {}, Args: {}".format(logger, kwargs))
-                logging.exception('Error serializing logging task "{}" for logger "{}"'.format(method_name, logger))
+                logger.log_batch(events)
+            except Exception:
+                logging.exception('Error in logger "{}"'.format(logger))
+
+
+def get_pending_batches() -> int:
+    """Returns the number of logging batches waiting in the queue."""
+    redis = get_redis()
+    if redis is None:
+        return 0
+    return max(int(redis.get(PENDING_KEY) or 0), 0)
+
+
+def _count_dropped(num_events):
+    metrics.counter("logging.dropped_batches").inc()
+    metrics.counter("logging.dropped_events").inc(num_events)
@@ -1,9 +1,9 @@
 import logging
 from typing import Optional
 from django.conf import settings
-from botshot.core.context import Context
+from botshot.core.context_store import get_context_store
 from botshot.core.dialog import Dialog
-from botshot.core.flow import Flow, State, get_flows
+from botshot.core.flow import Flow, State, get_flows, get_router
 from botshot.core.logging.test_recorder import ConversationTestRecorder
 from botshot.core.responses import TextMessage
 from botshot.core import config
@@ -28,8 +28,9 @@ class MessageProcessor:
         self.chat_manager = chat_manager
         self.send_exceptions = config.get("SEND_EXCEPTIONS", default=settings.DEBUG)
         self.flows = flows
+        self._router = None
         self.current_state_name = self.message.conversation.state or 'default.root'
-        self.context = Context.load(data=message.conversation.context_dict or {})
+        self.context = get_context_store().load(message.conversation)
         loggers = [import_string(path)() for path in config.get('MESSAGE_LOGGERS', default=[])]
         self.logging_service = AsyncLoggingService(loggers)
         self.dialog = Dialog(message=self.message, context=self.context, chat_manager=self.chat_manager, logging_service=self.logging_service)
@@ -125,16 +126,16 @@ class MessageProcessor:
 
         # move to the flow whose 'intent' field matches intent
 
+        router = self.get_router()
+
         # Check accepted intent of the current flow's states
-        flow = self.get_flow()
-        new_state_name = flow.get_state_for_intent(intent)
+        new_state_name = router.get_state_for_intent(self.get_flow().name, intent)
 
         # Check accepted intent of all flows
         if not new_state_name:
-            for flow in self.flows.values():
-                if flow.matches_intent(intent):
-                    new_state_name = flow.name + '.root'
-                    break
+            flow = router.get_flow_for_intent(intent)
+            if flow:
+                new_state_name = flow.name + '.root'
 
         if not new_state_name:
             logging.error('Error! Found intent "%s" but no flow present for it!' % intent)
@@ -157,10 +158,9 @@ class MessageProcessor:
         new_state_name = None
 
         # then check if there is a flow that would accept the entity
-        for flow in self.flows.values():
-            if flow.accepts_message(entities.keys()):
-                new_state_name = flow.name + '.root'  # TODO might use a state that accepts it instead?
-                break
+        flow = self.get_router().get_flow_for_entities(entities.keys())
+        if flow:
+            new_state_name = flow.name + '.root'  # TODO might use a state that accepts it instead?
 
         if new_state_name:
             logging.info("Moving by entity")
@@ -168,6 +168,12 @@ class MessageProcessor:
 
         return False
 
+    def get_router(self):
+        """Returns the routing index of flows, cached until the flows change."""
+        if self._router is None or not self._router.is_current(self.flows):
+            self._router = get_router(self.flows)
+        return self._router
+
     def get_flow(self, flow_name=None) -> Flow:
         """Returns a Flow object by its name. Defaults to current flow."""
         if not flow_name:
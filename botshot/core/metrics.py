@@ -0,0 +1,83 @@
+import bisect
+import threading
+
+# upper bounds of latency histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+class Counter:
+    """A thread-safe counter that only goes up."""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """A thread-safe histogram of observed values, for example request latencies in seconds."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'buckets': dict(zip(self.buckets + (float('inf'),), self.counts)),
+            }
+
+
+def counter(name) -> Counter:
+    """Returns the counter with the given name, creating it on first use."""
+    with _lock:
+        if name not in _counters:
+            _counters[name] = Counter()
+        return _counters[name]
+
+
+def histogram(name, buckets=DEFAULT_BUCKETS) -> Histogram:
+    """Returns the histogram with the given name, creating it on first use."""
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram(buckets)
+        return _histograms[name]
+
+
+def get_metrics():
+    """Returns a snapshot of all metrics of this process."""
+    with _lock:
+        counters, histograms = dict(_counters), dict(_histograms)
+    return {
+        'counters': {name: c.snapshot() for name, c in counters.items()},
+        'histograms': {name: h.snapshot() for name, h in histograms.items()},
+    }
+
+
+def reset():
+    """Removes all metrics, used in tests."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
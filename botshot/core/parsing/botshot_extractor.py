@@ -1,9 +1,10 @@
 import logging
 
-import requests
 from django.conf import settings
 
+from botshot.core import http
 from botshot.core.parsing.entity_extractor import EntityExtractor
+from botshot.core.persistence import json_deserialize
 from requests import HTTPError
 
 
@@ -14,6 +15,10 @@ class BotshotRemoteNLU(EntityExtractor):
         self.url = settings.BOT_CONFIG.get("REMOTE_NLU_URL")
         if not self.url:
             logging.error("Remote NLU URL not provided. NLU will not work.")
+        self.language = "en_US"
+
+    def get_locale(self):
+        return self.language
 
     def extract_entities(self, text: str, max_retries=1):
         for i in range(max_retries):
@@ -25,28 +30,40 @@ class BotshotRemoteNLU(EntityExtractor):
     def _parse_request(self, text):
         payload = {
             "text": text,
-            "lang": "en_US",
+            "lang": self.language,
         }
-        resp = requests.get(self.url + '/parse', params=payload)
+        resp = http.get(self.url + '/parse', endpoint="botshot_nlu.parse", params=payload, timeout=self.get_timeout())
         resp.raise_for_status()
-        return resp.json()
+        return json_deserialize(resp.json())
 
 
 class BotshotExtractor(EntityExtractor):
 
+    # the model is loaded in the first call if it wasn't warmed up
+    timeout = 30.0
+
     def __init__(self):
         super().__init__()
         self.nlu = None
 
-    def extract_entities(self, text: str, max_retries=1):
+    def warm_up(self):
         if not self.nlu:
             from botshot.nlu.predict import BotshotNLU
             self.nlu = BotshotNLU.load()
             global BOTSHOT_NLU
             BOTSHOT_NLU = self.nlu
 
-        # TODO use a separate thread (pool) to remove TF memory overhead
+    def extract_entities(self, text: str, max_retries=1):
+        self.warm_up()
+
+        # to load the model only once per host, run it in the nlu_server command and use BotshotRemoteNLU
         return self.nlu.parse(text)
 
+    def extract_entities_batch(self, texts: list):
+        self.warm_up()
+        if hasattr(self.nlu, 'parse_batch'):
+            return self.nlu.parse_batch(texts)
+        return [self.nlu.parse(text) for text in texts]
+
 
 BOTSHOT_NLU = None
@@ -1,7 +1,7 @@
 import json
 import logging
 
-import requests
+from botshot.core import http
 from django.conf import settings
 
 from botshot.core.parsing import date_utils
@@ -17,6 +17,9 @@ class DucklingExtractor(EntityExtractor):
         if not self.duckling_url:
             raise ValueError("Duckling URL not set! Please set it as settings.BOT_CONFIG['DUCKLING_URL'].")
 
+    def get_locale(self):
+        return self.language
+
     def extract_entities(self, text: str, max_retries=1):
         """
         Makes a duckling request for text entities.
@@ -28,7 +31,8 @@ class DucklingExtractor(EntityExtractor):
             'text': text
         }
         try:
-            resp = requests.post(self.duckling_url + "/parse", data=payload)
+            resp = http.post(self.duckling_url + "/parse", endpoint="duckling.parse", data=payload,
+                             timeout=self.get_timeout())
             if resp.status_code == 200:
                 jsn = resp.json()
                 logging.info('Duckling:', jsn)
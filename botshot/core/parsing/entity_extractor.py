@@ -1,5 +1,13 @@
 from abc import ABC, abstractmethod
 
+from botshot.core import config
+from botshot.core.parsing import nlu_cache
+
+# entities describing how a message was parsed, they are saved with the message but not added to context
+TIMEOUTS_ENTITY = '_extractor_timeouts'
+ERRORS_ENTITY = '_extractor_errors'
+METADATA_ENTITIES = (TIMEOUTS_ENTITY, ERRORS_ENTITY)
+
 
 class EntityExtractor(ABC):
     """
@@ -7,9 +15,70 @@ class EntityExtractor(ABC):
     Responsible for processing text and extracting entities such as names, dates, places etc.
     """
 
+    # default timeout in seconds, overridden by BOT_CONFIG.NLU_EXTRACTOR_TIMEOUT(S)
+    timeout = 5.0
+    # whether results are cached, see botshot.core.parsing.nlu_cache
+    cache_enabled = True
+    # change to invalidate cached results, for example when the model is retrained
+    model_version = "1"
+    # entities computed relative to the current time, results containing them are cached only shortly
+    time_relative_entities = ('date_interval', 'datetime', 'duration')
+
     def __init__(self):
         pass
 
+    def get_timeout(self) -> float:
+        """Returns how many seconds to wait for this extractor, configured by its class name or globally."""
+        timeouts = config.get("NLU_EXTRACTOR_TIMEOUTS", {})
+        cls = type(self)
+        for name in [cls.__module__ + "." + cls.__name__, cls.__name__]:
+            if name in timeouts:
+                return timeouts[name]
+        return config.get("NLU_EXTRACTOR_TIMEOUT", self.timeout)
+
+    def get_locale(self):
+        """Returns the locale of extracted texts, it's a part of cache keys."""
+        return None
+
+    def get_model_version(self) -> str:
+        """Returns the version of the model, configured by class name in NLU_MODEL_VERSIONS or the model_version attribute."""
+        versions = config.get("NLU_MODEL_VERSIONS", {})
+        cls = type(self)
+        for name in [cls.__module__ + "." + cls.__name__, cls.__name__]:
+            if name in versions:
+                return str(versions[name])
+        return str(self.model_version)
+
+    def extract(self, text: str) -> dict:
+        """Extracts entities from text using cached results, see extract_entities()."""
+        if not self.cache_enabled or not config.get("NLU_CACHE", True) or not text:
+            return self.extract_entities(text)
+        name = type(self).__name__
+        key = nlu_cache.get_key(name, self.get_model_version(), self.get_locale(), text)
+        entities = nlu_cache.get(name, key)
+        if entities is not None:
+            return entities
+        entities = self.extract_entities(text)
+        if entities:
+            if nlu_cache.is_time_relative(entities, self.time_relative_entities):
+                ttl = config.get("NLU_CACHE_TIME_RELATIVE_TTL", 0)
+            else:
+                ttl = config.get("NLU_CACHE_TTL", 3600 * 24 * 7)
+            nlu_cache.put(name, key, entities, ttl)
+        return entities
+
+    def extract_entities_batch(self, texts: list) -> list:
+        """Extracts entities from a list of texts, override if the model can parse them together."""
+        return [self.extract_entities(text) for text in texts]
+
+    def clear_cache(self):
+        """Removes cached results of this extractor."""
+        nlu_cache.clear(type(self).__name__)
+
+    def warm_up(self):
+        """Called when the extractor is registered, override to load models before the first message."""
+        pass
+
     @abstractmethod
     def extract_entities(self, text: str, max_retries=5):
         """
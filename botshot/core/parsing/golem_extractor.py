@@ -3,19 +3,31 @@ from botshot.core.parsing.entity_extractor import EntityExtractor
 
 class GolemExtractor(EntityExtractor):
 
+    # the model is loaded in the first call if it wasn't warmed up
+    timeout = 30.0
+
     def __init__(self):
         super().__init__()
         self.nlu = None
 
-    def extract_entities(self, text: str, max_retries=1):
+    def warm_up(self):
         if not self.nlu:
             from botshot.nlu.predict import GolemNLU
             self.nlu = GolemNLU()
             global GOLEM_NLU
             GOLEM_NLU = self.nlu
 
-        # TODO use a separate thread (pool) to remove TF memory overhead
+    def extract_entities(self, text: str, max_retries=1):
+        self.warm_up()
+
+        # to load the model only once per host, run it in the nlu_server command and use BotshotRemoteNLU
         return self.nlu.parse(text)
 
+    def extract_entities_batch(self, texts: list):
+        self.warm_up()
+        if hasattr(self.nlu, 'parse_batch'):
+            return self.nlu.parse_batch(texts)
+        return [self.nlu.parse(text) for text in texts]
+
 
 GOLEM_NLU = None
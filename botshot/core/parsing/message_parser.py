@@ -1,28 +1,39 @@
 import logging
 import emoji
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from django.conf import settings
-from botshot.core.parsing.entity_extractor import EntityExtractor
+from botshot.core.parsing.entity_extractor import EntityExtractor, TIMEOUTS_ENTITY, ERRORS_ENTITY
 from django.utils.module_loading import import_string
 
 ENTITY_EXTRACTORS = []
+_executor = None
 
 def register_extractor(extractor):
     """Registers an entity extractor class."""
     if isinstance(extractor, str):
         cls = import_string(extractor)
         logging.info("Registering entity extractor %s", cls)
-        ENTITY_EXTRACTORS.append(cls())
+        ENTITY_EXTRACTORS.append(_warm_up(cls()))
     elif issubclass(extractor, EntityExtractor):
         logging.info("Registering entity extractor %s", extractor)
-        ENTITY_EXTRACTORS.append(extractor())
+        ENTITY_EXTRACTORS.append(_warm_up(extractor()))
     elif isinstance(extractor, EntityExtractor):
         raise ValueError("Error: Please register entity extractor class instead of instance.")
     else:
         raise ValueError("Error: Entity extractor must be a subclass of botshot.core.parsing.entity_extractor.EntityExtractor")
 
 
+def _warm_up(extractor):
+    try:
+        extractor.warm_up()
+    except Exception:
+        logging.exception("Error warming up entity extractor %s", type(extractor).__name__)
+    return extractor
+
+
 for classname in settings.BOT_CONFIG.get("ENTITY_EXTRACTORS", []):
     register_extractor(classname)
 
@@ -38,16 +49,76 @@ def add_default_extractors():
 add_default_extractors()
 
 
+def _get_executor():
+    global _executor
+    if _executor is None:
+        max_workers = settings.BOT_CONFIG.get("NLU_MAX_WORKERS", 4 * max(len(ENTITY_EXTRACTORS), 1))
+        _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='botshot_nlu')
+    return _executor
+
+
+class _ExtractorTask:
+    """Runs an extractor in the pool and remembers when it started, the timeout counts from then."""
+
+    def __init__(self, extractor, text):
+        self.extractor = extractor
+        self.text = text
+        self.started = threading.Event()
+        self.start_time = None
+
+    def __call__(self):
+        self.start_time = time.time()
+        self.started.set()
+        return self.extractor.extract(self.text)
+
+
+def run_extractors(text, extractors):
+    """
+    Runs entity extractors concurrently, each one with its own timeout.
+    The timeout counts from when the extractor starts, time spent waiting for a free thread
+    is limited by the same timeout. Results of extractors that fail or don't finish in time are left out.
+
+    :returns: tuple (list of extracted entity dicts in order of extractors,
+                     list of extractors that timed out, list of extractors that failed)
+    """
+    executor = _get_executor()
+    tasks = [_ExtractorTask(extractor, text) for extractor in extractors]
+    futures = [executor.submit(task) for task in tasks]
+    results, timed_out, failed = [], [], []
+    for task, future in zip(tasks, futures):
+        name = type(task.extractor).__name__
+        timeout = task.extractor.get_timeout()
+        try:
+            if not task.started.wait(timeout):
+                raise TimeoutError()
+            remaining = task.start_time + timeout - time.time()
+            results.append(future.result(timeout=max(remaining, 0)) or {})
+        except TimeoutError:
+            # only cancels extractors that didn't start yet, running ones stop at their request timeout
+            future.cancel()
+            logging.warning("Entity extractor %s timed out, skipping", name)
+            timed_out.append(task.extractor)
+        except Exception:
+            logging.exception("Error in entity extractor %s", name)
+            failed.append(task.extractor)
+    return results, timed_out, failed
+
+
 def parse_text_entities(text, num_tries=1):
     entities = {}
 
     if len(ENTITY_EXTRACTORS) <= 0:
         logging.warning('No entity extractors configured!')
     else:
-        for extractor in ENTITY_EXTRACTORS:
-            append = extractor.extract_entities(text)
+        results, timed_out, failed = run_extractors(text, ENTITY_EXTRACTORS)
+        for append in results:
             for entity, values in append.items():
                 entities.setdefault(entity, []).extend(values)
+        # saved with the message, not added to context
+        if timed_out:
+            entities[TIMEOUTS_ENTITY] = [{'value': type(extractor).__name__} for extractor in timed_out]
+        if failed:
+            entities[ERRORS_ENTITY] = [{'value': type(extractor).__name__} for extractor in failed]
 
     append = parse_special_text_entities(text)
 
@@ -0,0 +1,137 @@
+"""
+Cache of entity extractor results, shared by all EntityExtractor implementations.
+
+Results are cached in two levels: an LRU dict in each process, in front of Redis keys shared by all workers.
+Keys contain the extractor name, its model version and locale, and a hash of the normalized text,
+so changing the version of a model invalidates its cached results.
+
+Entities such as date_interval are computed relative to the time of the message. Results containing them
+are cached for at most NLU_CACHE_TIME_RELATIVE_TTL seconds (by default not at all).
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from botshot.core import config, metrics
+from botshot.core.persistence import get_redis, json_serialize, json_deserialize, pipelined
+
+KEY_PREFIX = "botshot_nlu_"
+INDEX_PREFIX = "botshot_nlu_index_"
+
+# stores a result and evicts the oldest keys of the extractor above the maximum size
+_STORE = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[5]))
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local evicted = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+    redis.call('DEL', unpack(evicted))
+end
+"""
+
+_lru = OrderedDict()
+_lru_lock = threading.Lock()
+
+
+def normalize_text(text: str) -> str:
+    """Returns the text as it's used in cache keys, in NFC form and with whitespace collapsed."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def get_key(name, version, locale, text) -> str:
+    digest = hashlib.sha1("{}\n{}".format(locale or "", normalize_text(text)).encode("utf-8")).hexdigest()
+    return "{}{}_{}_{}".format(KEY_PREFIX, name, version, digest)
+
+
+def is_time_relative(entities: dict, time_relative_entities) -> bool:
+    return any(entities.get(entity) for entity in time_relative_entities)
+
+
+def get(name, key):
+    """Returns cached entities of a key, or None. Counts a hit or miss of the extractor."""
+    now = time.time()
+    with _lru_lock:
+        cached = _lru.get(key)
+        if cached is not None:
+            if cached[0] > now:
+                _lru.move_to_end(key)
+            else:
+                del _lru[key]
+                cached = None
+    if cached is not None:
+        metrics.counter("nlu_cache.{}.hits".format(name)).inc()
+        return _load(cached[1])
+    redis = get_redis()
+    data, ttl = None, None
+    if redis is not None:
+        try:
+            data, ttl = pipelined([('get', key), ('ttl', key)], client=redis, transaction=False)
+        except Exception:
+            logging.exception("Unable to read NLU cache")
+    if data is None:
+        metrics.counter("nlu_cache.{}.misses".format(name)).inc()
+        return None
+    metrics.counter("nlu_cache.{}.hits".format(name)).inc()
+    data = data.decode("utf-8") if isinstance(data, bytes) else data
+    if ttl and ttl > 0:
+        _remember(key, data, ttl)
+    return _load(data)
+
+
+def put(name, key, entities: dict, ttl):
+    """Caches entities of a key in this process and in Redis for ttl seconds."""
+    if not ttl or ttl <= 0:
+        return
+    data = json.dumps(json_serialize(entities))
+    _remember(key, data, ttl)
+    redis = get_redis()
+    if redis is None:
+        return
+    max_entries = config.get("NLU_CACHE_MAX_ENTRIES", 100000)
+    try:
+        redis.eval(_STORE, 2, key, INDEX_PREFIX + name, data, int(ttl), time.time(), max_entries,
+                   int(config.get("NLU_CACHE_TTL", 3600 * 24 * 7)))
+    except Exception:
+        logging.exception("Unable to write NLU cache")
+
+
+def clear(name=None):
+    """Removes cached results of an extractor, or of all extractors."""
+    with _lru_lock:
+        if name is None:
+            _lru.clear()
+        else:
+            for key in [k for k in _lru if k.startswith("{}{}_".format(KEY_PREFIX, name))]:
+                del _lru[key]
+    redis = get_redis()
+    if redis is None:
+        return
+    pattern = INDEX_PREFIX + (name if name is not None else "*")
+    for index in redis.scan_iter(match=pattern):
+        keys = redis.zrange(index, 0, -1)
+        if keys:
+            redis.delete(*keys)
+        redis.delete(index)
+
+
+def _remember(key, data, ttl):
+    max_size = config.get("NLU_CACHE_LRU_SIZE", 10000)
+    if max_size <= 0:
+        return
+    with _lru_lock:
+        _lru[key] = (time.time() + ttl, data)
+        _lru.move_to_end(key)
+        while len(_lru) > max_size:
+            _lru.popitem(last=False)
+
+
+def _load(data):
+    # each call gets its own copy, extracted entities are modified when they are processed
+    return json_deserialize(json.loads(data))
@@ -0,0 +1,150 @@
+"""
+A local server running one entity extractor for all workers of a host.
+
+Local models such as BotshotExtractor are otherwise loaded into the memory of every worker process.
+The server loads the model once, and requests received at the same time are parsed together
+in micro-batches of at most max_batch_size texts, waiting at most max_wait seconds for a batch to fill.
+Workers use it through BotshotRemoteNLU, with REMOTE_NLU_URL set to the address of the server.
+
+Run it with ``python manage.py nlu_server``.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+from botshot.core import metrics
+from botshot.core.persistence import json_serialize
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class MicroBatcher:
+    """Collects texts submitted from many threads and passes them to a batch function in one thread."""
+
+    def __init__(self, batch_fn, max_batch_size=32, max_wait=0.005):
+        """
+        :param batch_fn:        function taking a list of texts and returning a list of results in the same order
+        :param max_batch_size:  maximum number of texts in a batch
+        :param max_wait:        seconds to wait for more texts after the first text of a batch is received
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="nlu-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self.queue.put((text, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _next_batch(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                # finish this batch, then stop
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            texts = [text for text, _ in batch]
+            start = time.time()
+            try:
+                results = self._parse(texts)
+            except Exception:
+                logging.exception("Error parsing a batch of %d texts, parsing them one by one", len(texts))
+                metrics.counter("nlu_server.failed_batches").inc()
+                self._run_one_by_one(batch)
+                continue
+            finally:
+                metrics.histogram("nlu_server.batch_size", buckets=BATCH_SIZE_BUCKETS).observe(len(texts))
+                metrics.histogram("nlu_server.batch_latency").observe(time.time() - start)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def _parse(self, texts):
+        results = self.batch_fn(texts)
+        if len(results) != len(texts):
+            raise ValueError("Expected {} results, got {}".format(len(texts), len(results)))
+        return results
+
+    def _run_one_by_one(self, batch):
+        """Parses texts of a failed batch separately, so that one bad text fails only its own request."""
+        for text, future in batch:
+            try:
+                result = self._parse([text])[0]
+            except Exception as e:
+                logging.exception("Error parsing text: %s", text)
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keeps connections of the workers' HTTP sessions open
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            return self._respond(200, {'status': 'ok'})
+        if url.path != '/parse':
+            return self._respond(404, {'error': 'not found'})
+        text = parse_qs(url.query).get('text', [''])[0]
+        try:
+            entities = self.server.batcher.submit(text).result(timeout=self.server.timeout_seconds)
+        except Exception as e:
+            return self._respond(500, {'error': str(e)})
+        self._respond(200, json_serialize(entities or {}))
+
+    def _respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug("NLU server: " + format, *args)
+
+
+def make_server(extractor, host='127.0.0.1', port=8800, max_batch_size=32, max_wait=0.005, timeout=30.0):
+    """
+    Returns an HTTP server parsing texts with an extractor, call serve_forever() to run it.
+    The API is the same as of the Botshot NLU service: GET /parse?text=... returns a dict of entities.
+    """
+    extractor.warm_up()
+    server = _ThreadingHTTPServer((host, port), _Handler)
+    server.batcher = MicroBatcher(extractor.extract_entities_batch, max_batch_size, max_wait)
+    server.timeout_seconds = timeout
+    return server
@@ -1,14 +1,12 @@
 import json
 import logging
-import pickle
 
 from django.conf import settings
-from wit import Wit
-from wit.wit import WitError
+from wit.wit import WitError, WIT_API_HOST, WIT_API_VERSION
 
+from botshot.core import http
 from botshot.core.parsing import date_utils
 from botshot.core.parsing.entity_extractor import EntityExtractor
-from botshot.core.persistence import get_redis
 
 
 class WitExtractor(EntityExtractor):
@@ -19,26 +17,34 @@ class WitExtractor(EntityExtractor):
         self.wit_token = settings.BOT_CONFIG.get('WIT_TOKEN')
         if not self.wit_token:
             raise ValueError("Wit token not set! Please set it as settings.BOT_CONFIG['WIT_TOKEN'].")
-        self.cache_key = 'wit_cache'
-        self.cache = settings.BOT_CONFIG.get('WIT_ENABLE_CACHE', True)
-        # self.clear_wit_cache()
+        self.cache_enabled = settings.BOT_CONFIG.get('WIT_ENABLE_CACHE', True)
 
     def extract_entities(self, text: str, max_retries=5):
         if max_retries <= 0:
             self.log.error("Maximal number of Wit retries reached")
             return {}
-        cached = self._load_from_cache(text)
-        if cached: return cached
         try:
-            wit_client = Wit(access_token=self.wit_token, actions={})
-            entities = wit_client.message(text).get('entities', {})
-            entities = self._process_wit_entities(entities)
-            self.save_to_cache(text, entities)
-            return entities
+            entities = self._message(text).get('entities', {})
+            return self._process_wit_entities(entities)
         except WitError:
             self.log.exception('Wit error:')
             return self.extract_entities(text, max_retries - 1)
 
+    def _message(self, text):
+        """Calls the Wit /message endpoint using the shared HTTP session."""
+        headers = {
+            'authorization': 'Bearer ' + self.wit_token,
+            'accept': 'application/vnd.wit.' + WIT_API_VERSION + '+json'
+        }
+        rsp = http.get(WIT_API_HOST + '/message', endpoint="wit.message", headers=headers, params={'q': text},
+                       timeout=self.get_timeout())
+        if rsp.status_code > 200:
+            raise WitError('Wit responded with status: ' + str(rsp.status_code) + ' (' + rsp.reason + ')')
+        json = rsp.json()
+        if 'error' in json:
+            raise WitError('Wit responded with an error: ' + json['error'])
+        return json
+
     def _process_wit_entities(self, entities: dict):
 
         entities = self._process_metadata(entities)
@@ -66,36 +72,14 @@ class WitExtractor(EntityExtractor):
                         value['metadata'] = None
         return entities
 
-    def _load_from_cache(self, text):
-        if self.cache:
-            db = get_redis()
-            if db.hexists('wit_cache', text):
-                parsed = pickle.loads(db.hget('wit_cache', text))
-                self.log.debug('Got cached wit key: "{}" = {}'.format(self.cache_key, parsed))
-                return parsed
-        return None
-
-    def save_to_cache(self, text, entities):
-        if self.cache and 'date_interval' not in entities:
-            db = get_redis()
-            self.log.debug('Caching wit key: {} = {}'.format(text, entities))
-            db.hset('wit_cache', text, pickle.dumps(entities))
-
-    def clear_wit_cache(self):
-        if self.cache:
-            self.log.debug('Clearing Wit cache...')
-            db = get_redis()
-            db.delete('wit_cache')
-
 
 def teach_wit(wit_token, entity, values, doc=""):
-    import requests
     logging.warning('*** TEACHING WIT ***')
     params = {'v':'20160526'}
     logging.warning('Inserting values of {}'.format(entity))
-    rsp = requests.request(
-        'PUT',
+    rsp = http.put(
         'https://api.wit.ai/entities/'+entity,
+        endpoint="wit.entities",
         headers={
             'authorization': 'Bearer ' + wit_token,
             'accept': 'application/json'
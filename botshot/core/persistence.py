@@ -1,20 +1,33 @@
 import logging
+import os
+import threading
+import time
 import warnings
 
 import redis
 import pickle
 import dateutil.parser
-from urllib.parse import urlparse
-from base64 import b64encode, b64decode
+from datetime import datetime
+from base64 import b64decode
 
 from django.conf import settings
 from django.utils.module_loading import import_string
 
-from botshot.core import config
+from botshot.core import config, metrics
 from botshot.core.entity_value import EntityValue
 
-_connection_pool = None
 _redis = None
+_redis_pid = None
+_pubsub_redis = None
+_pubsub_redis_pid = None
+_redis_lock = threading.Lock()
+
+# upper bounds of the connection wait histogram buckets in seconds
+CONNECTION_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Version of the inline JSON schema used to store EntityValue objects.
+# Version 1 was a base64-encoded pickle under the "__data__" key, it is still readable.
+ENTITY_SCHEMA_VERSION = 2
 
 
 class DictSerializable:
@@ -29,31 +42,116 @@ class DictSerializable:
     pass
 
 
+class _TimedPoolMixin:
+    """Records how long callers wait for a connection from the pool in the redis.connection_wait metric."""
+
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().get_connection(*args, **kwargs)
+        except redis.ConnectionError:
+            metrics.counter("redis.connection_errors").inc()
+            raise
+        finally:
+            metrics.histogram("redis.connection_wait", buckets=CONNECTION_WAIT_BUCKETS).observe(
+                time.perf_counter() - start
+            )
+
+
+class TimedConnectionPool(_TimedPoolMixin, redis.ConnectionPool):
+    pass
+
+
+class TimedBlockingConnectionPool(_TimedPoolMixin, redis.BlockingConnectionPool):
+    pass
+
+
+def _create_connection_pool(pool_class=None, max_connections=None):
+    redis_url = config.get('REDIS_URL')
+    redis_config = config.get('REDIS')
+    if not redis_url and not redis_config:
+        return None
+    if pool_class is None:
+        pool_class = TimedBlockingConnectionPool if config.get('REDIS_BLOCKING_POOL', True) else TimedConnectionPool
+    blocking = issubclass(pool_class, redis.BlockingConnectionPool)
+    options = dict(
+        max_connections=max_connections or config.get('REDIS_MAX_CONNECTIONS', 50),
+        socket_timeout=config.get('REDIS_SOCKET_TIMEOUT', 5),
+        socket_connect_timeout=config.get('REDIS_CONNECT_TIMEOUT', 5),
+        health_check_interval=config.get('REDIS_HEALTH_CHECK_INTERVAL', 30),
+        retry_on_timeout=True,
+    )
+    if blocking:
+        options['timeout'] = config.get('REDIS_POOL_TIMEOUT', 5)
+    if redis_url:
+        # the URL can set the db index (redis://host:6379/1) and TLS (rediss://)
+        return pool_class.from_url(redis_url, **options)
+    if redis_config.get('SSL'):
+        options['connection_class'] = redis.SSLConnection
+    return pool_class(
+        host=redis_config.get('HOST', 'localhost'),
+        port=redis_config.get('PORT', 6379),
+        password=redis_config.get('PASSWORD'),
+        db=redis_config.get('DB', 0),
+        **options
+    )
+
+
 def get_redis():
     """
-    Returns an instance of Redis cache, or None if Redis is not configured. 
-    """
-    global _connection_pool
-    global _redis
-    if not _connection_pool:
-        redis_url = config.get('REDIS_URL')
-        if not redis_url:
-            warnings.warn("Redis not available, returning None. Set REDIS_URL in BOT_CONFIG to enable cache.")
-            return None
-        redis_url_parsed = urlparse(redis_url)
-
-        _connection_pool = redis.ConnectionPool(
-            host=redis_url_parsed.hostname,
-            port=redis_url_parsed.port,
-            password=redis_url_parsed.password,
-            db=0,
-            max_connections=2
-        )
-    if not _redis:
-        _redis = redis.StrictRedis(connection_pool=_connection_pool)
+    Returns the Redis client of this process, or None if Redis is not configured.
+    Redis is configured by REDIS_URL or the REDIS dict, each process has its own connection pool.
+    """
+    global _redis, _redis_pid
+    pid = os.getpid()
+    if _redis is None or _redis_pid != pid:
+        with _redis_lock:
+            if _redis is None or _redis_pid != pid:
+                pool = _create_connection_pool()
+                if pool is None:
+                    warnings.warn("Redis not available, returning None. Set REDIS_URL in BOT_CONFIG to enable cache.")
+                    return None
+                _redis = redis.StrictRedis(connection_pool=pool)
+                _redis_pid = pid
     return _redis
 
 
+def get_pubsub_redis():
+    """
+    Returns a Redis client of this process for long-lived subscriptions, or None if Redis is not configured.
+    It has its own connection pool, so that idle subscribers never take connections of get_redis().
+    """
+    global _pubsub_redis, _pubsub_redis_pid
+    pid = os.getpid()
+    if _pubsub_redis is None or _pubsub_redis_pid != pid:
+        with _redis_lock:
+            if _pubsub_redis is None or _pubsub_redis_pid != pid:
+                pool = _create_connection_pool(
+                    pool_class=redis.ConnectionPool,
+                    max_connections=config.get('REDIS_PUBSUB_MAX_CONNECTIONS', 1000)
+                )
+                if pool is None:
+                    return None
+                _pubsub_redis = redis.StrictRedis(connection_pool=pool)
+                _pubsub_redis_pid = pid
+    return _pubsub_redis
+
+
+def pipelined(commands, client=None, transaction=True) -> list:
+    """
+    Sends several Redis commands in one round trip.
+
+    :param commands:     list of tuples (method name, *args), for example [('incr', key), ('expire', key, 60)]
+    :param client:       Redis client, by default get_redis()
+    :param transaction:  whether to run the commands atomically in MULTI/EXEC
+    :returns: list of results of the commands
+    """
+    pipe = (client or get_redis()).pipeline(transaction=transaction)
+    for name, *args in commands:
+        getattr(pipe, name)(*args)
+    return pipe.execute()
+
+
 def fullname(o):
     module = o.__class__.__module__
     if module is None or module == str.__class__.__module__:
@@ -81,8 +179,12 @@ def json_deserialize(obj):
         if obj_type == 'datetime':
             return dateutil.parser.parse(obj.get('value'))
         elif obj_type == 'entity':
-            bytearr = str.encode(obj.get("__data__"))
-            return pickle.loads(b64decode(bytearr))
+            if '__data__' in obj:  # legacy pickled entity, rewritten in the new schema on next save
+                bytearr = str.encode(obj.get("__data__"))
+                return pickle.loads(b64decode(bytearr))
+            return _deserialize_entity(obj)
+        elif obj_type == 'tuple':
+            return tuple(json_deserialize(item) for item in obj.get('items', []))
         data = {}
         for k, v in obj.items():
             if not k.startswith("__"):
@@ -106,9 +208,9 @@ def json_serialize(obj):
     :return: The JSON representation. Should be saved with json.dumps().
     """
     try:
-        from datetime import datetime
-        # from botshot.core.entities import Entity
-        if isinstance(obj, dict):
+        if obj is None or isinstance(obj, (str, int, float)):
+            return obj
+        elif isinstance(obj, dict):
             data = {}
             for k, v in obj.items():
                 data[k] = json_serialize(v)
@@ -118,8 +220,7 @@ def json_serialize(obj):
         if isinstance(obj, datetime):
             return {'__type__': 'datetime', 'value': obj.isoformat()}
         elif isinstance(obj, EntityValue):
-            data = b64encode(pickle.dumps(obj))
-            return {"__data__": data.decode('utf8'), '__type__': 'entity'}
+            return _serialize_entity(obj)
         elif isinstance(obj, DictSerializable):
             data = {}
             for k, v in obj.__dict__.items():
@@ -131,3 +232,54 @@ def json_serialize(obj):
     except Exception:
         logging.exception("Error serializing object: %s" % obj)
         return None
+
+
+def _serialize_entity(entity: EntityValue) -> dict:
+    """
+    Serializes an EntityValue to a flat JSON dict.
+    Value and role are only stored when they differ from the ones in raw parser output.
+    """
+    data = {
+        '__type__': 'entity',
+        'version': ENTITY_SCHEMA_VERSION,
+        'name': entity.name,
+        'counter': entity.counter,
+        'timestamp': float(entity.timestamp),
+    }
+    if entity.state_set:
+        data['state_set'] = entity.state_set
+    if entity.raw:
+        data['raw'] = json_serialize(entity.raw)
+    if entity.value != entity.raw.get('value'):
+        value = entity.value
+        if isinstance(value, tuple):
+            data['value'] = {'__type__': 'tuple', 'items': json_serialize(value)}
+        else:
+            data['value'] = json_serialize(value)
+    if entity.role != entity.raw.get('role'):
+        data['role'] = entity.role
+    return data
+
+
+def _deserialize_entity(obj: dict) -> EntityValue:
+    """
+    Loads an EntityValue from the dict created by _serialize_entity().
+    Nested values were already decoded bottom-up by the object_hook, they are used as they are.
+    """
+    version = obj.get('version')
+    if version != ENTITY_SCHEMA_VERSION:
+        raise ValueError("Unsupported entity schema version: {}".format(version))
+    raw = obj.get('raw') or {}
+    entity = EntityValue(
+        name=obj['name'],
+        counter=obj['counter'],
+        state_set=obj.get('state_set'),
+        raw=raw,
+        timestamp=obj.get('timestamp')
+    )
+    # set directly, the constructor would replace falsy values with the raw ones
+    if 'value' in obj:
+        entity.value = obj['value']
+    if 'role' in obj:
+        entity.role = obj['role']
+    return entity
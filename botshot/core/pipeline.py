@@ -0,0 +1,111 @@
+"""
+Two-stage processing of received messages.
+
+If PARSE_STAGE is enabled, entities are extracted by a parse task in the PARSE_QUEUE, which can be consumed
+by its own pool of workers. The parsed message is then dispatched to the process stage (see botshot.core.dispatch),
+which only takes the conversation lock and runs the dialog. Slow NLU requests never delay other messages
+waiting in a shard queue, and each stage can be scaled on its own.
+
+Parse tasks of one conversation can finish out of order. Each message gets a sequence number when it's received,
+and the process stage waits (up to PARSE_ORDER_TIMEOUT seconds) until the previous message was processed.
+"""
+import logging
+import time
+
+from botshot.core import config, metrics
+from botshot.core.dispatch import dispatch, dispatch_message
+from botshot.core.persistence import get_redis, pipelined
+from botshot.core.parsing.raw_message import RawMessage
+from botshot.tasks import celery_method_call_wrapper
+
+SEQUENCE_KEY = "botshot_seq_"
+PROCESSED_KEY = "botshot_seq_done_"
+SEQUENCE_TTL = 3600 * 24
+# seconds between checks whether the previous message was processed
+ORDER_RETRY_SECONDS = 0.2
+
+# sets the processed sequence number, unless a newer message was processed already
+_MARK_PROCESSED = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tonumber(ARGV[1]) > current then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+end
+"""
+
+
+def is_enabled() -> bool:
+    return bool(config.get("PARSE_STAGE", False))
+
+
+def submit(raw_message: RawMessage):
+    """Accepts a received message asynchronously, in one or two stages depending on PARSE_STAGE."""
+    from botshot.core.chat_manager import ChatManager
+    if not is_enabled():
+        return dispatch_message(ChatManager().accept, raw_message)
+    options = {}
+    if config.get("PARSE_QUEUE"):
+        options['queue'] = config.get("PARSE_QUEUE")
+    return celery_method_call_wrapper.apply_async(
+        args=(parse_stage, ), kwargs=dict(raw_message=raw_message, seq=_next_sequence(raw_message)), **options
+    )
+
+
+def parse_stage(raw_message: RawMessage, seq=None):
+    """Extracts entities of a message and passes it to the process stage."""
+    from botshot.core.chat_manager import ChatManager
+    start = time.time()
+    try:
+        entities = ChatManager().parse_raw_message_entities(raw_message)
+    except Exception:
+        # the message is still processed, so that the conversation doesn't wait for it
+        logging.exception("Error parsing entities of message %s", raw_message)
+        metrics.counter("pipeline.parse_errors").inc()
+        entities = dict(raw_message.payload or {})
+        if raw_message.text:
+            entities['_message_text'] = raw_message.text
+    metrics.histogram("pipeline.parse_latency").observe(time.time() - start)
+    return dispatch(
+        process_stage,
+        interface_name=raw_message.interface.name,
+        raw_conversation_id=raw_message.raw_conversation_id,
+        raw_message=raw_message, entities=entities, seq=seq
+    )
+
+
+def process_stage(raw_message: RawMessage, entities: dict, seq=None):
+    """Processes a parsed message, after the previous message of the conversation."""
+    from botshot.core.chat_manager import ChatManager
+    redis = get_redis() if seq is not None else None
+    if redis is not None:
+        key = _key(PROCESSED_KEY, raw_message)
+        processed = int(redis.get(key) or 0)
+        waited = time.time() - raw_message.timestamp
+        if seq > processed + 1 and waited < config.get("PARSE_ORDER_TIMEOUT", 10):
+            return dispatch(
+                process_stage,
+                interface_name=raw_message.interface.name,
+                raw_conversation_id=raw_message.raw_conversation_id,
+                _seconds=ORDER_RETRY_SECONDS,
+                raw_message=raw_message, entities=entities, seq=seq
+            )
+    try:
+        return ChatManager().accept_with_entities(raw_message, entities)
+    finally:
+        if redis is not None:
+            redis.eval(_MARK_PROCESSED, 1, _key(PROCESSED_KEY, raw_message), seq, SEQUENCE_TTL)
+
+
+def _key(prefix, raw_message):
+    return "{}{}_{}".format(prefix, raw_message.interface.name, raw_message.raw_conversation_id)
+
+
+def _next_sequence(raw_message):
+    redis = get_redis()
+    if redis is None:
+        return None
+    try:
+        key = _key(SEQUENCE_KEY, raw_message)
+        return pipelined([('incr', key), ('expire', key, SEQUENCE_TTL)], client=redis)[0]
+    except Exception:
+        logging.exception("Unable to get sequence number of message %s", raw_message)
+        return None
@@ -0,0 +1,201 @@
+import bisect
+import json
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import pytz
+
+# timespec key -> allowed range
+RANGES = {
+    "second": (0, 59),
+    "minute": (0, 59),
+    "hour": (0, 23),
+    "day_of_month": (1, 31),
+    "month_of_year": (1, 12),
+    "day_of_week": (0, 6),  # Monday is 0, as in datetime.weekday()
+}
+
+# order of fields in a cron expression, with an optional leading second field
+CRON_FIELDS = ("minute", "hour", "day_of_month", "month_of_year", "day_of_week")
+
+# the calendar repeats every 28 years, a time that doesn't occur in this period never occurs
+MAX_YEARS = 28
+
+
+def _parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+            if step <= 0:
+                raise ValueError("Invalid step in cron field {}".format(field))
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(x) for x in part.split("-", 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class Recurrence:
+    """
+    A set of times a recurrent schedule runs at, in UTC.
+
+    Each field is a set of allowed values, None means any value (for seconds, only 0).
+    Like in cron, if both day_of_month and day_of_week are restricted, a day matching either of them matches.
+    """
+
+    def __init__(self, second=None, minute=None, hour=None, day_of_month=None, month_of_year=None,
+                 day_of_week=None):
+        fields = dict(second=second, minute=minute, hour=hour, day_of_month=day_of_month,
+                      month_of_year=month_of_year, day_of_week=day_of_week)
+        for key, value in fields.items():
+            low, high = RANGES[key]
+            if value is None:
+                values = {0} if key == "second" else set(range(low, high + 1))
+            elif isinstance(value, int):
+                values = {value}
+            else:
+                values = set(value)
+            if not values or any(not isinstance(v, int) or v < low or v > high for v in values):
+                raise ValueError("{} must be in range ({}, {})".format(key, low, high))
+            setattr(self, key, tuple(sorted(values)))
+        self.any_day_of_month = day_of_month is None
+        self.any_day_of_week = day_of_week is None
+        self._days_of_month = set(self.day_of_month)
+        self._days_of_week = set(self.day_of_week)
+
+    @staticmethod
+    def from_cron(expr: str) -> 'Recurrence':
+        """
+        Parses a cron expression, for example "*/15 9-17 * * 1-5".
+        Six fields start with seconds. In cron, Sunday is 0 or 7.
+        """
+        parts = expr.split()
+        if len(parts) not in (5, 6):
+            raise ValueError("Cron expression must have 5 or 6 fields: {}".format(expr))
+        second = _parse_cron_field(parts.pop(0), 0, 59) if len(parts) == 6 else None
+        fields = {}
+        for key, part in zip(CRON_FIELDS, parts):
+            if part in ("*", "?"):
+                continue
+            if key == "day_of_week":
+                fields[key] = {(day - 1) % 7 for day in _parse_cron_field(part, 0, 7)}
+            else:
+                fields[key] = _parse_cron_field(part, *RANGES[key])
+        return Recurrence(second=second, **fields)
+
+    @staticmethod
+    def parse(spec) -> 'Recurrence':
+        """Returns the recurrence of a timespec dict (as stored in ScheduledAction.recurrence) or a cron expression."""
+        if isinstance(spec, Recurrence):
+            return spec
+        return _parse(json.dumps(spec, sort_keys=True))
+
+    def matches_day(self, dt) -> bool:
+        if dt.month not in self.month_of_year:
+            return False
+        day_ok = dt.day in self._days_of_month
+        weekday_ok = dt.weekday() in self._days_of_week
+        if self.any_day_of_month or self.any_day_of_week:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def matches(self, dt) -> bool:
+        return (self.matches_day(dt) and dt.hour in self.hour
+                and dt.minute in self.minute and dt.second in self.second)
+
+    def next_after(self, dt: datetime):
+        """
+        Returns the first time strictly after dt, or None if there is no such time.
+        Naive datetimes are in UTC, the result is tz-aware iff dt is.
+        """
+        aware = dt.tzinfo is not None
+        if aware:
+            dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+        t = dt.replace(microsecond=0) + timedelta(seconds=1)
+        last_year = t.year + MAX_YEARS
+        while t.year <= last_year:
+            if t.month not in self.month_of_year:
+                month = self._next_value(self.month_of_year, t.month)
+                t = datetime(t.year, month, 1) if month else datetime(t.year + 1, self.month_of_year[0], 1)
+                continue
+            if not self.matches_day(t):
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+            if t.hour not in self.hour:
+                hour = self._next_value(self.hour, t.hour)
+                if hour is None:
+                    t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                else:
+                    t = t.replace(hour=hour, minute=0, second=0)
+                continue
+            if t.minute not in self.minute:
+                minute = self._next_value(self.minute, t.minute)
+                if minute is None:
+                    t = t.replace(minute=0, second=0) + timedelta(hours=1)
+                else:
+                    t = t.replace(minute=minute, second=0)
+                continue
+            if t.second not in self.second:
+                second = self._next_value(self.second, t.second)
+                if second is None:
+                    t = t.replace(second=0) + timedelta(minutes=1)
+                else:
+                    t = t.replace(second=second)
+                continue
+            return t.replace(tzinfo=pytz.utc) if aware else t
+        return None
+
+    def next_times(self, after: datetime, count: int, until: datetime = None) -> list:
+        """Returns up to count next times after a datetime, not later than until."""
+        times = []
+        t = after
+        while len(times) < count:
+            t = self.next_after(t)
+            if t is None or (until is not None and t > until):
+                break
+            times.append(t)
+        return times
+
+    @staticmethod
+    def _next_value(values, current):
+        """Returns the smallest value greater than current, or None."""
+        index = bisect.bisect_right(values, current)
+        return values[index] if index < len(values) else None
+
+
+@lru_cache(maxsize=4096)
+def _parse(key):
+    spec = json.loads(key)
+    if isinstance(spec, str):
+        return Recurrence.from_cron(spec)
+    return Recurrence(**{k: v for k, v in spec.items() if v is not None})
+
+
+def next_fire_times(schedules, count, now=None) -> dict:
+    """
+    Computes the next fire times of many schedules at once.
+    Schedules with the same timespec, start time and end time share one computation,
+    so a large number of schedules with a few distinct timespecs is cheap.
+
+    :param schedules:   iterable of (key, timespec, after, until) tuples, after and until are tz-aware or None
+    :param count:       how many fire times to compute for each schedule
+    :param now:         time to compute from when after is None
+    :returns: dict of key -> list of tz-aware fire times in UTC
+    """
+    now = now or datetime.now(pytz.utc)
+    computed = {}
+    result = {}
+    for key, timespec, after, until in schedules:
+        spec_key = json.dumps(timespec, sort_keys=True)
+        group = (spec_key, after or now, until)
+        if group not in computed:
+            computed[group] = _parse(spec_key).next_times(after or now, count, until=until)
+        result[key] = computed[group]
+    return result
@@ -1,21 +1,83 @@
 import logging
+import time
 from datetime import datetime, timedelta
+from django.db import connection, transaction
+from django.db.models import Min
 from django.utils import timezone
 import pytz
 
 from celery import shared_task
 from celery.signals import beat_init, celeryd_init
 
-from botshot.models import ScheduledAction, ChatUser, ChatConversation
+from botshot.core import config, metrics
+from botshot.core.persistence import get_redis
+from botshot.core.recurrence import Recurrence, next_fire_times
+from botshot.models import ScheduledAction, ScheduledRun, ChatUser, ChatConversation
 from botshot.core.responses import MessageElement
 from botshot.core.chat_manager import ChatManager
 from botshot.core.parsing.raw_message import RawMessage
 from botshot.core.conversation_filter import ConversationFilter, ListConversationFilter
+from botshot.core.dispatch import dispatch, get_shard_count
 
 from django.db.models.signals import post_save, post_delete
 
 
 TASK_TIMEOUT = timedelta(hours=1)
+# upper bounds of scheduler lag histogram buckets in seconds
+LAG_BUCKETS = (1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class ScheduleChunk:
+    """
+    Tracks progress of one chunk of a scheduled run in Redis.
+    Conversations are marked as done one by one, so that a chunk redelivered after a worker crash
+    continues where it stopped, and a finished chunk is never run again.
+    Without Redis, nothing is tracked.
+    """
+
+    KEY_PREFIX = "botshot_schedule_chunk_"
+    TTL = 3600 * 24
+
+    def __init__(self, run_id, index):
+        self.key = "{}{}_{}".format(self.KEY_PREFIX, run_id, index)
+        self.lock_seconds = config.get("SCHEDULE_CHUNK_TIMEOUT", 600)
+        self.redis = get_redis()
+
+    def is_done(self) -> bool:
+        return self.redis is not None and bool(self.redis.exists(self.key + "_done"))
+
+    def lock(self) -> bool:
+        """Makes sure only one worker processes the chunk at a time."""
+        if self.redis is None:
+            return True
+        return bool(self.redis.set(self.key + "_lock", 1, nx=True, ex=self.lock_seconds))
+
+    def unlock(self):
+        if self.redis is not None:
+            self.redis.delete(self.key + "_lock")
+
+    def filter(self, conversation_ids) -> list:
+        """Returns IDs of conversations that were not processed yet."""
+        if self.redis is None or not conversation_ids:
+            return list(conversation_ids)
+        pipe = self.redis.pipeline()
+        for id in conversation_ids:
+            pipe.sismember(self.key, id)
+        return [id for id, done in zip(conversation_ids, pipe.execute()) if not done]
+
+    def add(self, conversation_ids):
+        if self.redis is not None and conversation_ids:
+            pipe = self.redis.pipeline()
+            pipe.sadd(self.key, *conversation_ids)
+            pipe.expire(self.key, self.TTL)
+            pipe.execute()
+
+    def set_done(self):
+        if self.redis is not None:
+            pipe = self.redis.pipeline()
+            pipe.set(self.key + "_done", 1, ex=self.TTL)
+            pipe.delete(self.key)
+            pipe.execute()
 
 
 class MessageScheduler:
@@ -46,7 +108,7 @@ class MessageScheduler:
         self, action, conversations, 
         hour=None, minute=None, second=None, 
         weekday=None, day=None, month=None, 
-        until=None, description=None
+        until=None, description=None, cron=None
     ) -> str:
         """
         Schedules a recurrent action.
@@ -55,30 +117,44 @@ class MessageScheduler:
         :param action:          either a dict containing payload or a MessageElement
         :param conversations:   conversations for which the schedule will be executed
                                 You can provide a ConversationFilter object, a list or one id.
+        :param weekday:         day of week, Monday is 0
         :param until:           localized datetime, when to remove the schedule
         :param description:     (optional) short human-readable description of event
+        :param cron:            (optional) cron expression used instead of the other time arguments,
+                                for example "0 9 * * 1-5", see botshot.core.recurrence.Recurrence.from_cron
         :return: ID of this schedule
         """
 
-        timespec = {
-            "hour": hour,
-            "minute": minute,
-            "second": second,
-            "day_of_week": weekday,
-            "day_of_month": day,
-            "month_of_year": month
-        }
+        if cron is not None:
+            timespec = cron
+            try:
+                Recurrence.parse(cron)
+            except ValueError as e:
+                raise Exception("Invalid schedule specification") from e
+        else:
+            timespec = {
+                "hour": hour,
+                "minute": minute,
+                "second": second,
+                "day_of_week": weekday,
+                "day_of_month": day,
+                "month_of_year": month
+            }
+            self._validate_timespec(timespec)
         conversations = self._validate_conversation_filter(conversations)
-        self._validate_timespec(timespec)
         self._validate_action(action)
-        at = MessageScheduler._nearest_datetime(timespec)  # tz-naive
-        at = at.replace(tzinfo=pytz.UTC)
-        print("WILL RUN @ {}".format(at))
         until = self._validate_datetime(until) if until else None
-        schedule = ScheduledAction(recurrence=timespec, _at=at, _until=until, 
-            action=action, description=description, 
-            conversations=conversations)
-        schedule.save()
+        now = timezone.now()
+        with transaction.atomic():
+            schedule = ScheduledAction(recurrence=timespec, _at=now, _until=until,
+                action=action, description=description, 
+                conversations=conversations)
+            schedule.save()
+            next_runs = MessageScheduler._precompute_runs([(schedule, now)])
+            if not next_runs:
+                raise Exception("The schedule would never run")
+            schedule._at = next_runs[schedule._id]
+            schedule.save(update_fields=['_at'])
         task_id = "botshot_schedule_{}".format(schedule.pk)
         return task_id
 
@@ -95,95 +171,221 @@ class MessageScheduler:
     @staticmethod
     @shared_task(name='botshot.schedule_wrapper', bind=True)
     def _schedule_wrapper(self, conversations: ConversationFilter, action, task_id=None):
+        """Splits conversations of a scheduled run into chunks, each chunk is processed by a separate task."""
         logging.debug("Running schedule %s", task_id)
-        conversations = conversations.get_ids()
-
-        if isinstance(action, dict):
-            # Botshot state + context schedule, different for each conversation
-            manager = ChatManager()
-            for id in conversations:
-                manager.accept_scheduled(
-                    conversation_id=id, user_id=None, payload=action)
-        elif isinstance(action, MessageElement):
-            # Prepared MessageElement schedule, sent as a broadcast
-            # TODO: send the message to the interfaces
-            # TODO: send more messages at once
-            raise NotImplementedError()
+        chunk_size = config.get("SCHEDULE_CHUNK_SIZE", 500)
+        # ids are streamed from the database, never loaded all at once
+        for index, chunk in enumerate(conversations.iter_id_chunks(chunk_size)):
+            MessageScheduler._schedule_chunk.delay(chunk, action, task_id, index)
+
+    @staticmethod
+    @shared_task(name='botshot.schedule_chunk', bind=True, acks_late=True, reject_on_worker_lost=True,
+                 max_retries=None)
+    def _schedule_chunk(self, conversation_ids: list, action, task_id, index):
+        """
+        Runs a scheduled action for a chunk of conversations.
+        The task is acknowledged only after it finishes, so it is redelivered if the worker crashes.
+        """
+        chunk = ScheduleChunk(task_id, index)
+        if chunk.is_done():
+            logging.info("Chunk %d of schedule %s already done, skipping", index, task_id)
+            return
+        if not chunk.lock():
+            # another worker is processing the chunk, check again when its lock expires
+            raise self.retry(countdown=chunk.lock_seconds)
+        try:
+            conversation_ids = chunk.filter(conversation_ids)
+            if isinstance(action, dict):
+                # Botshot state + context schedule, different for each conversation
+                MessageScheduler._accept_scheduled(chunk, conversation_ids, action)
+            elif isinstance(action, MessageElement):
+                # Prepared MessageElement schedule, sent as a broadcast grouped by interface
+                conversations = list(ChatConversation.objects.filter(pk__in=conversation_ids))
+                ChatManager().broadcast(conversations, [action], broadcast_id=chunk.key)
+                chunk.add(conversation_ids)
+            chunk.set_done()
+        finally:
+            chunk.unlock()
+
+    @staticmethod
+    def _accept_scheduled(chunk: ScheduleChunk, conversation_ids, action):
+        manager = ChatManager()
+        if get_shard_count():
+            # process in the conversation's shard, so that it doesn't wait for the conversation lock
+            rows = ChatConversation.objects.filter(pk__in=conversation_ids)
+            for id, interface_name, raw_conversation_id in rows.values_list(
+                    'pk', 'interface_name', 'raw_conversation_id'):
+                dispatch(manager.accept_scheduled, interface_name, raw_conversation_id,
+                         conversation_id=id, user_id=None, payload=action)
+                chunk.add([id])
+            return
+        for id in conversation_ids:
+            manager.accept_scheduled(
+                conversation_id=id, user_id=None, payload=action)
+            chunk.add([id])
 
     @staticmethod
     @shared_task
     def heartbeat():
+        """
+        Runs due schedules. Due rows are claimed in batches with SELECT ... FOR UPDATE SKIP LOCKED,
+        so several heartbeat workers can run at once without running a schedule twice.
+        """
         now = timezone.now()
-        actions_to_run = []
+        batch_size = config.get("SCHEDULER_BATCH_SIZE", 500)
         # delete expired schedules
         ScheduledAction.objects.filter(_until__lt=now).delete()
-        # select tasks to run
-        for schedule in ScheduledAction.objects.filter(_at__lte=now, is_done=False):
-            if schedule.at >= now - TASK_TIMEOUT:
-                # task is recent enough to run
-                actions_to_run.append((schedule._id, schedule.conversations, schedule.action))
-            # either way, if the task is periodic, set it to run next time
-            # TODO: test how this behaves with very short time intervals
-            if schedule.recurrence:
-                # update _at to first matching future time
-                nearest = MessageScheduler._nearest_datetime(schedule.recurrence)  # tz-naive
-                schedule._at = nearest.replace(tzinfo=pytz.UTC)
-                schedule.save()           # saved for future run
+        # recurrent schedules created before fire times were precomputed
+        with transaction.atomic():
+            legacy = list(
+                ScheduledAction.objects.select_for_update(skip_locked=True)
+                .filter(recurrence__isnull=False, is_done=False)
+                .exclude(_id__in=ScheduledRun.objects.values('schedule_id'))[:batch_size]
+            )
+            MessageScheduler._refresh_next_runs(legacy, now, after=lambda s: s.at - timedelta(seconds=1))
+        lags = []
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    ScheduledAction.objects.select_for_update(skip_locked=True)
+                    .filter(recurrence__isnull=True, _at__lte=now, is_done=False)
+                    .order_by('_at')[:batch_size]
+                )
+                lags += MessageScheduler._run_batch(batch, now)
+            if len(batch) < batch_size:
+                break
+        while True:
+            with transaction.atomic():
+                # lock only the runs, not the schedules they are joined with
+                lock_of = ('self',) if connection.features.has_select_for_update_of else ()
+                runs = list(
+                    ScheduledRun.objects.select_for_update(skip_locked=True, of=lock_of)
+                    .select_related('schedule')
+                    .filter(_at__lte=now)
+                    .order_by('_at')[:batch_size]
+                )
+                lags += MessageScheduler._run_recurrent_batch(runs, now)
+            if len(runs) < batch_size:
+                break
+        MessageScheduler._record_lags(lags)
+
+    @staticmethod
+    def _dispatch(schedule, at, now) -> list:
+        """
+        Dispatches a run of a schedule if it is recent enough.
+        Runs are dispatched before their claim commits, chunks of a run are idempotent if it is dispatched twice.
+        :returns: list with the lag in seconds between due time and dispatch time, empty if skipped
+        """
+        if at < now - TASK_TIMEOUT:
+            logging.warning("Skipping schedule %s, it was due at %s", schedule._id, at)
+            metrics.counter("scheduler.skipped").inc()
+            return []
+        # each run of a recurrent schedule needs its own ID, chunks are tracked by it
+        run_id = "{}_{}".format(schedule._id, int(at.timestamp()))
+        MessageScheduler._schedule_wrapper.delay(schedule.conversations, schedule.action, run_id)
+        return [(timezone.now() - at).total_seconds()]
+
+    @staticmethod
+    def _run_batch(batch, now) -> list:
+        """
+        Dispatches claimed one-time schedules and marks them as done in bulk.
+        :returns: list of lags in seconds between due time and dispatch time
+        """
+        done_ids, delete_ids, lags = [], [], []
+        for schedule in batch:
+            lags += MessageScheduler._dispatch(schedule, schedule.at, now)
+            # one-time schedule, we can't risk running it twice
+            if schedule.description:  # human-triggered, kept for future reference
+                done_ids.append(schedule._id)
+            else:  # automatic (no description), not needed
+                delete_ids.append(schedule._id)
+        if done_ids:
+            ScheduledAction.objects.filter(_id__in=done_ids).update(is_done=True)
+        if delete_ids:
+            ScheduledAction.objects.filter(_id__in=delete_ids).delete()
+        return lags
+
+    @staticmethod
+    def _run_recurrent_batch(runs, now) -> list:
+        """
+        Dispatches claimed precomputed runs of recurrent schedules and deletes them.
+        :returns: list of lags in seconds between due time and dispatch time
+        """
+        schedules, lags = {}, []
+        for run in runs:
+            if not run.schedule.is_done:
+                lags += MessageScheduler._dispatch(run.schedule, run.at, now)
+            schedules[run.schedule_id] = run.schedule
+        ScheduledRun.objects.filter(id__in=[run.id for run in runs]).delete()
+        MessageScheduler._refresh_next_runs(list(schedules.values()), now)
+        return lags
+
+    @staticmethod
+    def _refresh_next_runs(schedules, now, after=None):
+        """
+        Sets _at of recurrent schedules to their next precomputed run.
+        Schedules without runs left get new runs computed after now, or after after(schedule) if given.
+        Schedules that never run again are marked as done.
+        """
+        if not schedules:
+            return
+        ids = [schedule._id for schedule in schedules]
+        next_runs = dict(
+            ScheduledRun.objects.filter(schedule_id__in=ids)
+            .values_list('schedule_id').annotate(Min('_at'))
+        )
+        empty = [(s, after(s) if after else now) for s in schedules if s._id not in next_runs]
+        next_runs.update(MessageScheduler._precompute_runs(empty))
+        for schedule in schedules:
+            if schedule._id in next_runs:
+                schedule._at = next_runs[schedule._id]
             else:
-                # one-time schedule, we can't risk running it twice
-                if schedule.description:  # human-triggered
-                    schedule.is_done = True  # TODO: is_active would be better
-                    schedule.save()       # saved for future reference
-                else:                     # automatic (no description)
-                    schedule.delete()     # not needed, deleted
-        # run selected tasks
-        for task_id, conversations, action in actions_to_run:
-            MessageScheduler._schedule_wrapper.delay(conversations, action, task_id)
+                schedule.is_done = True
+        ScheduledAction.objects.bulk_update(schedules, ['_at', 'is_done'])
+
+    @staticmethod
+    def _precompute_runs(schedules) -> dict:
+        """
+        Stores the next fire times of recurrent schedules as ScheduledRun rows.
+        :param schedules: list of (schedule, after) tuples
+        :returns: dict of schedule id -> first new fire time, for schedules that run again
+        """
+        count = config.get("SCHEDULE_PRECOMPUTED_RUNS", 10)
+        fire_times = next_fire_times(
+            ((s._id, s.recurrence, after, s.until) for s, after in schedules), count
+        )
+        ScheduledRun.objects.bulk_create(
+            [ScheduledRun(schedule_id=id, _at=at) for id, times in fire_times.items() for at in times],
+            batch_size=1000,
+        )
+        return {id: times[0] for id, times in fire_times.items() if times}
+
+    LAG_KEY = "botshot_scheduler_lag"
+
+    @staticmethod
+    def _record_lags(lags):
+        histogram = metrics.histogram("scheduler.lag", buckets=LAG_BUCKETS)
+        for lag in lags:
+            histogram.observe(lag)
+        metrics.counter("scheduler.dispatched").inc(len(lags))
+        redis = get_redis()
+        if redis is None:
+            return
+        stats = {'heartbeat': time.time(), 'dispatched': len(lags)}
+        if lags:
+            stats.update(max_lag=max(lags), avg_lag=sum(lags) / len(lags))
+        redis.hset(MessageScheduler.LAG_KEY, mapping=stats)
 
     @staticmethod
-    def _nearest_datetime(timespec: dict):  # timespec has to be in UTC!
-        # TODO: test me!
-        now = datetime.now()
-
-        month = timespec.get('month_of_year')
-        date = timespec.get('day_of_month')
-        weekday = timespec.get('day_of_week')
-
-        hour = timespec.get('hour')
-        minute = timespec.get('minute')
-        second = timespec.get('second') or 0
-
-        if minute is None:
-            dt = now.replace(second=second)
-            if dt <= now:
-                dt += timedelta(minutes=1)
-            return dt
-        if hour is None:
-            dt = now.replace(minute=minute, second=second)
-            if dt <= now:
-                dt += timedelta(hours=1)
-            return dt
-        if weekday is None and date is None:
-            dt = now.replace(hour=hour, minute=minute, second=second)
-            if dt <= now:
-                dt += timedelta(days=1)
-            return dt
-        if date is None:  # weekday
-            day_delta = weekday - now.weekday
-            dt = now.replace(hour=hour, minute=minute, second=second) + timedelta(days=day_delta)
-            if dt <= now:
-                dt += timedelta(days=7)
-            return dt
-        if month is None: # date
-            dt = datetime(year=now.year, month=now.month, day=date, hour=hour, minute=minute, second=second)
-            if dt <= now:
-                month, year = now.month + 1, now.year if now.month < 12 else 1, now.year + 1
-                dt = datetime(year=year, month=month, day=date, hour=hour, minute=minute, second=second)
-            return dt
-        dt = datetime(year=now.year, month=month, day=date, hour=hour, minute=minute, second=second)
-        if dt <= now:
-            dt.replace(year=now.year+1)
-        return dt
+    def get_lag_stats() -> dict:
+        """
+        Returns stats of the last heartbeat of any worker: its time, the number of dispatched schedules,
+        and the maximum and average seconds between their due time and dispatch.
+        """
+        redis = get_redis()
+        if redis is None:
+            return {}
+        return {key.decode('utf8'): float(value) for key, value in redis.hgetall(MessageScheduler.LAG_KEY).items()}
 
     def _validate_timespec(self, timespec: dict):
         try:
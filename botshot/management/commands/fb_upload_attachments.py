@@ -0,0 +1,44 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Uploads media to Facebook before they are sent, for example before a broadcast'
+
+    def add_arguments(self, parser):
+        parser.add_argument('manifest', help='JSON list of {"url": ..., "type": ...} objects, '
+                                             'or a text file with a URL and an optional type on each line')
+        parser.add_argument('--page', action='append', dest='pages',
+                            help='PAGE_ID of a page in FB_PAGES, can be repeated (default all pages)')
+
+    def handle(self, *args, **options):
+        from botshot.core.interface_factory import InterfaceFactory
+        from botshot.core.interfaces.facebook import FacebookInterface
+        interface = InterfaceFactory.from_name(FacebookInterface.name)
+        attachments = self._read_manifest(options['manifest'])
+        if options['pages']:
+            pages = [interface.get_page(page_id) for page_id in options['pages']]
+        else:
+            pages = interface.pages
+        for page in pages:
+            ids = interface.attachments.get_many(page, attachments)
+            failed = [url for url, att_id in ids.items() if att_id is None]
+            self.stdout.write("Page {}: {} attachments ready, {} failed".format(
+                page.name, len(ids) - len(failed), len(failed)
+            ))
+            for url in failed:
+                self.stderr.write("Failed to upload {}".format(url))
+
+    @staticmethod
+    def _read_manifest(path):
+        with open(path) as f:
+            content = f.read()
+        if content.lstrip().startswith('['):
+            return [(item['url'], item.get('type', 'image')) for item in json.loads(content)]
+        attachments = []
+        for line in content.splitlines():
+            parts = line.split()
+            if parts and not parts[0].startswith('#'):
+                attachments.append((parts[0], parts[1] if len(parts) > 1 else 'image'))
+        return attachments
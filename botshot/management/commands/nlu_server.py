@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from botshot.core import config
+
+
+class Command(BaseCommand):
+    help = 'Runs an entity extractor in a local HTTP server, use it from workers with BotshotRemoteNLU'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--extractor', default='botshot.core.parsing.botshot_extractor.BotshotExtractor')
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8800)
+        parser.add_argument('--max-batch-size', type=int, default=config.get('NLU_SERVER_MAX_BATCH_SIZE', 32))
+        parser.add_argument('--max-wait-ms', type=float, default=config.get('NLU_SERVER_MAX_WAIT_MS', 5))
+
+    def handle(self, *args, **options):
+        from botshot.core.parsing.nlu_server import make_server
+        extractor = import_string(options['extractor'])()
+        server = make_server(
+            extractor, host=options['host'], port=options['port'],
+            max_batch_size=options['max_batch_size'], max_wait=options['max_wait_ms'] / 1000,
+            timeout=extractor.get_timeout(),
+        )
+        self.stdout.write("Serving {} at http://{}:{}".format(options['extractor'], options['host'], options['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            server.batcher.close()
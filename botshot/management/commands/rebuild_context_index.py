@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the index of latest entity values used by conversation filters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        from botshot.core.context_index import get_context_counter, update_context_index
+        from botshot.core.conversation_filter import iter_keyset
+        from botshot.models import ChatConversation
+        from django.db.models import Case, F, Value, When
+        count = 0
+        for ids in iter_keyset(ChatConversation.objects.all(), 'conversation_id', options['chunk_size']):
+            contexts = dict(
+                ChatConversation.objects.filter(conversation_id__in=ids).values_list('conversation_id', 'context_dict')
+            )
+            ChatConversation.objects.filter(conversation_id__in=ids).update(context_counter=Case(*[
+                When(conversation_id=conversation_id, then=Value(get_context_counter(context_dict)))
+                for conversation_id, context_dict in contexts.items()
+            ], default=F('context_counter')))
+            update_context_index(contexts)
+            count += len(ids)
+            self.stdout.write("Indexed {} conversations".format(count))
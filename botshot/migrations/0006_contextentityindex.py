@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botshot', '0005_chatconversation_context_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContextEntityIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity', models.CharField(max_length=128)),
+                ('value_key', models.CharField(max_length=255, null=True)),
+                ('is_truthy', models.BooleanField()),
+                ('counter', models.IntegerField()),
+                ('context_counter', models.IntegerField()),
+                ('timestamp', models.FloatField()),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='context_index', to='botshot.ChatConversation')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='contextentityindex',
+            index=models.Index(fields=['entity', 'value_key', 'conversation'], name='botshot_con_entity_820956_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='contextentityindex',
+            unique_together={('conversation', 'entity')},
+        ),
+    ]
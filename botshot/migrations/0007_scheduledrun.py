@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botshot', '0006_contextentityindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('_at', models.DateTimeField(db_index=True)),
+                ('schedule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='botshot.ScheduledAction')),
+            ],
+            options={
+                'unique_together': {('schedule', '_at')},
+            },
+        ),
+    ]
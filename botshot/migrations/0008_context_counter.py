@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-18 21:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botshot', '0007_scheduledrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatconversation',
+            name='context_counter',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RemoveField(
+            model_name='contextentityindex',
+            name='context_counter',
+        ),
+    ]
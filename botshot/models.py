@@ -5,13 +5,14 @@ import tempfile
 import pytz
 import requests
 
+from botshot.core import http
 from botshot.core.persistence import json_serialize, json_deserialize
 from django.db import models
 from jsonfield import JSONField
 
 
 def save_temporary_image(image_url):
-    request = requests.get(image_url, stream=True)
+    request = http.get(image_url, endpoint="image", stream=True)
 
     # Was the request OK?
     if request.status_code != requests.codes.ok:
@@ -39,6 +40,8 @@ class ChatConversation(models.Model):
     is_test = models.BooleanField(default=False)
     meta = JSONField(null=True, load_kwargs=dict(object_hook=json_deserialize), dump_kwargs=dict(default=json_serialize))
     context_dict = JSONField(null=True, load_kwargs=dict(object_hook=json_deserialize), dump_kwargs=dict(default=json_serialize))
+    context_version = models.BigIntegerField(default=0)  # last context version written, see ContextStore
+    context_counter = models.IntegerField(default=0)  # counter of the written context, see ContextEntityIndex
 
     @property
     def id(self):
@@ -119,6 +122,21 @@ class ChatMessage(models.Model):
         return 'ChatMessage({})'.format({k:v for k, v in self.__dict__.items() if k not in ['_state']})
 
 
+class ContextEntityIndex(models.Model):
+    """Latest value of each entity in a conversation's context, used to filter conversations in the database."""
+
+    conversation = models.ForeignKey(ChatConversation, on_delete=models.CASCADE, related_name="context_index")
+    entity = models.CharField(max_length=128)
+    value_key = models.CharField(max_length=255, null=True)  # see botshot.core.context_index.index_value
+    is_truthy = models.BooleanField()
+    counter = models.IntegerField()  # counter of the message that set the value
+    timestamp = models.FloatField()
+
+    class Meta:
+        unique_together = (('conversation', 'entity'),)
+        indexes = [models.Index(fields=['entity', 'value_key', 'conversation'], name='botshot_con_entity_820956_idx')]
+
+
 class ScheduledAction(models.Model):
 
     _id = models.BigAutoField(primary_key=True)
@@ -139,3 +157,17 @@ class ScheduledAction(models.Model):
         if self._until:
             return self._until.replace(tzinfo=pytz.UTC)
         return None
+
+
+class ScheduledRun(models.Model):
+    """Precomputed fire time of a recurrent ScheduledAction, see botshot.core.recurrence."""
+
+    schedule = models.ForeignKey(ScheduledAction, on_delete=models.CASCADE, related_name="runs")
+    _at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = (('schedule', '_at'),)
+
+    @property
+    def at(self):
+        return self._at.replace(tzinfo=pytz.UTC)
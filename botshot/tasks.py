@@ -39,6 +39,14 @@ def celery_method_call_wrapper(method, **kwargs):
     return method(**kwargs)
 
 
+@shared_task
+def sharded_method_call_wrapper(method, shard, counted, **kwargs):
+    from botshot.core.dispatch import on_task_started
+    if counted:
+        on_task_started(shard)
+    return method(**kwargs)
+
+
 def get_set_task_flag(task_id):
     """Prevents duplicate scheduled tasks."""
     from botshot.core.persistence import get_redis
@@ -1,11 +1,6 @@
 import os
 
 BOT_CONFIG = {
-    "REDIS": {
-        "HOST": 'localhost',
-        "PORT": 6379,
-        "PASSWORD": None,
-    },
     "INTERFACES": [
         "botshot.tests.test_chat_manager._TestInterface",
     ],
@@ -21,7 +21,7 @@ class _TestInterface(BasicAsyncInterface):
     def send_responses(self, conversation, reply_to, responses):
         pass
 
-    def broadcast_responses(self, conversations, responses):
+    def broadcast_responses(self, conversations, responses, broadcast_id=None):
         pass
 
 @pytest.fixture
@@ -80,3 +80,131 @@ class TestChatManager:
     def test_send(self, chat_mgr, conversation):
         responses = [TextMessage("Hello world!")]
         chat_mgr.send(conversation, responses, None)
+
+    def _process_with_responses(self, monkeypatch, chat_mgr, message, saved_during_processing):
+        from botshot.models import ChatMessage
+
+        class Processor:
+            def __init__(self, chat_manager, message, interceptors):
+                self.chat_manager, self.message = chat_manager, message
+                self.logging_service = mock.Mock()
+
+            def process(self):
+                conversation = self.message.conversation
+                self.chat_manager.send(conversation, [TextMessage("one"), TextMessage("two")], self.message)
+                self.chat_manager.send(conversation, [TextMessage("three")], self.message)
+                saved_during_processing.append(ChatMessage.objects.filter(is_user=False).count())
+
+        monkeypatch.setattr("botshot.core.message_processor.MessageProcessor", Processor)
+        chat_mgr.accept(message)
+
+    def test_responses_are_saved_at_once(self, monkeypatch, chat_mgr, message):
+        from botshot.models import ChatMessage
+        saved = []
+        bulk_create = mock.Mock(wraps=ChatMessage.objects.bulk_create)
+        monkeypatch.setattr(ChatMessage.objects, "bulk_create", bulk_create)
+        self._process_with_responses(monkeypatch, chat_mgr, message, saved)
+        assert saved == [0]
+        bulk_create.assert_called_once()
+        responses = list(ChatMessage.objects.filter(is_user=False).order_by('time'))
+        assert [r.text for r in responses] == ["one", "two", "three"]
+        assert [r.text for r in ChatMessage.objects.filter(is_user=False).order_by('message_id')] == ["one", "two", "three"]
+        assert all(r.user_id == ChatUser.objects.get(raw_user_id="foo").user_id for r in responses)
+
+    def test_send_outside_of_processing(self, chat_mgr, conversation):
+        from botshot.models import ChatMessage
+        chat_mgr.send(conversation, [TextMessage("Hello"), TextMessage("world")], None)
+        assert ChatMessage.objects.filter(conversation=conversation).count() == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_response_persistence(monkeypatch, settings, message):
+    from botshot.models import ChatMessage
+    settings.BOT_CONFIG['RESPONSE_PERSISTENCE'] = 'async'
+    chat_mgr = ChatManager()
+    del settings.BOT_CONFIG['RESPONSE_PERSISTENCE']
+    tasks = []
+    monkeypatch.setattr("botshot.tasks.run_async", lambda method, **kwargs: tasks.append((method, kwargs)))
+    saved = []
+    TestChatManager()._process_with_responses(monkeypatch, chat_mgr, message, saved)
+    assert saved == [0] and len(tasks) == 1
+    assert ChatMessage.objects.filter(is_user=False).count() == 0
+    method, kwargs = tasks[0]
+    method(**kwargs)
+    assert [r.text for r in ChatMessage.objects.filter(is_user=False).order_by('time')] == ["one", "two", "three"]
+
+
+class _ContextProcessor:
+    """Processes a message like MessageProcessor, it only loads the context, stores the entities and saves it."""
+
+    def __init__(self, chat_manager, message, interceptors=None):
+        from botshot.core.context_store import get_context_store
+        self.message = message
+        self.context = get_context_store().load(message.conversation)
+        self.logging_service = mock.Mock()
+
+    def process(self):
+        self.context.counter += 1
+        for entity, value in (self.message.entities or {}).items():
+            self.context.set_value(entity, value)
+        self.message.conversation.context_dict = self.context.to_dict()
+
+
+@pytest.mark.django_db(transaction=True)
+class TestAcceptQueries:
+    """
+    Regression test of the number of queries needed to accept a message, including BEGIN of the transaction.
+    Before the persistence path was reworked, a returning user's message needed 6 queries:
+    select conversation and user, update conversation, update user and insert message.
+    """
+
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        from botshot.core import chat_manager
+        monkeypatch.setattr('botshot.core.message_processor.MessageProcessor', _ContextProcessor)
+        chat_manager._memberships.clear()
+
+    def accept(self, chat_mgr, raw_user_id="foo", raw_conversation_id="chat_id", entities=None):
+        chat_mgr.accept_with_entities(RawMessage(
+            interface=_TestInterface(), raw_user_id=raw_user_id, raw_conversation_id=raw_conversation_id,
+            conversation_meta={}, type="message", text="Hello world!", payload=None, timestamp=time()
+        ), entities or {})
+
+    def test_new_user(self, chat_mgr, django_assert_num_queries):
+        # select and insert conversation and user, insert membership, update conversation, insert message
+        with django_assert_num_queries(8):
+            self.accept(chat_mgr)
+        user = ChatUser.objects.get(raw_user_id="foo")
+        assert list(user.conversations.all()) == [ChatConversation.objects.get(raw_conversation_id="chat_id")]
+
+    def test_returning_user(self, chat_mgr, django_assert_num_queries):
+        self.accept(chat_mgr, entities={"intent": "greeting"})
+        # select conversation and user, update conversation with context, insert message
+        with django_assert_num_queries(5):
+            self.accept(chat_mgr)
+        # a changed entity adds one update of the context index
+        with django_assert_num_queries(6):
+            self.accept(chat_mgr, entities={"intent": "goodbye"})
+
+    def test_rolled_back_membership_is_not_remembered(self, chat_mgr, monkeypatch):
+        from botshot.core import chat_manager
+        monkeypatch.setattr(_ContextProcessor, "process", mock.Mock(side_effect=Exception()))
+        monkeypatch.setattr(ChatManager, "save_responses", mock.Mock(side_effect=RuntimeError()))
+        with pytest.raises(RuntimeError):
+            self.accept(chat_mgr)
+        assert not chat_manager._memberships
+
+    def test_returning_user_in_new_conversation(self, chat_mgr):
+        self.accept(chat_mgr)
+        self.accept(chat_mgr, raw_conversation_id="other")
+        user = ChatUser.objects.get(raw_user_id="foo")
+        assert user.conversations.count() == 2
+        assert ChatUser.objects.count() == 1
+
+    def test_changed_user_details_are_saved(self, chat_mgr, monkeypatch):
+        def fill_user_details(self, user):
+            user.first_name = "Foo"
+
+        monkeypatch.setattr(_TestInterface, "fill_user_details", fill_user_details)
+        self.accept(chat_mgr)
+        assert ChatUser.objects.get(raw_user_id="foo").first_name == "Foo"
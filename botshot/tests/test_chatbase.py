@@ -0,0 +1,99 @@
+import time
+from datetime import datetime
+
+import mock
+import pytest
+import pytz
+
+from botshot.core import metrics
+from botshot.core.logging import chatbase
+from botshot.core.responses import TextMessage
+from botshot.models import ChatConversation, ChatMessage
+
+
+def response(status):
+    return mock.Mock(ok=status < 400, status_code=status, text="")
+
+
+@pytest.fixture
+def post(settings, monkeypatch):
+    settings.BOT_CONFIG['CHATBASE_API_KEY'] = 'secret'
+    settings.BOT_CONFIG['CHATBASE_BATCH_SIZE'] = 2
+    post = mock.Mock(return_value=response(200))
+    monkeypatch.setattr(chatbase.http, "post", post)
+    monkeypatch.setattr(chatbase, "time", mock.Mock(time=time.time))
+    monkeypatch.setattr(chatbase, "get_redis", lambda: None)
+    chatbase._sender = None
+    metrics.reset()
+    yield post
+    chatbase._sender = None
+    del settings.BOT_CONFIG['CHATBASE_API_KEY']
+    del settings.BOT_CONFIG['CHATBASE_BATCH_SIZE']
+
+
+@pytest.fixture
+def message():
+    message = ChatMessage(type=ChatMessage.MESSAGE, text="Hello", is_user=True,
+                          time=datetime(2026, 10, 18, 12, tzinfo=pytz.utc))
+    message.conversation = ChatConversation(conversation_id=1, interface_name="facebook")
+    message.entities = {"intent": [{"value": "greeting"}]}
+    return message
+
+
+def sent_messages(post):
+    return [call[1]['json']['messages'] for call in post.call_args_list]
+
+
+class TestChatbaseLogger:
+
+    def test_batching(self, post, message):
+        logger = chatbase.ChatbaseLogger()
+        logger.log_user_message_end(message, 'default.root')
+        post.assert_not_called()
+        logger.log_bot_response(message, TextMessage("Hi"), timestamp=0)
+        logger.log_bot_response(message, TextMessage("Bye"), timestamp=0)
+        assert [[m['message'] for m in batch] for batch in sent_messages(post)] == [["Hello", "Hi"]]
+        chatbase.get_sender().flush()
+        assert [[m['message'] for m in batch] for batch in sent_messages(post)] == [["Hello", "Hi"], ["Bye"]]
+        url = post.call_args[0][0]
+        assert url.endswith("/messages") and 'secret' not in url and 'params' not in post.call_args[1]
+        assert sent_messages(post)[0][0]['api_key'] == 'secret'
+
+    def test_retry(self, post, message):
+        post.side_effect = [response(503), IOError("connection reset"), response(200)]
+        logger = chatbase.ChatbaseLogger()
+        logger.log_user_message_end(message, 'default.root')
+        chatbase.get_sender().flush()
+        assert post.call_count == 3
+        delays = [call[0][0] for call in chatbase.time.sleep.call_args_list]
+        assert 0.25 <= delays[0] <= 0.75 and 0.5 <= delays[1] <= 1.5
+        assert metrics.get_metrics()['counters']['chatbase.sent'] == 1
+
+    def test_invalid_batch_is_not_retried(self, post, message):
+        post.return_value = response(400)
+        chatbase.ChatbaseLogger().log_user_message_end(message, 'default.root')
+        chatbase.get_sender().flush()
+        assert post.call_count == 1
+
+    def test_unsent_batches_survive_restart(self, post, message, monkeypatch):
+        fakeredis = pytest.importorskip("fakeredis")
+        redis = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr(chatbase, "get_redis", lambda: redis)
+        post.return_value = response(503)
+        logger = chatbase.ChatbaseLogger()
+        for text in ("one", "two", "three"):
+            message.text = text
+            logger.log_user_message_end(message, 'default.root')
+        chatbase.get_sender().flush()
+        assert redis.llen(chatbase.UNSENT_KEY) == 2
+        assert metrics.get_metrics()['counters']['chatbase.failed_batches'] == 2
+
+        # worker restarted
+        chatbase._sender = None
+        post.reset_mock()
+        post.return_value = response(200)
+        message.text = "four"
+        chatbase.ChatbaseLogger().log_user_message_end(message, 'default.root')
+        chatbase.get_sender().flush()
+        assert [[m['message'] for m in batch] for batch in sent_messages(post)] == [["four"], ["one", "two"]]
+        assert redis.llen(chatbase.UNSENT_KEY) == 1
@@ -89,3 +89,81 @@ class TestContext():
         assert proc.context.counter == 0
         proc.process()
         assert proc.context.counter == 1
+
+    def test_load_legacy_context(self):
+        entity = EntityValue("intent", counter=1, state_set="default.root", raw={"value": "greeting"})
+        data = {"history": [], "counter": 1, "entities": {"intent": [entity, None], "broken": [None]}}
+        context = Context.load(data)
+        assert context.intent.get_value() == "greeting"
+        assert context.intent.count() == 1
+        assert "broken" not in context.entities
+        assert context.to_dict()['version'] == 2
+
+    def test_load_drops_unsupported_entities(self):
+        import json
+        from botshot.core.persistence import json_serialize, json_deserialize
+        entity = EntityValue("intent", counter=1, state_set="default.root", raw={"value": "greeting"})
+        data = json.loads(json.dumps({"version": 2, "entities": {"intent": [entity]}}, default=json_serialize))
+        data["entities"]["intent"].append(dict(data["entities"]["intent"][0], version=99))
+        context = Context.load(json.loads(json.dumps(data), object_hook=json_deserialize))
+        assert context.intent.values() == ["greeting"]
+
+    def test_metadata_entities_not_in_context(self):
+        context = Context(entities={}, history=[], counter=0)
+        context.add_message_entities({"intent": "greeting", "_extractor_timeouts": [{"value": "WitExtractor"}]})
+        assert "_extractor_timeouts" not in context.entities and context.intent.get_value() == "greeting"
+
+    def test_max_depth(self):
+        context = Context(entities={}, history=[], counter=0, max_depth=3)
+        for i in range(5):
+            context.add_message_entities({"myentity": i})
+        assert context.myentity.values() == [4, 3, 2]
+        context.set_value("myentity", 5)
+        context.myentity = 6
+        assert context.myentity.values() == [6, 5, 4]
+        assert context.evicted['depth'] == 4
+
+    def test_evictions_are_exported(self):
+        from botshot.core import metrics
+        metrics.reset()
+        context = Context(entities={}, history=[], counter=0, max_depth=1)
+        context.add_message_entities({"myentity": "a"})
+        context.add_message_entities({"myentity": "b"})
+        assert metrics.get_metrics()['counters']['context.evicted.depth'] == 1
+
+    def test_max_entities(self):
+        context = Context(entities={}, history=[], counter=0, max_entities=3)
+        for i in range(3):
+            context.counter = i
+            context.add_message_entities({"first": i})
+        context.counter = 3
+        context.add_message_entities({"second": "foo"})
+        assert context.first.values() == [2, 1]
+        assert context.second.get_value() == "foo"
+        assert context.evicted['budget'] == 1
+
+    def test_max_age(self):
+        context = Context(entities={}, history=[], counter=0, max_age=1)
+        context.myentity = "old"
+        context.counter = 2
+        context.other = "new"
+        context.prune()
+        assert "myentity" not in context
+        assert context.other.get_value() == "new"
+        assert context.evicted['age'] == 1
+
+    def test_max_seconds(self):
+        context = Context(entities={}, history=[], counter=0, max_seconds=60)
+        context.myentity = EntityValue("myentity", counter=0, state_set=None, value="old", timestamp=time.time() - 120)
+        assert "myentity" not in context
+        assert context.evicted['expired'] == 1
+
+    def test_load_enforces_limits(self, settings):
+        settings.BOT_CONFIG['CONTEXT_MAX_DEPTH'] = 2
+        try:
+            values = [EntityValue("myentity", counter=0, state_set=None, value=str(i)) for i in range(5)]
+            context = Context.load({"version": 2, "counter": 0, "history": [], "entities": {"myentity": values}})
+        finally:
+            del settings.BOT_CONFIG['CONTEXT_MAX_DEPTH']
+        assert context.myentity.values() == ["0", "1"]
+        assert context.to_dict()['evicted']['depth'] == 3
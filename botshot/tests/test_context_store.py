@@ -0,0 +1,148 @@
+import pytest
+
+from botshot.core.context import Context
+from botshot.core.context_store import LocalContextStore, DatabaseContextStore, RedisContextStore
+from botshot.models import ChatConversation, ContextEntityIndex
+
+
+@pytest.fixture
+def store(settings):
+    settings.BOT_CONFIG['CONTEXT_STORE_FLUSH_SIZE'] = 2
+    settings.BOT_CONFIG['CONTEXT_STORE_FLUSH_SECONDS'] = 3600
+    yield LocalContextStore()
+    del settings.BOT_CONFIG['CONTEXT_STORE_FLUSH_SIZE']
+    del settings.BOT_CONFIG['CONTEXT_STORE_FLUSH_SECONDS']
+
+
+@pytest.fixture
+def redis_store(settings, monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr("botshot.core.context_store.get_redis", lambda: redis)
+    settings.BOT_CONFIG['CONTEXT_STORE_FLUSH_SIZE'] = 2
+    settings.BOT_CONFIG['CONTEXT_STORE_FLUSH_SECONDS'] = 3600
+    yield RedisContextStore()
+    del settings.BOT_CONFIG['CONTEXT_STORE_FLUSH_SIZE']
+    del settings.BOT_CONFIG['CONTEXT_STORE_FLUSH_SECONDS']
+
+
+def _conversation():
+    conversation = ChatConversation()
+    conversation.interface_name = 'test'
+    conversation.raw_conversation_id = 'chat_id'
+    conversation.save()
+    return conversation
+
+
+def _process(store, conversation, state, value):
+    context = store.load(conversation)
+    context.counter += 1
+    context.myentity = value
+    conversation.state = state
+    conversation.context_dict = context.to_dict()
+    store.save(conversation)
+
+
+@pytest.mark.django_db
+class TestContextStore:
+
+    def test_database_store(self):
+        store = DatabaseContextStore()
+        conversation = _conversation()
+        _process(store, conversation, 'default.root', 'foo')
+        fresh = ChatConversation.objects.get(pk=conversation.pk)
+        assert store.load(fresh).myentity.get_value() == 'foo'
+
+    @pytest.mark.django_db(transaction=True)
+    def test_write_behind(self, store):
+        conversation = _conversation()
+        _process(store, conversation, 'default.root', 'foo')
+
+        # state is written immediately, context only to cache
+        fresh = ChatConversation.objects.get(pk=conversation.pk)
+        assert fresh.state == 'default.root'
+        assert fresh.context_dict is None and fresh.context_version == 0
+        context = store.load(fresh)
+        assert context.counter == 1 and context.myentity.get_value() == 'foo'
+
+        _process(store, fresh, 'default.next', 'bar')
+        assert ChatConversation.objects.get(pk=conversation.pk).context_version == 0
+
+        # another conversation reaches the flush size
+        _process(store, _conversation(), 'default.root', 'baz')
+        fresh = ChatConversation.objects.get(pk=conversation.pk)
+        assert fresh.context_version == 2
+        assert Context.load(fresh.context_dict).myentity.get_value() == 'bar'
+        assert not store.dirty
+        # the entity index is updated when the context is written
+        assert ContextEntityIndex.objects.get(conversation=conversation, entity='myentity').value_key == '"bar"'
+
+    def test_database_fallback(self, store):
+        conversation = _conversation()
+        _process(store, conversation, 'default.root', 'foo')
+        store.flush()
+        # a newer version was written by another worker
+        ChatConversation.objects.filter(pk=conversation.pk).update(
+            context_dict={'counter': 5, 'history': [], 'entities': {}}, context_version=10
+        )
+        fresh = ChatConversation.objects.get(pk=conversation.pk)
+        assert store.load(fresh).counter == 5
+
+    def test_stale_flush_is_ignored(self, store):
+        conversation = _conversation()
+        _process(store, conversation, 'default.root', 'foo')
+        ChatConversation.objects.filter(pk=conversation.pk).update(context_version=10)
+        store.flush()
+        fresh = ChatConversation.objects.get(pk=conversation.pk)
+        assert fresh.context_dict is None and fresh.context_version == 10
+
+    def test_pending_contexts_are_not_evicted(self, store):
+        store.max_size = 1
+        conversations = [_conversation() for _ in range(2)]
+        # not in the database, its flush is skipped
+        store._put(12345, 1, {'counter': 1})
+        for conversation in conversations:
+            store._put(conversation.conversation_id, 1, {'counter': 1, 'history': [], 'entities': {}})
+        assert len(store.cache) == 3
+        store.flush()
+        assert list(store.dirty) == [12345]
+        assert list(store.cache) == [12345]
+        assert store._pending() == [(12345, 1, {'counter': 1})]
+
+
+@pytest.mark.django_db
+class TestRedisContextStore:
+
+    def test_put_and_get(self, redis_store):
+        conversation = _conversation()
+        _process(redis_store, conversation, 'default.root', 'foo')
+        fresh = ChatConversation.objects.get(pk=conversation.pk)
+        assert fresh.context_dict is None
+        assert redis_store.load(fresh).myentity.get_value() == 'foo'
+        assert redis_store._pending_count() == 1
+
+    def test_pending_is_bounded(self, redis_store):
+        for i in range(5):
+            redis_store._put(i + 1, 1, {'counter': i})
+        pending = redis_store._pending()
+        assert len(pending) == 2
+        assert all(version == 1 for _, version, _ in pending)
+
+    def test_save_during_flush_stays_pending(self, redis_store):
+        redis_store._put(1, 1, {'counter': 1})
+        [(conversation_id, version, _)] = redis_store._pending()
+        # the context is saved again before the flush marks it as written
+        redis_store._put(1, 2, {'counter': 2})
+        redis_store._mark_written(conversation_id, version)
+        assert [(id, version) for id, version, _ in redis_store._pending()] == [(1, 2)]
+        redis_store._mark_written(1, 2)
+        assert redis_store._pending() == []
+
+    def test_flush(self, redis_store):
+        conversation = _conversation()
+        _process(redis_store, conversation, 'default.root', 'foo')
+        redis_store.flush()
+        fresh = ChatConversation.objects.get(pk=conversation.pk)
+        assert fresh.context_version == 1
+        assert Context.load(fresh.context_dict).myentity.get_value() == 'foo'
+        assert redis_store._pending_count() == 0
@@ -0,0 +1,81 @@
+import pytest
+from django.core.management import call_command
+
+from botshot.core.context import Context
+from botshot.core.context_store import DatabaseContextStore
+from botshot.core.conversation_filter import AllConversationFilter, EntityValueConversationFilter
+from botshot.models import ChatConversation, ContextEntityIndex
+
+
+def _conversation(store, values, counter=0):
+    conversation = ChatConversation(interface_name='test', raw_conversation_id='chat_id')
+    conversation.save()
+    context = Context.load({})
+    for entity, value in values.items():
+        context[entity] = value
+    context.counter = counter
+    conversation.context_dict = context.to_dict()
+    store.save(conversation)
+    return conversation.pk
+
+
+@pytest.mark.django_db
+class TestConversationFilter:
+
+    def test_all_conversations_keyset(self):
+        store = DatabaseContextStore()
+        ids = [_conversation(store, {}) for _ in range(5)]
+        assert list(AllConversationFilter().iter_id_chunks(2)) == [ids[0:2], ids[2:4], ids[4:5]]
+        assert AllConversationFilter().get_ids() == ids
+
+    def test_entity_value_filter(self):
+        store = DatabaseContextStore()
+        foo = _conversation(store, {"city": "Prague"})
+        bar = _conversation(store, {"city": "Brno"})
+        empty = _conversation(store, {"city": ""})
+        old = _conversation(store, {"city": "Prague"}, counter=5)
+        _conversation(store, {})
+        assert EntityValueConversationFilter("city", "Prague").get_ids() == [foo, old]
+        assert EntityValueConversationFilter("city").get_ids() == [foo, bar, old]
+        assert EntityValueConversationFilter("city", "Prague", max_age=2).get_ids() == [foo]
+        assert empty not in EntityValueConversationFilter("city").get_ids()
+
+    def test_index_follows_latest_value(self):
+        store = DatabaseContextStore()
+        id = _conversation(store, {"city": "Prague"})
+        conversation = ChatConversation.objects.get(pk=id)
+        context = store.load(conversation)
+        context.city = "Brno"
+        conversation.context_dict = context.to_dict()
+        store.save(conversation)
+        assert EntityValueConversationFilter("city", "Prague").get_ids() == []
+        assert EntityValueConversationFilter("city", "Brno").get_ids() == [id]
+
+    def test_only_changed_entities_are_written(self, django_assert_num_queries):
+        store = DatabaseContextStore()
+        id = _conversation(store, {"city": "Prague", "name": "Foo", "color": "red"})
+        conversation = ChatConversation.objects.get(pk=id)
+        context = store.load(conversation)
+        context.counter += 1
+        conversation.context_dict = context.to_dict()
+        # only the conversation is updated
+        with django_assert_num_queries(1):
+            store.save(conversation)
+        context = store.load(conversation)
+        context.counter += 1
+        context.city = "Brno"
+        context.size = "XL"
+        del context.entities["color"]
+        conversation.context_dict = context.to_dict()
+        # update conversation, delete color, update city, insert size
+        with django_assert_num_queries(4):
+            store.save(conversation)
+        rows = dict(ContextEntityIndex.objects.filter(conversation_id=id).values_list('entity', 'value_key'))
+        assert rows == {"city": '"Brno"', "name": '"Foo"', "size": '"XL"'}
+        assert ChatConversation.objects.get(pk=id).context_counter == 2
+
+    def test_rebuild_index(self):
+        id = _conversation(DatabaseContextStore(), {"city": "Prague"})
+        ContextEntityIndex.objects.all().delete()
+        call_command("rebuild_context_index")
+        assert EntityValueConversationFilter("city", "Prague").get_ids() == [id]
@@ -0,0 +1,68 @@
+import mock
+import pytest
+
+from botshot.core import dispatch
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr("botshot.core.dispatch.get_redis", lambda: redis)
+    return redis
+
+
+@pytest.fixture
+def shards(settings, monkeypatch):
+    settings.BOT_CONFIG['DISPATCH_SHARDS'] = 4
+    monkeypatch.setattr("botshot.core.dispatch.get_redis", lambda: None)
+    yield 4
+    del settings.BOT_CONFIG['DISPATCH_SHARDS']
+
+
+def handler(**kwargs):
+    pass
+
+
+class TestDispatch:
+
+    def test_shard_is_stable(self, shards):
+        shard = dispatch.get_shard("facebook", "12345")
+        assert 0 <= shard < shards
+        assert all(dispatch.get_shard("facebook", "12345") == shard for _ in range(10))
+        assert len({dispatch.get_shard("facebook", str(i)) for i in range(100)}) == shards
+
+    def test_dispatch_to_shard_queue(self, shards, monkeypatch):
+        apply_async = mock.Mock()
+        monkeypatch.setattr("botshot.core.dispatch.sharded_method_call_wrapper.apply_async", apply_async)
+        dispatch.dispatch(handler, interface_name="facebook", raw_conversation_id="12345", foo="bar")
+        shard = dispatch.get_shard("facebook", "12345")
+        apply_async.assert_called_once_with(
+            args=(handler, shard, True), kwargs={"foo": "bar"}, queue="botshot_shard_{}".format(shard)
+        )
+
+    def test_dispatch_disabled(self, monkeypatch):
+        run_async = mock.Mock()
+        monkeypatch.setattr("botshot.core.dispatch.run_async", run_async)
+        dispatch.dispatch(handler, interface_name="facebook", raw_conversation_id="12345", foo="bar")
+        run_async.assert_called_once_with(handler, _at=None, _seconds=None, foo="bar")
+
+    def test_queue_depth(self, shards, redis, monkeypatch):
+        monkeypatch.setattr("botshot.core.dispatch.sharded_method_call_wrapper.apply_async", mock.Mock())
+        shard = dispatch.get_shard("facebook", "12345")
+        dispatch.dispatch(handler, interface_name="facebook", raw_conversation_id="12345")
+        dispatch.dispatch(handler, interface_name="facebook", raw_conversation_id="12345")
+        # delayed tasks don't wait for a worker yet
+        dispatch.dispatch(handler, interface_name="facebook", raw_conversation_id="12345", _seconds=60)
+        assert dispatch.get_queue_depths()[shard] == 2
+        dispatch.on_task_started(shard)
+        depths = dispatch.get_queue_depths()
+        assert depths[shard] == 1 and len(depths) == shards
+
+    def test_queue_depth_on_publish_error(self, shards, redis, monkeypatch):
+        monkeypatch.setattr(
+            "botshot.core.dispatch.sharded_method_call_wrapper.apply_async", mock.Mock(side_effect=OSError())
+        )
+        with pytest.raises(OSError):
+            dispatch.dispatch(handler, interface_name="facebook", raw_conversation_id="12345")
+        assert dispatch.get_queue_depths()[dispatch.get_shard("facebook", "12345")] == 0
@@ -0,0 +1,123 @@
+import json
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import pytz
+
+pytest.importorskip("elasticsearch")
+
+from botshot.core.logging import elastic
+from botshot.core.responses import TextMessage
+from botshot.models import ChatMessage
+
+
+class ElasticStub(BaseHTTPRequestHandler):
+    """Accepts bulk requests like Elasticsearch and records the indexed documents."""
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def _respond(self, body):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        self.do_POST()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        lines = [json.loads(line) for line in self.rfile.read(length).decode('utf8').splitlines() if line]
+        ElasticStub.requests.append((self.path, lines))
+        actions = lines[::2]
+        self._respond({
+            "took": 1, "errors": False,
+            "items": [{"index": {"_index": a["index"]["_index"], "status": 201}} for a in actions],
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def elastic_url(settings):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ElasticStub)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    ElasticStub.requests = []
+    url = "http://127.0.0.1:{}".format(server.server_port)
+    settings.BOT_CONFIG['ELASTIC'] = {'URL': url, 'BULK_SIZE': 3, 'FLUSH_SECONDS': 60}
+    elastic._client = elastic._indexer = None
+    yield url
+    del settings.BOT_CONFIG['ELASTIC']
+    elastic._client = elastic._indexer = None
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def message():
+    message = ChatMessage(type=ChatMessage.MESSAGE, text="Hello", is_user=True,
+                          time=datetime(2026, 10, 18, 12, tzinfo=pytz.utc))
+    message.conversation_id = 1
+    message.entities = {"intent": [{"value": "greeting"}]}
+    return message
+
+
+class TestElasticsearchLogger:
+
+    def test_client_is_shared(self, elastic_url):
+        assert elastic.get_elastic() is elastic.get_elastic()
+
+    def test_bulk_on_size(self, elastic_url, message):
+        logger = elastic.ElasticsearchLogger()
+        logger.log_batch([
+            ('log_user_message_start', message, {'accepted_state': 'default.root'}),
+            ('log_bot_response', message, {'response': TextMessage("Hi"), 'timestamp': message.time.timestamp()}),
+        ])
+        assert ElasticStub.requests == []
+        logger.log_user_message_end(message, 'default.root')
+        logger.log_error(message, 'default.root', ValueError("oops"))
+        assert len(ElasticStub.requests) == 1
+        path, lines = ElasticStub.requests[0]
+        assert path.startswith("/_bulk")
+        assert lines[0] == {"index": {"_index": "message-log-2026.10.18"}}
+        assert [doc['type'] for doc in lines[1::2]] == ['TextMessage', ChatMessage.MESSAGE, 'error']
+        assert lines[1]['state'] == 'default.root'
+        assert lines[3]['entities'] == {"intent": [{"value": "greeting"}]}
+        elastic.get_indexer().flush()
+        assert len(ElasticStub.requests) == 1
+
+    def test_failed_documents_are_kept(self, settings, message):
+        settings.BOT_CONFIG['ELASTIC'] = {'URL': 'http://127.0.0.1:1', 'BULK_SIZE': 10, 'TIMEOUT': 1}
+        elastic._client = elastic._indexer = None
+        try:
+            logger = elastic.ElasticsearchLogger()
+            logger.log_user_message_end(message, 'default.root')
+            elastic.get_indexer().flush()
+            assert len(elastic.get_indexer().items) == 1
+        finally:
+            del settings.BOT_CONFIG['ELASTIC']
+            elastic._client = elastic._indexer = None
+
+    def test_monthly_index(self, settings):
+        settings.BOT_CONFIG['ELASTIC'] = {'HOST': 'localhost', 'INDEX': 'bot', 'INDEX_PERIOD': 'month'}
+        timestamp = datetime(2026, 1, 31, 23, 59, tzinfo=pytz.utc).timestamp()
+        assert elastic.get_index_name(timestamp) == 'bot-2026.01'
+        del settings.BOT_CONFIG['ELASTIC']
+
+    def test_flush_on_time(self, elastic_url, settings, message):
+        import time
+        settings.BOT_CONFIG['ELASTIC']['FLUSH_SECONDS'] = 0.1
+        elastic.ElasticsearchLogger().log_user_message_end(message, 'default.root')
+        for _ in range(50):
+            if ElasticStub.requests:
+                break
+            time.sleep(0.1)
+        assert len(ElasticStub.requests) == 1
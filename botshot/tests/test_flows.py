@@ -1,3 +1,6 @@
+import os
+import time
+
 import pytest
 import yaml
 
@@ -24,3 +27,173 @@ class TestFlows:
         assert "root" in flow.states
         assert flow.matches_intent("default")
         assert not flow.matches_intent("deflate")
+
+
+class TestFlowRouter:
+
+    def _flows(self):
+        from botshot.core.flow import State
+        flows = {}
+        for name, intent in [("default", "(default.*)"), ("greeting", "greeting"), ("catch", ".*")]:
+            flows[name] = Flow(name, intent=intent)
+            flows[name].add_state(State("root", action=None))
+        flows['greeting'].add_state(State("hello", action=None, intent="hello|hi"))
+        flows['greeting'].add_state(State("hi", action=None, intent="hi"))
+        flows['greeting'].set_accepts("name")
+        flows['catch'].set_accepts("name").set_accepts("place")
+        return flows
+
+    def test_intent_routing(self):
+        from botshot.core.flow import FlowRouter
+        flows = self._flows()
+        router = FlowRouter(flows)
+        for intent in ["default", "default_foo", "greeting", "greetings", "hi", "xyz"]:
+            expected = next((f for f in flows.values() if f.matches_intent(intent)), None)
+            assert router.get_flow_for_intent(intent) is expected
+            assert router.get_state_for_intent("greeting", intent) == flows['greeting'].get_state_for_intent(intent)
+        assert router.get_state_for_intent("greeting", "hi") == "greeting.hello"
+        assert router.get_state_for_intent("default", "hi") is None
+
+    def test_backreferences_are_not_combined(self):
+        from botshot.core.flow import IntentMatcher
+        matcher = IntentMatcher([(r"(a)\1", 1), (r"(b)\1", 2)])
+        assert matcher.combined is None
+        assert matcher.match("bb") == 2 and matcher.match("ab") is None
+
+    def test_entity_routing(self):
+        from botshot.core.flow import FlowRouter
+        flows = self._flows()
+        router = FlowRouter(flows)
+        assert router.get_flow_for_entities(["place", "name"]) is flows['greeting']
+        assert router.get_flow_for_entities(["place"]) is flows['catch']
+        assert router.get_flow_for_entities(["foo"]) is None
+
+    def test_router_rebuilt_on_change(self):
+        from botshot.core.flow import State, get_router
+        flows = self._flows()
+        router = get_router(flows)
+        assert get_router(flows) is router
+        flows['greeting'].add_state(State("bye", action=None, intent="bye"))
+        assert get_router(flows) is not router
+        assert get_router(flows).get_state_for_intent("greeting", "bye") == "greeting.bye"
+
+    def test_router_rebuilt_on_intent_change(self):
+        from botshot.core.flow import get_router
+        flows = self._flows()
+        get_router(flows)
+        flows['greeting'].get_state("hi").intent = "hey"
+        assert get_router(flows).get_state_for_intent("greeting", "hey") == "greeting.hi"
+
+    def test_precomputed_literals_match_like_regexes(self):
+        import re
+        from botshot.core.flow import IntentMatcher
+        items = [("greet", 1), ("hi|hello", 2), ("greeting", 3), ("h", 4), ("", 5), ("bye", 6)]
+        matcher = IntentMatcher(items)
+        assert set(matcher.cache) == {"greet", "greeting", "h", "", "bye"}
+        for intent, result in matcher.cache.items():
+            assert result == next(r for regex, r in items if re.match(regex, intent))
+
+    def test_conditional_groups_are_not_combined(self):
+        from botshot.core.flow import IntentMatcher
+        matcher = IntentMatcher([("(a)?(?(1)b|c)", "first"), ("(x)y", "second")])
+        assert matcher.combined is None
+        assert matcher.match("ab") == "first" and matcher.match("c") == "first"
+        assert matcher.match("xy") == "second"
+
+
+def greet(dialog):
+    dialog.send("Hello")
+
+
+GREETING_FLOW = """
+greeting:
+    states:
+    - name: root
+      action: test_flows.greet
+"""
+
+DEFAULT_FLOW = """
+default:
+    states:
+    - name: root
+      action: test_flows.missing_action
+"""
+
+
+class TestGetFlows:
+
+    @pytest.fixture
+    def bots(self, tmp_path, monkeypatch, settings):
+        from botshot.core import flow
+        bots = tmp_path / "bots"
+        bots.mkdir()
+        (bots / "default.yml").write_text(DEFAULT_FLOW)
+        (bots / "empty.yml").write_text("")
+        (bots / "greeting.yml").write_text(GREETING_FLOW)
+        settings.BASE_DIR = str(tmp_path)
+        settings.BOT_CONFIG = {
+            'BOTS': ['bots/default.yml', 'bots/empty.yml', 'bots/greeting.yml'],
+            'FLOW_CACHE_DIR': str(tmp_path / "cache"),
+            'FLOW_RELOAD_SECONDS': 0,
+        }
+        monkeypatch.setattr(flow, "_FLOWS", None)
+        monkeypatch.setattr(flow, "_FILES", {})
+        monkeypatch.syspath_prepend("botshot/tests")
+        return bots
+
+    def test_files_after_empty_file_are_loaded(self, bots):
+        from botshot.core.flow import get_flows
+        assert set(get_flows()) == {'default', 'greeting'}
+
+    def test_actions_are_imported_on_first_use(self, bots):
+        from botshot.core.flow import LazyAction, get_flows
+        flows = get_flows()
+        action = flows['greeting']['root'].action
+        assert isinstance(action, LazyAction)
+        assert action.resolve().__name__ == "greet"
+        with pytest.raises(ImportError):
+            flows['default']['root'].action(dialog=None)
+
+    def test_missing_action_module_is_reported_on_load(self, bots):
+        from botshot.core.flow import get_flows
+        (bots / "default.yml").write_text(DEFAULT_FLOW.replace("test_flows.", "missing_module."))
+        with pytest.raises(ImportError):
+            get_flows()
+
+    @pytest.mark.skipif(not hasattr(os, "getuid"), reason="POSIX permissions")
+    def test_cache_writable_by_others_is_not_used(self, bots, tmp_path, settings):
+        from botshot.core.flow import get_flows
+        cache = tmp_path / "cache"
+        cache.mkdir()
+        cache.chmod(0o777)
+        get_flows()
+        assert list(cache.iterdir()) == []
+
+    def test_definitions_are_cached_by_content(self, bots, monkeypatch):
+        import yaml
+        from botshot.core.flow import get_flows
+        get_flows()
+        monkeypatch.setattr(yaml, "load", None)
+        flows = get_flows(cache=False)
+        assert 'greeting' in flows
+
+    def test_hot_reload_loads_changed_files(self, bots, settings):
+        from botshot.core.flow import get_flows
+        settings.BOT_CONFIG = dict(settings.BOT_CONFIG, FLOW_HOT_RELOAD=True)
+        flows = get_flows()
+        default = flows['default']
+        greeting = bots / "greeting.yml"
+        greeting.write_text(GREETING_FLOW.replace("greeting:", "hello:"))
+        os.utime(str(greeting), (time.time() + 10, time.time() + 10))
+        flows = get_flows()
+        assert set(flows) == {'default', 'hello'}
+        assert flows['default'] is default
+
+    def test_hot_reload_keeps_flows_on_error(self, bots, settings):
+        from botshot.core.flow import get_flows
+        settings.BOT_CONFIG = dict(settings.BOT_CONFIG, FLOW_HOT_RELOAD=True)
+        flows = get_flows()
+        greeting = bots / "greeting.yml"
+        greeting.write_text(GREETING_FLOW.replace("greeting:", "default:"))
+        os.utime(str(greeting), (time.time() + 10, time.time() + 10))
+        assert get_flows() is flows
@@ -0,0 +1,48 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from botshot.core import http, metrics
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ports = []
+
+    def do_GET(self):
+        Handler.ports.append(self.client_address[1])
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    Handler.ports = []
+    yield "http://127.0.0.1:{}".format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+class TestHttp:
+
+    def test_connection_is_reused(self, server):
+        for _ in range(3):
+            assert http.get(server + "/test").text == "ok"
+        assert len(Handler.ports) == 3
+        assert len(set(Handler.ports)) == 1
+
+    def test_latency_is_recorded(self, server):
+        metrics.reset()
+        http.get(server + "/test", endpoint="test.endpoint")
+        histogram = metrics.get_metrics()["histograms"]["http.latency.test.endpoint"]
+        assert histogram["count"] == 1
@@ -3,10 +3,12 @@ from time import time
 
 import pytest
 from django.conf import settings
-from django.test import RequestFactory
+from django.test import RequestFactory, override_settings
 from django.test.client import JSON_CONTENT_TYPE_RE
 from mock import Mock
 
+from botshot.core import interface_factory
+from botshot.core.interface_factory import InterfaceFactory
 from botshot.core.interfaces.alexa import AlexaInterface
 from botshot.core.interfaces.facebook import FacebookInterface
 from botshot.core.interfaces.telegram import TelegramInterface
@@ -82,11 +84,146 @@ class TestFacebookInterface():
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.json = lambda: {"first_name": "foo", "last_name": "bar"}
-        monkeypatch.setattr("requests.get", lambda x: mock_response)
+        monkeypatch.setattr("botshot.core.http.get", lambda url, endpoint=None: mock_response)
         interface.fill_user_details(user)
         assert user.first_name == 'foo' and user.last_name == 'bar'
 
 
+    def _conversations(self, count):
+        conversations = []
+        for i in range(count):
+            conversation = ChatConversation(interface_name='facebook', raw_conversation_id=str(i))
+            conversation.meta = {"page_id": self.page['PAGE_ID']}
+            conversation.save()
+            conversations.append(conversation)
+        return conversations
+
+    def test_broadcast_batches(self, interface, monkeypatch):
+        from botshot.core.responses import TextMessage
+        batches = []
+
+        def post(url, endpoint=None, data=None, **kwargs):
+            batch = json.loads(data['batch'])
+            batches.append(batch)
+            response = Mock()
+            response.status_code = 200
+            response.headers = {'X-App-Usage': '{"call_count": 10, "total_time": 5}'}
+            response.json = lambda: [{"code": 200, "body": "{}"} for _ in batch]
+            return response
+
+        monkeypatch.setattr("botshot.core.http.post", post)
+        stats = interface.broadcast_responses(self._conversations(60), [TextMessage("a"), TextMessage("b")])
+        assert stats == {'sent': 60, 'failed': 0, 'skipped': 0}
+        assert sorted(len(batch) for batch in batches) == [20, 50, 50]
+        # responses of one conversation are chained in order
+        first, second = batches[0][0], batches[0][1]
+        assert second['depends_on'] == first['name']
+        assert interface.pacer.usage == 10
+
+    def test_broadcast_resume(self, interface, monkeypatch):
+        fakeredis = pytest.importorskip("fakeredis")
+        from botshot.core.responses import TextMessage
+        redis = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr("botshot.core.interfaces.facebook.get_redis", lambda: redis)
+        conversations = self._conversations(3)
+
+        def post(url, endpoint=None, data=None, **kwargs):
+            batch = json.loads(data['batch'])
+            response = Mock()
+            response.status_code = 200
+            response.headers = {}
+            # the second conversation fails
+            response.json = lambda: [{"code": 200 if '"1"' not in r['body'] and '%221%22' not in r['body'] else 400}
+                                     for r in batch]
+            return response
+
+        monkeypatch.setattr("botshot.core.http.post", post)
+        stats = interface.broadcast_responses(conversations, [TextMessage("a")], broadcast_id="news")
+        assert stats == {'sent': 2, 'failed': 1, 'skipped': 0}
+        stats = interface.broadcast_responses(conversations, [TextMessage("a")], broadcast_id="news")
+        assert stats == {'sent': 0, 'failed': 1, 'skipped': 2}
+
+    def test_broadcast_read_timeout_is_not_retried(self, interface, monkeypatch):
+        import requests
+        fakeredis = pytest.importorskip("fakeredis")
+        from botshot.core.interfaces.facebook import BroadcastProgress
+        from botshot.core.responses import TextMessage
+        redis = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr("botshot.core.interfaces.facebook.get_redis", lambda: redis)
+        conversations = self._conversations(3)
+        post = Mock(side_effect=requests.ReadTimeout())
+        monkeypatch.setattr("botshot.core.http.post", post)
+        stats = interface.broadcast_responses(conversations, [TextMessage("a")], broadcast_id="news")
+        assert stats == {'sent': 0, 'failed': 3, 'skipped': 0}
+        assert post.call_count == 1
+        assert BroadcastProgress("news").get_unknown() == {c.conversation_id for c in conversations}
+        # resuming the broadcast doesn't send the messages twice
+        stats = interface.broadcast_responses(conversations, [TextMessage("a")], broadcast_id="news")
+        assert stats == {'sent': 0, 'failed': 0, 'skipped': 3}
+
+    def test_broadcast_connection_error_is_retried(self, interface, monkeypatch):
+        import requests
+        from botshot.core.responses import TextMessage
+        response = Mock()
+        response.status_code = 200
+        response.headers = {}
+        response.json = lambda: [{"code": 200, "body": "{}"}]
+        post = Mock(side_effect=[requests.ConnectTimeout(), response])
+        monkeypatch.setattr("botshot.core.http.post", post)
+        stats = interface.broadcast_responses(self._conversations(1), [TextMessage("a")])
+        assert stats == {'sent': 1, 'failed': 0, 'skipped': 0}
+        assert post.call_count == 2
+
+    def test_concurrent_attachment_uploads_are_deduplicated(self, interface, monkeypatch):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        fakeredis = pytest.importorskip("fakeredis")
+        redis = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr("botshot.core.interfaces.facebook.get_redis", lambda: redis)
+        uploads = []
+
+        def upload(page, url, media_type, is_reusable):
+            uploads.append(url)
+            threading.Event().wait(0.2)
+            return "att_" + url
+
+        monkeypatch.setattr(interface, "_upload_to_page", upload)
+        meta = {"page_id": self.page['PAGE_ID']}
+        with ThreadPoolExecutor(8) as executor:
+            ids = list(executor.map(lambda _: interface.get_attachment_id(meta, "http://a/1.jpg", "image"), range(8)))
+        assert ids == ["att_http://a/1.jpg"] * 8
+        assert uploads == ["http://a/1.jpg"]
+        # another process reads it from Redis
+        settings.BOT_CONFIG['FB_PAGES'] = [self.page]
+        other = FacebookInterface()
+        monkeypatch.setattr(other, "_upload_to_page", upload)
+        assert other.get_attachment_id(meta, "http://a/1.jpg", "image") == "att_http://a/1.jpg"
+        assert len(uploads) == 1
+        # not reusable attachments are always uploaded
+        interface.get_attachment_id(meta, "http://a/1.jpg", "image", is_reusable=False)
+        assert len(uploads) == 2
+
+    def test_attachments_are_prefetched(self, interface, monkeypatch):
+        from botshot.core.responses import MediaMessage, TextMessage
+        uploaded = []
+        monkeypatch.setattr("botshot.core.interfaces.facebook.get_redis", lambda: None)
+        monkeypatch.setattr(interface, "_upload_to_page", lambda page, url, media_type, reusable: uploaded.append(url) or url)
+        posted = []
+        monkeypatch.setattr("botshot.core.http.post", lambda url, endpoint=None, data=None, **kwargs: posted.append(data) or Mock(status_code=200))
+        responses = [MediaMessage("http://a/{}.jpg".format(i)) for i in range(3)] + [TextMessage("hi")]
+        interface._send_responses("fbid", {"page_id": self.page['PAGE_ID']}, responses)
+        assert sorted(uploaded) == ["http://a/0.jpg", "http://a/1.jpg", "http://a/2.jpg"]
+        assert json.loads(posted[0])['message']['attachment']['payload']['elements'][0]['attachment_id'] == "http://a/0.jpg"
+
+    def test_usage_pacing(self):
+        from botshot.core.interfaces.facebook import UsagePacer
+        pacer = UsagePacer(max_usage=80, max_delay=60)
+        pacer.update({'X-Page-Usage': '{"call_count": 50}'})
+        assert pacer.get_delay() == 0
+        pacer.update({'X-App-Usage': '{"call_count": 90}', 'X-Page-Usage': '{"call_count": 50}'})
+        assert pacer.get_delay() == 30
+
+
 class TestTelegramInterface():
 
     token = '000000000:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
@@ -172,3 +309,107 @@ class TestAlexaInterface():
         message, entities = interface.parse_raw_message(req)
         assert entities['intent'][0]['value'] == 'search'
         assert entities['asset_type'][0]['value'] == 'movie'
+
+
+class TestInterfaceFactory:
+
+    @pytest.fixture(autouse=True)
+    def registry(self):
+        InterfaceFactory.reload()
+        yield
+        InterfaceFactory.reload()
+
+    def test_instance_is_shared(self, monkeypatch):
+        import_string = Mock(wraps=interface_factory.import_string)
+        monkeypatch.setattr(interface_factory, "import_string", import_string)
+        interface = InterfaceFactory.from_name("test")
+        assert InterfaceFactory.from_name("test") is interface
+        assert [cls.name for cls in InterfaceFactory.get_interfaces()] == ["test"]
+        assert import_string.call_count == 1
+
+    def test_unknown_name(self):
+        with pytest.raises(ValueError):
+            InterfaceFactory.from_name("foo")
+
+    def test_reload(self):
+        interface = InterfaceFactory.from_name("test")
+        InterfaceFactory.reload()
+        assert InterfaceFactory.from_name("test") is not interface
+
+    def test_settings_change_reloads(self):
+        InterfaceFactory.from_name("test")
+        with override_settings(BOT_CONFIG=dict(settings.BOT_CONFIG, INTERFACES=[
+            "botshot.core.interfaces.alexa.AlexaInterface"
+        ])):
+            assert isinstance(InterfaceFactory.from_name("alexa"), AlexaInterface)
+            with pytest.raises(ValueError):
+                InterfaceFactory.from_name("test")
+
+    @override_settings(BOT_CONFIG=dict(settings.BOT_CONFIG, INTERFACES=[
+        "botshot.core.interfaces.alexa.AlexaInterface", "botshot.core.interfaces.alexa.AlexaInterface"
+    ]))
+    def test_duplicate_names_are_rejected(self):
+        with pytest.raises(ValueError):
+            InterfaceFactory.get_interfaces()
+
+
+class TestWebchatInterface:
+
+    @pytest.fixture
+    def redis(self, monkeypatch):
+        fakeredis = pytest.importorskip("fakeredis")
+        redis = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr("botshot.webchat.push.get_redis", lambda: redis)
+        monkeypatch.setattr("botshot.webchat.push.get_pubsub_redis", lambda: redis)
+        return redis
+
+    @pytest.fixture
+    def interface(self, monkeypatch):
+        from botshot.webchat.interface import WebchatInterface
+        # renders the text instead of the template
+        monkeypatch.setattr(WebchatInterface, "render_messages", staticmethod(lambda messages: [m.text for m in messages]))
+        return WebchatInterface()
+
+    def _events(self, stream):
+        events = []
+        for chunk in stream:
+            if chunk.startswith("id: "):
+                lines = chunk.strip().split("\n")
+                events.append((int(lines[0][4:]), json.loads(lines[1][6:])['messages']))
+        return events
+
+    def test_send_responses_publishes_delta(self, redis, interface):
+        from botshot.core.responses import TextMessage
+        from botshot.webchat import push
+        conversation = ChatConversation(raw_conversation_id="abc")
+        interface.send_responses(conversation, None, [TextMessage("Hi"), TextMessage("How are you?")])
+        assert push.get_last_id("abc") == 1
+        interface.send_responses(conversation, None, [TextMessage("Bye")])
+        events = self._events(push.stream("abc", last_id=1, duration=0))
+        assert events == [(2, ["Bye"])]
+
+    def test_stream_receives_published_events(self, redis, interface):
+        import threading
+        from botshot.core.responses import TextMessage
+        from botshot.webchat import push
+        stream = push.stream("abc", last_id=0, duration=2, heartbeat=10)
+        assert next(stream).startswith("retry:")
+        conversation = ChatConversation(raw_conversation_id="abc")
+        threading.Timer(0.1, interface.send_responses, args=(conversation, None, [TextMessage("Hi")])).start()
+        assert self._events([next(stream)]) == [(1, ["Hi"])]
+        stream.close()
+
+    def test_stream_sends_heartbeats(self, redis):
+        from botshot.webchat import push
+        assert list(push.stream("abc", duration=0.3, heartbeat=0.1)).count(": ping\n\n") >= 2
+
+    def test_publish_without_redis(self, interface, monkeypatch):
+        from botshot.core.responses import TextMessage
+        from botshot.webchat import push
+        monkeypatch.setattr("botshot.webchat.push.get_redis", lambda: None)
+        interface.send_responses(ChatConversation(raw_conversation_id="abc"), None, [TextMessage("Hi")])
+        assert push.get_last_id("abc") == 0
+
+    def test_format_multiline_data(self):
+        from botshot.webchat.push import _format
+        assert _format(3, "a\nb") == "id: 3\ndata: a\ndata: b\n\n"
@@ -1,41 +1,142 @@
+import time
+import mock
+import pytest
+
+from botshot.core import metrics
 from botshot.core.logging import MessageLogger
-from botshot.core.responses import MessageElement
+from botshot.core.responses import MessageElement, TextMessage
 from botshot.models import ChatMessage
 
+from botshot.core.logging import logging_service
 from botshot.core.logging.logging_service import AsyncLoggingService
 
 
-def run_sync(method, _at=None, _seconds=None, **kwargs):
-    method(kwargs)
-    return None
-
+class RecordingLogger(MessageLogger):
 
-class TestMessageLogger(MessageLogger):
+    def __init__(self):
+        self.events = []
 
     def log_user_message_start(self, message: ChatMessage, accepted_state):
         assert message.id == 105
+        self.events.append(('start', accepted_state))
 
     def log_user_message_end(self, message: ChatMessage, final_state):
         assert message.id == 105
+        self.events.append(('end', final_state))
 
     def log_state_change(self, message: ChatMessage, state):
         assert message.id == 105
+        self.events.append(('state', state))
 
     def log_bot_response(self, message: ChatMessage, response: MessageElement, timestamp):
         assert message.id == 105
+        self.events.append(('response', response.text))
 
     def log_error(self, message: ChatMessage, state, exception):
         assert message.id == 105
+        self.events.append(('error', str(exception)))
+
+
+@pytest.fixture
+def message():
+    message = ChatMessage()
+    message.type = ChatMessage.MESSAGE
+    message.text = "Hello, world!"
+    message.id = 105
+    return message
+
+
+@pytest.fixture
+def apply_async(monkeypatch):
+    apply_async = mock.Mock()
+    monkeypatch.setattr(logging_service.celery_method_call_wrapper, "apply_async", apply_async)
+    metrics.reset()
+    monkeypatch.setattr(logging_service, "_buffer", None)
+    yield apply_async
+
+
+def run_tasks(apply_async):
+    for call in apply_async.call_args_list:
+        method, = call[1]['args']
+        method(**call[1]['kwargs'])
+
+
+class TestLoggingService:
+
+    def test_one_task_per_message(self, message, apply_async, monkeypatch):
+        monkeypatch.setattr(logging_service, "get_redis", lambda: None)
+        loggers = [RecordingLogger(), RecordingLogger()]
+        service = AsyncLoggingService(loggers)
+        service.log_user_message_start(message, 'default.root')
+        service.log_state_change(message, 'default.greeting')
+        service.log_bot_response(message, TextMessage("Hi"), timestamp=0)
+        service.log_bot_response(message, TextMessage("How are you?"), timestamp=0)
+        service.log_user_message_end(message, 'default.greeting')
+        apply_async.assert_not_called()
+        service.flush()
+        apply_async.assert_called_once()
+        run_tasks(apply_async)
+        for logger in loggers:
+            assert logger.events == [
+                ('start', 'default.root'), ('state', 'default.greeting'),
+                ('response', 'Hi'), ('response', 'How are you?'), ('end', 'default.greeting'),
+            ]
+
+    def test_batch_of_messages(self, message, apply_async, monkeypatch, settings):
+        monkeypatch.setattr(logging_service, "get_redis", lambda: None)
+        settings.BOT_CONFIG['LOGGING_BATCH_MESSAGES'] = 3
+        logger = RecordingLogger()
+        for i in range(4):
+            service = AsyncLoggingService([logger])
+            service.log_state_change(message, 'default.state_{}'.format(i))
+            service.flush()
+        del settings.BOT_CONFIG['LOGGING_BATCH_MESSAGES']
+        apply_async.assert_called_once()
+        run_tasks(apply_async)
+        assert logger.events == [('state', 'default.state_{}'.format(i)) for i in range(3)]
+        logging_service.flush_buffer()
+        assert apply_async.call_count == 2
+
+    def test_buffer_is_flushed_periodically(self, message, apply_async, monkeypatch, settings):
+        monkeypatch.setattr(logging_service, "get_redis", lambda: None)
+        settings.BOT_CONFIG['LOGGING_BATCH_MESSAGES'] = 100
+        settings.BOT_CONFIG['LOGGING_FLUSH_SECONDS'] = 0.05
+        service = AsyncLoggingService([RecordingLogger()])
+        service.log_state_change(message, 'default.root')
+        service.flush()
+        del settings.BOT_CONFIG['LOGGING_BATCH_MESSAGES']
+        del settings.BOT_CONFIG['LOGGING_FLUSH_SECONDS']
+        for _ in range(100):
+            if apply_async.called:
+                break
+            time.sleep(0.02)
+        apply_async.assert_called_once()
+
+    def test_unpicklable_exception(self, message, apply_async, monkeypatch):
+        import pickle
+        monkeypatch.setattr(logging_service, "get_redis", lambda: None)
 
+        class LocalError(Exception):
+            pass
 
-class LoggingTest:
+        service = AsyncLoggingService([RecordingLogger()])
+        service.log_error(message, 'default.root', LocalError("oops"))
+        pickle.dumps(service.events)
 
-    def test_logging_service(self, monkeypatch):
-        monkeypatch.setattr("botshot.tasks.run_async", run_sync)
-        current_state_name = 'default.root'
-        message = ChatMessage()
-        message.type = ChatMessage.MESSAGE
-        message.text = "Hello, world!"
-        message.id = 105
-        logging_service = AsyncLoggingService([TestMessageLogger()])
-        logging_service.log_user_message_start(message, current_state_name)
+    def test_drops_when_queue_is_full(self, message, apply_async, monkeypatch, settings):
+        fakeredis = pytest.importorskip("fakeredis")
+        redis = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr(logging_service, "get_redis", lambda: redis)
+        settings.BOT_CONFIG['LOGGING_MAX_PENDING'] = 2
+        for i in range(3):
+            service = AsyncLoggingService([RecordingLogger()])
+            service.log_state_change(message, 'default.root')
+            service.log_state_change(message, 'default.root')
+            service.flush()
+        del settings.BOT_CONFIG['LOGGING_MAX_PENDING']
+        assert apply_async.call_count == 2
+        assert logging_service.get_pending_batches() == 2
+        counters = metrics.get_metrics()['counters']
+        assert counters['logging.dropped_batches'] == 1 and counters['logging.dropped_events'] == 2
+        run_tasks(apply_async)
+        assert logging_service.get_pending_batches() == 0
@@ -0,0 +1,151 @@
+import time
+
+import pytest
+from django.test import override_settings
+
+from botshot.core import metrics
+from botshot.core.parsing import message_parser, nlu_cache
+from botshot.core.parsing.entity_extractor import EntityExtractor
+
+
+class FastExtractor(EntityExtractor):
+    def extract_entities(self, text: str, max_retries=5):
+        return {'intent': [{'value': 'greeting'}]}
+
+
+class SlowExtractor(EntityExtractor):
+    def extract_entities(self, text: str, max_retries=5):
+        time.sleep(0.5)
+        return {'intent': [{'value': 'slow'}]}
+
+
+class BrokenExtractor(EntityExtractor):
+    def extract_entities(self, text: str, max_retries=5):
+        raise ValueError()
+
+
+class CountingExtractor(EntityExtractor):
+    def __init__(self, entities=None):
+        super().__init__()
+        self.calls = 0
+        self.entities = entities or {'intent': [{'value': 'greeting'}]}
+
+    def extract_entities(self, text: str, max_retries=5):
+        self.calls += 1
+        return self.entities
+
+
+@pytest.fixture(autouse=True)
+def no_cached_results():
+    nlu_cache._lru.clear()
+    yield
+    nlu_cache._lru.clear()
+
+
+class TestParseTextEntities:
+
+    def test_extractors_run_concurrently(self, monkeypatch):
+        monkeypatch.setattr(message_parser, 'ENTITY_EXTRACTORS', [SlowExtractor(), SlowExtractor()])
+        start = time.time()
+        entities = message_parser.parse_text_entities("hi")
+        assert time.time() - start < 0.9
+        assert [v['value'] for v in entities['intent']] == ['slow', 'slow']
+
+    @override_settings(BOT_CONFIG={'NLU_EXTRACTOR_TIMEOUTS': {'SlowExtractor': 0.05}})
+    def test_timed_out_extractor_is_reported(self, monkeypatch):
+        extractors = [SlowExtractor(), FastExtractor(), BrokenExtractor()]
+        monkeypatch.setattr(message_parser, 'ENTITY_EXTRACTORS', extractors)
+        start = time.time()
+        entities = message_parser.parse_text_entities("hi")
+        assert time.time() - start < 0.4
+        assert entities['intent'] == [{'value': 'greeting'}]
+        assert entities[message_parser.TIMEOUTS_ENTITY] == [{'value': 'SlowExtractor'}]
+        assert entities[message_parser.ERRORS_ENTITY] == [{'value': 'BrokenExtractor'}]
+
+    @override_settings(BOT_CONFIG={'NLU_MAX_WORKERS': 1, 'NLU_EXTRACTOR_TIMEOUT': 0.8})
+    def test_timeout_counts_from_start(self, monkeypatch):
+        monkeypatch.setattr(message_parser, '_executor', None)
+        monkeypatch.setattr(message_parser, 'ENTITY_EXTRACTORS', [SlowExtractor(), SlowExtractor()])
+        # the second extractor waits for the first one, but still has its full timeout
+        entities = message_parser.parse_text_entities("hi")
+        assert [v['value'] for v in entities['intent']] == ['slow', 'slow']
+        assert message_parser.TIMEOUTS_ENTITY not in entities
+
+
+class TestNLUCache:
+
+    @pytest.fixture
+    def redis(self, monkeypatch):
+        fakeredis = pytest.importorskip("fakeredis")
+        redis = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr(nlu_cache, "get_redis", lambda: redis)
+        return redis
+
+    def test_results_are_cached(self, redis):
+        metrics.reset()
+        extractor = CountingExtractor()
+        assert extractor.extract("Hello  there ") == {'intent': [{'value': 'greeting'}]}
+        assert extractor.extract("Hello there") == {'intent': [{'value': 'greeting'}]}
+        assert extractor.calls == 1
+        counters = metrics.get_metrics()['counters']
+        assert counters['nlu_cache.CountingExtractor.hits'] == 1
+        assert counters['nlu_cache.CountingExtractor.misses'] == 1
+
+    def test_cached_results_are_copies(self, redis):
+        extractor = CountingExtractor()
+        extractor.extract("hi")['intent'].append({'value': 'changed'})
+        assert extractor.extract("hi") == {'intent': [{'value': 'greeting'}]}
+
+    def test_redis_is_shared_by_processes(self, redis):
+        CountingExtractor().extract("hi")
+        nlu_cache._lru.clear()
+        other = CountingExtractor()
+        assert other.extract("hi") == {'intent': [{'value': 'greeting'}]}
+        assert other.calls == 0
+
+    def test_key_contains_version_and_locale(self, redis):
+        extractor = CountingExtractor()
+        extractor.extract("hi")
+        extractor.model_version = "2"
+        extractor.extract("hi")
+        extractor.get_locale = lambda: "cs_CZ"
+        extractor.extract("hi")
+        assert extractor.calls == 3
+
+    def test_time_relative_results_are_not_cached(self, redis):
+        extractor = CountingExtractor({'date_interval': [{'value': 'tomorrow'}]})
+        extractor.extract("tomorrow")
+        extractor.extract("tomorrow")
+        assert extractor.calls == 2
+        with override_settings(BOT_CONFIG={'NLU_CACHE_TIME_RELATIVE_TTL': 60}):
+            extractor.extract("tomorrow")
+            extractor.extract("tomorrow")
+        assert extractor.calls == 3
+        assert 0 < redis.ttl(redis.zrange(nlu_cache.INDEX_PREFIX + "CountingExtractor", 0, 0)[0]) <= 60
+
+    @override_settings(BOT_CONFIG={'NLU_CACHE_MAX_ENTRIES': 2, 'NLU_CACHE_LRU_SIZE': 2})
+    def test_size_is_bounded(self, redis):
+        extractor = CountingExtractor()
+        for text in ["a", "b", "c"]:
+            extractor.extract(text)
+        assert len(nlu_cache._lru) == 2
+        assert redis.zcard(nlu_cache.INDEX_PREFIX + "CountingExtractor") == 2
+        assert len(redis.keys(nlu_cache.KEY_PREFIX + "CountingExtractor_*")) == 2
+        nlu_cache._lru.clear()
+        extractor.extract("a")
+        assert extractor.calls == 4
+
+    def test_clear_cache(self, redis):
+        extractor = CountingExtractor()
+        extractor.extract("hi")
+        extractor.clear_cache()
+        assert redis.keys(nlu_cache.KEY_PREFIX + "*") == []
+        extractor.extract("hi")
+        assert extractor.calls == 2
+
+    @override_settings(BOT_CONFIG={'NLU_CACHE': False})
+    def test_cache_can_be_disabled(self, redis):
+        extractor = CountingExtractor()
+        extractor.extract("hi")
+        extractor.extract("hi")
+        assert extractor.calls == 2
@@ -0,0 +1,87 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from django.test import override_settings
+
+from botshot.core.parsing.botshot_extractor import BotshotRemoteNLU
+from botshot.core.parsing.entity_extractor import EntityExtractor
+from botshot.core.parsing.nlu_server import MicroBatcher, make_server
+
+
+class BatchExtractor(EntityExtractor):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def extract_entities(self, text: str, max_retries=5):
+        return {'intent': [{'value': text}]}
+
+    def extract_entities_batch(self, texts: list):
+        self.batches.append(list(texts))
+        time.sleep(0.05)
+        return super().extract_entities_batch(texts)
+
+
+class TestMicroBatcher:
+
+    def test_concurrent_texts_are_batched(self):
+        batches = []
+        batcher = MicroBatcher(lambda texts: batches.append(texts) or [t.upper() for t in texts],
+                               max_batch_size=3, max_wait=0.2)
+        futures = [batcher.submit(text) for text in ["a", "b", "c", "d"]]
+        assert [f.result(timeout=2) for f in futures] == ["A", "B", "C", "D"]
+        assert batches == [["a", "b", "c"], ["d"]]
+        batcher.close()
+
+    def test_errors_are_passed_to_all_texts(self):
+        def fail(texts):
+            raise ValueError("broken model")
+        batcher = MicroBatcher(fail, max_wait=0.05)
+        futures = [batcher.submit(text) for text in ["a", "b"]]
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result(timeout=2)
+        batcher.close()
+
+    def test_failing_text_fails_only_its_request(self):
+        batches = []
+
+        def parse(texts):
+            batches.append(texts)
+            if "bad" in texts:
+                raise ValueError("broken text")
+            return [t.upper() for t in texts]
+        batcher = MicroBatcher(parse, max_batch_size=3, max_wait=0.2)
+        futures = [batcher.submit(text) for text in ["a", "bad", "c"]]
+        assert futures[0].result(timeout=2) == "A"
+        assert futures[2].result(timeout=2) == "C"
+        with pytest.raises(ValueError):
+            futures[1].result(timeout=2)
+        assert batches == [["a", "bad", "c"], ["a"], ["bad"], ["c"]]
+        batcher.close()
+
+
+class TestNLUServer:
+
+    @pytest.fixture
+    def server(self):
+        server = make_server(BatchExtractor(), port=0, max_batch_size=16, max_wait=0.02)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+        server.batcher.close()
+
+    def test_remote_extractor_uses_server(self, server):
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        with override_settings(BOT_CONFIG={'REMOTE_NLU_URL': url, 'NLU_CACHE': False}):
+            extractor = BotshotRemoteNLU()
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(extractor.extract, ["text {}".format(i) for i in range(8)]))
+        assert results == [{'intent': [{'value': "text {}".format(i)}]} for i in range(8)]
+        batches = server.batcher.batch_fn.__self__.batches
+        assert sum(len(batch) for batch in batches) == 8
+        assert len(batches) < 8
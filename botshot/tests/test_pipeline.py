@@ -0,0 +1,105 @@
+import time
+
+import mock
+import pytest
+
+from botshot.core import pipeline
+from botshot.core.interfaces.test import TestInterface as _TestInterface
+from botshot.core.parsing.raw_message import RawMessage
+
+
+def raw_message(text, timestamp=None):
+    return RawMessage(interface=_TestInterface(), raw_user_id="user", raw_conversation_id="chat",
+                      conversation_meta={}, type="message", text=text, payload={},
+                      timestamp=timestamp or time.time())
+
+
+@pytest.fixture
+def tasks(monkeypatch, settings):
+    """Captures tasks of both stages instead of sending them to Celery."""
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(pipeline, "get_redis", lambda: redis)
+    settings.BOT_CONFIG['PARSE_STAGE'] = True
+    settings.BOT_CONFIG['PARSE_QUEUE'] = "parse"
+    parse_tasks, process_tasks = [], []
+    monkeypatch.setattr(pipeline.celery_method_call_wrapper, "apply_async",
+                        lambda args, kwargs, **options: parse_tasks.append((args[0], kwargs, options)))
+    monkeypatch.setattr(pipeline, "dispatch", lambda method, **kwargs: process_tasks.append((method, kwargs)))
+    yield parse_tasks, process_tasks
+    del settings.BOT_CONFIG['PARSE_STAGE']
+    del settings.BOT_CONFIG['PARSE_QUEUE']
+
+
+def run(task):
+    method, kwargs = task[:2]
+    kwargs = {k: v for k, v in kwargs.items() if k not in ('interface_name', 'raw_conversation_id', '_seconds')}
+    return method(**kwargs)
+
+
+class TestPipeline:
+
+    def test_disabled(self, monkeypatch):
+        dispatch_message = mock.Mock()
+        monkeypatch.setattr(pipeline, "dispatch_message", dispatch_message)
+        message = raw_message("hi")
+        pipeline.submit(message)
+        method, dispatched = dispatch_message.call_args[0]
+        assert method.__name__ == "accept" and dispatched is message
+
+    def test_parse_then_process(self, tasks, monkeypatch):
+        parse_tasks, process_tasks = tasks
+        monkeypatch.setattr("botshot.core.chat_manager.parse_text_entities", lambda text: {"intent": [{"value": "hi"}]})
+        accept = mock.Mock()
+        monkeypatch.setattr("botshot.core.chat_manager.ChatManager.accept_with_entities", accept)
+        pipeline.submit(raw_message("hello"))
+        method, kwargs, options = parse_tasks[0]
+        assert method is pipeline.parse_stage and options == {'queue': "parse"}
+        run(parse_tasks[0])
+        method, kwargs = process_tasks[0]
+        assert method is pipeline.process_stage
+        assert kwargs['interface_name'] == "test" and kwargs['raw_conversation_id'] == "chat"
+        assert kwargs['entities'] == {"intent": [{"value": "hi"}], "_message_text": "hello"}
+        run(process_tasks[0])
+        assert accept.call_args[0][1] == kwargs['entities']
+
+    def test_parse_error(self, tasks, monkeypatch):
+        parse_tasks, process_tasks = tasks
+
+        def fail(text):
+            raise IOError("NLU unavailable")
+
+        monkeypatch.setattr("botshot.core.chat_manager.parse_text_entities", fail)
+        pipeline.submit(raw_message("hello"))
+        run(parse_tasks[0])
+        assert process_tasks[0][1]['entities'] == {"_message_text": "hello"}
+
+    def test_messages_are_processed_in_order(self, tasks, monkeypatch):
+        parse_tasks, process_tasks = tasks
+        monkeypatch.setattr("botshot.core.chat_manager.parse_text_entities", lambda text: {})
+        processed = []
+        monkeypatch.setattr("botshot.core.chat_manager.ChatManager.accept_with_entities",
+                            lambda self, message, entities: processed.append(message.text))
+        pipeline.submit(raw_message("first"))
+        pipeline.submit(raw_message("second"))
+        # the second message is parsed first
+        run(parse_tasks[1])
+        run(parse_tasks[0])
+        second, first = process_tasks
+        run(second)
+        assert processed == [] and process_tasks[-1][1]['_seconds'] > 0
+        run(first)
+        run(process_tasks[-1])
+        assert processed == ["first", "second"]
+
+    def test_wait_times_out(self, tasks, monkeypatch, settings):
+        parse_tasks, process_tasks = tasks
+        monkeypatch.setattr("botshot.core.chat_manager.parse_text_entities", lambda text: {})
+        processed = []
+        monkeypatch.setattr("botshot.core.chat_manager.ChatManager.accept_with_entities",
+                            lambda self, message, entities: processed.append(message.text))
+        pipeline.submit(raw_message("lost"))
+        pipeline.submit(raw_message("second", timestamp=time.time() - 60))
+        run(parse_tasks[1])
+        run(process_tasks[0])
+        assert processed == ["second"]
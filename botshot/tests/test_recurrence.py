@@ -0,0 +1,118 @@
+import itertools
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from botshot.core.recurrence import Recurrence, next_fire_times
+
+
+def test_weekday():
+    # Wednesday -> next Monday
+    recurrence = Recurrence.parse({"second": 0, "minute": 30, "hour": 8, "day_of_week": 0})
+    assert recurrence.next_after(datetime(2026, 10, 14, 12, 0)) == datetime(2026, 10, 19, 8, 30)
+
+
+def test_month_rollover():
+    recurrence = Recurrence.parse({"second": 0, "minute": 0, "hour": 12, "day_of_month": 5})
+    assert recurrence.next_after(datetime(2026, 12, 20)) == datetime(2027, 1, 5, 12, 0)
+    # months without the day are skipped
+    recurrence = Recurrence.parse({"second": 0, "minute": 0, "hour": 0, "day_of_month": 31})
+    assert recurrence.next_after(datetime(2027, 1, 31, 1)) == datetime(2027, 3, 31)
+
+
+def test_yearly():
+    recurrence = Recurrence.parse({"second": 0, "minute": 0, "hour": 0, "day_of_month": 1, "month_of_year": 3})
+    assert recurrence.next_after(datetime(2026, 6, 1)) == datetime(2027, 3, 1)
+    leap = Recurrence.parse({"second": 0, "minute": 0, "hour": 0, "day_of_month": 29, "month_of_year": 2})
+    assert leap.next_after(datetime(2026, 6, 1)) == datetime(2028, 2, 29)
+    assert Recurrence.parse("0 0 30 2 *").next_after(datetime(2026, 1, 1)) is None
+
+
+def test_cron():
+    recurrence = Recurrence.parse("*/15 9-17 * * 1-5")
+    assert recurrence.next_after(datetime(2026, 10, 16, 17, 50)) == datetime(2026, 10, 19, 9, 0)  # Friday evening
+    assert recurrence.next_times(datetime(2026, 10, 19, 9, 0), 3) == [
+        datetime(2026, 10, 19, 9, 15), datetime(2026, 10, 19, 9, 30), datetime(2026, 10, 19, 9, 45)
+    ]
+    # Sunday is 0 or 7 in cron
+    assert Recurrence.parse("0 0 * * 0").day_of_week == Recurrence.parse("0 0 * * 7").day_of_week == (6,)
+    # seconds
+    assert Recurrence.parse("30 * * * * *").next_after(datetime(2026, 1, 1, 0, 0, 30)) == datetime(2026, 1, 1, 0, 1, 30)
+    with pytest.raises(ValueError):
+        Recurrence.parse("* * *")
+    with pytest.raises(ValueError):
+        Recurrence.parse("0 25 * * *")
+
+
+def test_timezone_aware():
+    recurrence = Recurrence.parse({"second": 0, "minute": 0, "hour": 9})
+    prague = pytz.timezone("Europe/Prague")
+    after = prague.localize(datetime(2026, 10, 18, 10, 30))  # 8:30 UTC
+    assert recurrence.next_after(after) == datetime(2026, 10, 18, 9, 0, tzinfo=pytz.utc)
+
+
+def test_next_fire_times_shares_computation():
+    now = datetime(2026, 10, 18, tzinfo=pytz.utc)
+    until = datetime(2026, 10, 18, 2, 30, tzinfo=pytz.utc)
+    hourly = {"second": 0, "minute": 0}
+    times = next_fire_times([(1, hourly, None, None), (2, dict(hourly), None, None), (3, hourly, None, until)],
+                            3, now=now)
+    assert times[1] == times[2] == [now + timedelta(hours=h) for h in (1, 2, 3)]
+    assert times[3] == [now + timedelta(hours=h) for h in (1, 2)]
+
+
+hypothesis = pytest.importorskip("hypothesis")
+st = hypothesis.strategies
+
+
+def _values(low, high):
+    return st.one_of(st.none(), st.sets(st.integers(low, high), min_size=1, max_size=4).map(sorted))
+
+
+@st.composite
+def recurrences(draw):
+    fields = dict(
+        second=draw(st.sets(st.integers(0, 59), min_size=1, max_size=2).map(sorted)),
+        minute=draw(_values(0, 59)),
+        hour=draw(_values(0, 23)),
+        day_of_month=draw(_values(1, 28)),
+        month_of_year=draw(_values(1, 12)),
+        day_of_week=draw(_values(0, 6)),
+    )
+    return Recurrence(**fields)
+
+
+def _brute_force_next(recurrence, after):
+    """Reference implementation, checks every second of each matching day."""
+    day = datetime(after.year, after.month, after.day)
+    for _ in range(366 * 8):
+        if recurrence.matches_day(day):
+            for hour, minute, second in itertools.product(recurrence.hour, recurrence.minute, recurrence.second):
+                t = day.replace(hour=hour, minute=minute, second=second)
+                if t > after:
+                    return t
+        day += timedelta(days=1)
+    return None
+
+
+datetimes = st.datetimes(min_value=datetime(2000, 1, 1), max_value=datetime(2100, 1, 1))
+
+
+@hypothesis.settings(max_examples=200, deadline=None)
+@hypothesis.given(recurrence=recurrences(), after=datetimes)
+def test_next_after_matches_brute_force(recurrence, after):
+    after = after.replace(microsecond=0)
+    expected = _brute_force_next(recurrence, after)
+    assert recurrence.next_after(after) == expected
+    if expected is not None:
+        assert recurrence.matches(expected)
+
+
+@hypothesis.settings(max_examples=100, deadline=None)
+@hypothesis.given(recurrence=recurrences(), after=datetimes, count=st.integers(1, 10))
+def test_next_times_are_consecutive(recurrence, after, count):
+    times = recurrence.next_times(after, count)
+    assert all(a < b for a, b in zip(times, times[1:]))
+    for previous, t in zip([after] + times, times):
+        assert recurrence.next_after(previous) == t
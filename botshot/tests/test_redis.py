@@ -0,0 +1,67 @@
+import pytest
+import redis
+from django.test import override_settings
+
+from botshot.core import metrics, persistence
+from botshot.core.persistence import get_redis, pipelined
+
+
+@pytest.fixture(autouse=True)
+def no_client(monkeypatch):
+    monkeypatch.setattr(persistence, "_redis", None)
+    monkeypatch.setattr(persistence, "_redis_pid", None)
+    monkeypatch.setattr(persistence, "_pubsub_redis", None)
+    monkeypatch.setattr(persistence, "_pubsub_redis_pid", None)
+
+
+class TestGetRedis:
+
+    @override_settings(BOT_CONFIG={})
+    def test_not_configured(self):
+        with pytest.warns(UserWarning):
+            assert get_redis() is None
+
+    @override_settings(BOT_CONFIG={'REDIS_URL': 'rediss://:secret@redis.example.com:6380/3', 'REDIS_MAX_CONNECTIONS': 8})
+    def test_url_sets_db_and_tls(self):
+        pool = get_redis().connection_pool
+        assert isinstance(pool, redis.BlockingConnectionPool)
+        assert pool.max_connections == 8
+        assert pool.connection_class is redis.SSLConnection
+        assert pool.connection_kwargs['db'] == 3
+        assert pool.connection_kwargs['password'] == 'secret'
+        assert pool.connection_kwargs['health_check_interval'] == 30
+
+    @override_settings(BOT_CONFIG={'REDIS': {'HOST': 'redis', 'DB': 2}, 'REDIS_BLOCKING_POOL': False})
+    def test_config_block(self):
+        pool = get_redis().connection_pool
+        assert not isinstance(pool, redis.BlockingConnectionPool)
+        assert pool.connection_kwargs['host'] == 'redis'
+        assert pool.connection_kwargs['port'] == 6379
+        assert pool.connection_kwargs['db'] == 2
+
+    @override_settings(BOT_CONFIG={'REDIS_URL': 'redis://localhost:6379'})
+    def test_client_per_process(self, monkeypatch):
+        client = get_redis()
+        assert get_redis() is client
+        monkeypatch.setattr(persistence.os, "getpid", lambda: -1)
+        assert get_redis() is not client
+
+    @override_settings(BOT_CONFIG={'REDIS_URL': 'redis://localhost:6379/1', 'REDIS_MAX_CONNECTIONS': 8})
+    def test_pubsub_has_own_pool(self):
+        pool = persistence.get_pubsub_redis().connection_pool
+        assert pool is not get_redis().connection_pool
+        assert not isinstance(pool, redis.BlockingConnectionPool)
+        assert pool.max_connections == 1000
+        assert pool.connection_kwargs['db'] == 1
+
+    def test_connection_wait_is_recorded(self):
+        fakeredis = pytest.importorskip("fakeredis")
+        metrics.reset()
+        pool = persistence.TimedBlockingConnectionPool(
+            connection_class=getattr(fakeredis, "FakeRedisConnection", fakeredis.FakeConnection),
+            server=fakeredis.FakeServer(), max_connections=2
+        )
+        client = redis.StrictRedis(connection_pool=pool)
+        client.set("foo", "bar")
+        assert pipelined([('get', 'foo'), ('incr', 'count'), ('incr', 'count')], client=client) == [b"bar", 1, 2]
+        assert metrics.get_metrics()['histograms']['redis.connection_wait']['count'] == 2
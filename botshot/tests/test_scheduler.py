@@ -56,3 +56,117 @@ class TestScheduler():
         pk = task_id.split("botshot_schedule_")[1]
         s = ScheduledAction.objects.get(pk=pk)
         assert s.conversations.get_ids() == scheduler._validate_conversation_filter(conversations).get_ids()
+
+    def test_schedule_is_split_to_chunks(self, scheduler, settings, monkeypatch):
+        from botshot.core.conversation_filter import ListConversationFilter
+        settings.BOT_CONFIG['SCHEDULE_CHUNK_SIZE'] = 2
+        delay = mock.Mock()
+        monkeypatch.setattr(scheduler._schedule_chunk, "delay", delay)
+        scheduler._schedule_wrapper(ListConversationFilter([1, 2, 3, 4, 5]), {"_state": "foo.bar:"}, "1_0")
+        del settings.BOT_CONFIG['SCHEDULE_CHUNK_SIZE']
+        assert [c[0][0] for c in delay.call_args_list] == [[1, 2], [3, 4], [5]]
+        assert [c[0][3] for c in delay.call_args_list] == [0, 1, 2]
+
+    def test_broadcast_chunk(self, scheduler, monkeypatch):
+        fakeredis = pytest.importorskip("fakeredis")
+        from botshot.core.responses import TextMessage
+        from botshot.models import ChatConversation
+        redis = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr("botshot.core.scheduler.get_redis", lambda: redis)
+        broadcast = mock.Mock()
+        monkeypatch.setattr("botshot.core.chat_manager.ChatManager.broadcast", broadcast)
+        ids = [ChatConversation.objects.create(interface_name="test", raw_conversation_id=str(i)).pk
+               for i in range(3)]
+        message = TextMessage("hello")
+        scheduler._schedule_chunk(ids, message, "1_0", 0)
+        scheduler._schedule_chunk(ids, message, "1_0", 0)
+        broadcast.assert_called_once()
+        conversations, responses = broadcast.call_args[0]
+        assert sorted(c.pk for c in conversations) == sorted(ids) and responses == [message]
+
+    def test_chunk_resumes_after_crash(self, scheduler, monkeypatch):
+        fakeredis = pytest.importorskip("fakeredis")
+        redis = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr("botshot.core.scheduler.get_redis", lambda: redis)
+        accepted = []
+
+        def accept_scheduled(self, conversation_id, user_id, payload):
+            if conversation_id == 2 and 2 not in accepted:
+                accepted.append(2)
+                raise OSError("worker lost")
+            accepted.append(conversation_id)
+
+        monkeypatch.setattr("botshot.core.chat_manager.ChatManager.accept_scheduled", accept_scheduled)
+        with pytest.raises(OSError):
+            scheduler._schedule_chunk([1, 2, 3], {"_state": "foo.bar:"}, "1_0", 0)
+        scheduler._schedule_chunk([1, 2, 3], {"_state": "foo.bar:"}, "1_0", 0)
+        assert accepted == [1, 2, 2, 3]
+
+    def test_heartbeat_claims_due_schedules(self, scheduler, settings, monkeypatch):
+        from datetime import timedelta
+        from botshot.core import metrics
+        from botshot.models import ScheduledAction, ScheduledRun
+        settings.BOT_CONFIG['SCHEDULER_BATCH_SIZE'] = 2
+        delay = mock.Mock()
+        monkeypatch.setattr(scheduler._schedule_wrapper, "delay", delay)
+        monkeypatch.setattr("botshot.core.scheduler.get_redis", lambda: None)
+        metrics.reset()
+        now = timezone.now()
+        action = {"_state": "foo.bar:"}
+        once = ScheduledAction.objects.create(_at=now - timedelta(seconds=30), action=action, conversations=[1])
+        kept = ScheduledAction.objects.create(_at=now - timedelta(seconds=20), action=action, conversations=[1],
+                                              description="kept")
+        recurrent = ScheduledAction.objects.create(_at=now - timedelta(seconds=10), action=action, conversations=[1],
+                                                   recurrence={"second": 0})
+        ScheduledRun.objects.create(schedule=recurrent, _at=recurrent.at)
+        stale = ScheduledAction.objects.create(_at=now - timedelta(hours=2), action=action, conversations=[1])
+        future = ScheduledAction.objects.create(_at=now + timedelta(hours=1), action=action, conversations=[1])
+        scheduler.heartbeat()
+        del settings.BOT_CONFIG['SCHEDULER_BATCH_SIZE']
+
+        run_ids = [c[0][2] for c in delay.call_args_list]
+        assert sorted(run_ids) == sorted("{}_{}".format(s._id, int(s.at.timestamp())) for s in (once, kept, recurrent))
+        assert not ScheduledAction.objects.filter(pk__in=[once.pk, stale.pk]).exists()
+        assert ScheduledAction.objects.get(pk=kept.pk).is_done
+        assert ScheduledAction.objects.get(pk=recurrent.pk).at > now
+        assert ScheduledRun.objects.filter(schedule=recurrent, _at__gt=now).count() == 10
+        assert not ScheduledAction.objects.get(pk=future.pk).is_done
+        stats = metrics.get_metrics()
+        assert stats['histograms']['scheduler.lag']['count'] == 3
+        assert stats['counters']['scheduler.skipped'] == 1
+
+        delay.reset_mock()
+        scheduler.heartbeat()
+        delay.assert_not_called()
+
+    def test_lag_stats(self, scheduler, monkeypatch):
+        fakeredis = pytest.importorskip("fakeredis")
+        redis = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr("botshot.core.scheduler.get_redis", lambda: redis)
+        scheduler._record_lags([1.0, 3.0])
+        stats = scheduler.get_lag_stats()
+        assert stats['dispatched'] == 2 and stats['max_lag'] == 3.0 and stats['avg_lag'] == 2.0
+
+    def test_recurrent_schedule_runs_are_precomputed(self, scheduler, settings):
+        from botshot.models import ScheduledAction, ScheduledRun
+        settings.BOT_CONFIG['SCHEDULE_PRECOMPUTED_RUNS'] = 3
+        task_id = scheduler.add_recurrent_schedule({"_state": "foo.bar:"}, [1], cron="0 9 * * 1")
+        del settings.BOT_CONFIG['SCHEDULE_PRECOMPUTED_RUNS']
+        schedule = ScheduledAction.objects.get(pk=task_id.split("botshot_schedule_")[1])
+        runs = [run.at for run in ScheduledRun.objects.filter(schedule=schedule).order_by('_at')]
+        assert len(runs) == 3 and schedule.at == runs[0]
+        assert all(at.weekday() == 0 and at.hour == 9 and at.minute == 0 for at in runs)
+        with pytest.raises(Exception):
+            scheduler.add_recurrent_schedule({"_state": "foo.bar:"}, [1], cron="0 9 31 2 *")
+
+    def test_legacy_recurrent_schedule_gets_runs(self, scheduler, monkeypatch):
+        from datetime import timedelta
+        from botshot.models import ScheduledAction, ScheduledRun
+        delay = mock.Mock()
+        monkeypatch.setattr(scheduler._schedule_wrapper, "delay", delay)
+        monkeypatch.setattr("botshot.core.scheduler.get_redis", lambda: None)
+        due = timezone.now().replace(second=0, microsecond=0) - timedelta(minutes=1)
+        schedule = ScheduledAction.objects.create(_at=due, action={}, conversations=[1], recurrence={"second": 0})
+        scheduler.heartbeat()
+        assert delay.call_args_list[0][0][2] == "{}_{}".format(schedule._id, int(due.timestamp()))
+        assert ScheduledRun.objects.filter(schedule=schedule).exists()
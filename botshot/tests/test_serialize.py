@@ -29,3 +29,41 @@ class TestSerialize:
         assert json_deserialize(obj) is None
         obj = {"__type__": "i.dont.exist"}
         assert json_deserialize(obj) is None
+
+    def test_serialize_entity_inline(self):
+        import json
+        from datetime import datetime
+        from botshot.core.entity_value import EntityValue
+        start, end = datetime(2019, 1, 1), datetime(2019, 1, 2)
+        entity = EntityValue("date_interval", counter=3, state_set="default.root",
+                             value=(start, end), raw={"grain": "day"}, role="from")
+        data = json_serialize(entity)
+        assert data['__type__'] == 'entity' and '__data__' not in data
+        assert data['name'] == 'date_interval' and data['counter'] == 3
+        assert isinstance(data['timestamp'], float)
+
+        loaded = json.loads(json.dumps(entity, default=json_serialize), object_hook=json_deserialize)
+        assert isinstance(loaded, EntityValue)
+        assert loaded.value == (start, end)
+        assert loaded.role == 'from' and loaded.raw == {"grain": "day"}
+        assert loaded.counter == 3 and loaded.state_set == "default.root"
+        assert loaded.timestamp == entity.timestamp
+
+    def test_serialize_entity_compact(self):
+        from botshot.core.entity_value import EntityValue
+        entity = EntityValue("intent", counter=0, state_set=None, raw={"value": "greeting"})
+        data = json_serialize(entity)
+        # the value is already present in raw parser output
+        assert 'value' not in data and 'role' not in data and 'state_set' not in data
+        loaded = json_deserialize(data)
+        assert loaded.value == "greeting" and loaded.state_set == ""
+
+    def test_deserialize_legacy_entity(self):
+        import pickle
+        from base64 import b64encode
+        from botshot.core.entity_value import EntityValue
+        entity = EntityValue("intent", counter=1, state_set="default.root", raw={"value": "greeting"})
+        data = {"__type__": "entity", "__data__": b64encode(pickle.dumps(entity)).decode('utf8')}
+        loaded = json_deserialize(data)
+        assert isinstance(loaded, EntityValue) and loaded.value == "greeting"
+        assert json_serialize(loaded)['version'] == 2
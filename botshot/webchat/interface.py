@@ -4,11 +4,15 @@ import random
 import time
 import uuid
 
-from botshot.core.chat_manager import ChatManager
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from botshot.core import pipeline
 from botshot.core.interfaces import BotshotInterface
 from botshot.core.parsing.raw_message import RawMessage
 from botshot.models import ChatMessage
-from botshot.tasks import run_async
+from botshot.webchat import push
 
 
 class WebchatInterface(BotshotInterface):
@@ -16,8 +20,6 @@ class WebchatInterface(BotshotInterface):
     name = 'webchat'
 
     def webhook(self, request):
-        manager = ChatManager()
-        
         text = request.POST.get('message')
         payload = None
         if request.POST.get('payload'):
@@ -42,17 +44,50 @@ class WebchatInterface(BotshotInterface):
         )
 
         self.on_message_received(raw_message)
+        message = ChatMessage(type=msg_type, text=text, time=timezone.now(), is_user=True)
+        self.publish_messages(webchat_id, [message])
         logging.info("[Webchat] Received raw message: %s", raw_message)
-        run_async(manager.accept, raw_message=raw_message)
+        pipeline.submit(raw_message)
         return True
 
     def on_message_received(self, raw_message):
         pass
 
     def send_responses(self, conversation, reply_to, responses):
-        pass
+        messages = [
+            ChatMessage(type=ChatMessage.MESSAGE, text=response.get_text(), time=timezone.now(),
+                        is_user=False, response_dict=response)
+            for response in responses
+        ]
+        self.publish_messages(conversation.raw_conversation_id, messages)
+
+    def publish_messages(self, webchat_id, messages):
+        """Sends rendered messages to open webchat pages of a conversation, if Redis is configured."""
+        if not messages or not push.is_enabled():
+            return
+        try:
+            push.publish(webchat_id, json.dumps({'messages': self.render_messages(messages)}))
+        except Exception:
+            # the messages are still shown when the page is reloaded
+            logging.exception("[Webchat] Unable to publish messages")
+
+    @staticmethod
+    def render_messages(messages) -> list:
+        """Returns HTML of each message, the same as in the webchat page."""
+        context = WebchatInterface.get_template_context()
+        return [
+            render_to_string('botshot/webchat/message.html', dict(context, m=message, last=i == len(messages) - 1))
+            for i, message in enumerate(messages)
+        ]
+
+    @staticmethod
+    def get_template_context() -> dict:
+        return {
+            'user_img': settings.BOT_CONFIG.get('WEBCHAT_USER_IMAGE', 'images/icon_user.png'),
+            'bot_img': settings.BOT_CONFIG.get('WEBCHAT_BOT_IMAGE', 'images/icon_robot.png'),
+        }
 
-    def broadcast_responses(self, conversations, responses):
+    def broadcast_responses(self, conversations, responses, broadcast_id=None):
         pass
 
     @staticmethod
@@ -0,0 +1,106 @@
+"""
+Delivery of new webchat messages to open pages, through Redis pub/sub and Server-Sent Events.
+
+Each event is published to the channel of a webchat conversation and appended to its short history,
+with an ID from a sequence of the conversation. A page receives only events with a higher ID than the last one it has,
+the history replays events published while it was reconnecting. Open pages don't query the database.
+"""
+import time
+
+from botshot.core import config, metrics
+from botshot.core.persistence import get_redis, get_pubsub_redis
+
+CHANNEL_PREFIX = "botshot_webchat_"
+HISTORY_PREFIX = "botshot_webchat_history_"
+SEQUENCE_PREFIX = "botshot_webchat_seq_"
+SEQUENCE_TTL = 3600 * 24
+# milliseconds the browser waits before it reconnects a closed stream
+RETRY_MS = 1000
+
+# numbers an event, appends it to the history and publishes it
+_PUBLISH = """
+local id = redis.call('INCR', KEYS[1])
+local entry = id .. ':' .. ARGV[1]
+redis.call('RPUSH', KEYS[2], entry)
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('PUBLISH', KEYS[3], entry)
+return id
+"""
+
+
+def is_enabled() -> bool:
+    return get_redis() is not None
+
+
+def publish(webchat_id, data: str):
+    """Sends an event to open pages of a conversation, returns its ID, or None without Redis."""
+    redis = get_redis()
+    if redis is None:
+        return None
+    event_id = redis.eval(
+        _PUBLISH, 3, SEQUENCE_PREFIX + webchat_id, HISTORY_PREFIX + webchat_id, CHANNEL_PREFIX + webchat_id,
+        data, config.get("WEBCHAT_HISTORY_SIZE", 50), SEQUENCE_TTL
+    )
+    metrics.counter("webchat.published").inc()
+    return event_id
+
+
+def get_last_id(webchat_id) -> int:
+    """Returns the ID of the last event of a conversation, a page rendered now has all events up to it."""
+    redis = get_redis()
+    if redis is None or not webchat_id:
+        return 0
+    return int(redis.get(SEQUENCE_PREFIX + webchat_id) or 0)
+
+
+def stream(webchat_id, last_id=0, duration=None, heartbeat=None):
+    """
+    Generates Server-Sent Events of a conversation with an ID higher than last_id.
+    The stream ends after duration seconds and the browser reconnects, so that a connection isn't held forever.
+    A comment is sent every heartbeat seconds to keep idle connections open through proxies.
+
+    The subscription holds a connection of get_pubsub_redis(), outside the shared pool of get_redis().
+    With a sync WSGI server, each open stream also holds a worker thread for its whole duration.
+    """
+    duration = duration if duration is not None else config.get("WEBCHAT_STREAM_SECONDS", 60)
+    heartbeat = heartbeat if heartbeat is not None else config.get("WEBCHAT_HEARTBEAT_SECONDS", 15)
+    redis = get_redis()
+    pubsub = get_pubsub_redis().pubsub(ignore_subscribe_messages=True)
+    # subscribe before reading the history, so that no event is missed in between
+    pubsub.subscribe(CHANNEL_PREFIX + webchat_id)
+    metrics.counter("webchat.streams").inc()
+    try:
+        yield "retry: {}\n\n".format(RETRY_MS)
+        for entry in redis.lrange(HISTORY_PREFIX + webchat_id, 0, -1):
+            event_id, data = _parse(entry)
+            if event_id > last_id:
+                last_id = event_id
+                yield _format(event_id, data)
+        now = time.time()
+        deadline, next_heartbeat = now + duration, now + heartbeat
+        while now < deadline:
+            message = pubsub.get_message(timeout=max(min(deadline, next_heartbeat) - now, 0))
+            now = time.time()
+            if message is not None and message['type'] == 'message':
+                event_id, data = _parse(message['data'])
+                if event_id > last_id:
+                    last_id = event_id
+                    yield _format(event_id, data)
+            elif now >= next_heartbeat:
+                next_heartbeat = now + heartbeat
+                yield ": ping\n\n"
+    finally:
+        pubsub.close()
+
+
+def _parse(entry):
+    entry = entry.decode("utf-8") if isinstance(entry, bytes) else entry
+    event_id, data = entry.split(":", 1)
+    return int(event_id), data
+
+
+def _format(event_id, data: str) -> str:
+    lines = "".join("data: {}\n".format(line) for line in data.split("\n"))
+    return "id: {}\n{}\n".format(event_id, lines)
@@ -6,5 +6,6 @@ urlpatterns = [
     # url(r'(?P<uid>[0-9]+)', view=webchat, name='webchat'),
     url(r'^$', view=webchat, name='webchat'),
     url(r'^logout/?$', view=do_logout, name='do_logout'),
-    url(r'^last_change/$', view=get_last_change, name='last_change')
+    url(r'^last_change/$', view=get_last_change, name='last_change'),
+    url(r'^stream/$', view=stream, name='webchat_stream')
 ]
@@ -3,10 +3,12 @@ from datetime import datetime
 
 from django.conf import settings
 from django.db.models import Max
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 
+from botshot.core.interface_factory import InterfaceFactory
 from botshot.models import ChatMessage
+from botshot.webchat import push
 from botshot.webchat.interface import WebchatInterface
 from .forms import MessageForm
 import logging
@@ -22,7 +24,7 @@ def webchat(request):
             webchat_id = WebchatInterface.make_webchat_id()
             request.session['webchat_id'] = webchat_id
 
-        interface = WebchatInterface()
+        interface = InterfaceFactory.from_name(WebchatInterface.name)
         is_ok = interface.webhook(request)
         return JsonResponse({'ok': True}) if is_ok else HttpResponse(400)
 
@@ -46,8 +48,10 @@ def webchat(request):
         'messages': messages,
         'form': MessageForm,
         'timestamp': datetime.now().timestamp(),
-        'user_img': settings.BOT_CONFIG.get('WEBCHAT_USER_IMAGE', 'images/icon_user.png'),
-        'bot_img': settings.BOT_CONFIG.get('WEBCHAT_BOT_IMAGE', 'images/icon_robot.png')
+        'has_conversation': 'webchat_id' in request.session,
+        # without Redis, the page polls for changes
+        'stream_last_id': push.get_last_id(request.session.get('webchat_id')) if push.is_enabled() else None,
+        **WebchatInterface.get_template_context()
     }
     return render(request, 'botshot/webchat/index.html', context)
 
@@ -62,6 +66,23 @@ def _get_webchat_id_messages(webchat_id):
     return ChatMessage.objects.filter(conversation__raw_conversation_id=webchat_id).order_by('time')
 
 
+def stream(request):
+    """Server-Sent Events with new messages of the conversation, see botshot.webchat.push."""
+    if 'webchat_id' not in request.session or not push.is_enabled():
+        # tells the browser not to reconnect, the page falls back to polling
+        return HttpResponse(status=204)
+    try:
+        last_id = int(request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_id') or 0)
+    except ValueError:
+        last_id = 0
+    response = StreamingHttpResponse(push.stream(request.session['webchat_id'], last_id),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # disables buffering of the response in nginx
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 def get_last_change(request):
     if 'webchat_id' not in request.session:
         max_timestamp = 0
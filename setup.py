@@ -47,7 +47,7 @@ setup(
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
         'Topic :: Communications :: Chat',
     ],
-    install_requires=['django>=2.1.5', 'networkx', 'requests', 'six', 'sqlparse', 'wit==4.3.0', 'wheel', 'redis', 'Pillow', 'jsonfield',
+    install_requires=['django>=2.2', 'networkx', 'requests', 'urllib3>=1.26', 'six', 'sqlparse', 'wit==4.3.0', 'wheel', 'redis>=3.3', 'Pillow', 'jsonfield',
                       'pytz', 'unidecode', 'emoji', 'elasticsearch', 'celery>=4.1.1', 'python-dateutil', 'pyyaml', 'djangorestframework',
                       'pytest', 'pytest-django', 'mock'],
 )